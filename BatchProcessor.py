@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import itertools
+import collections
+import multiprocessing
+
+import EFI
+from TreePrinter import EfiTreePrintVisitor
+from EfiTreeFileDumpVisitor import EfiTreeFileDumpVisitor
+from FDFGenerator import FDFGenerator
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ['summary', 'print', 'dump', 'genfdf']
+
+#Seconds an image may take before it is reported as failed
+DEFAULT_TIMEOUT = 3600
+
+class ImageTimeout(Exception):
+	pass
+
+def _timeout(signum, frame):
+	raise ImageTimeout("Processing the image took too long")
+
+def _startTimeout(seconds):
+	"""Raises ImageTimeout in this process after seconds, returns False if that is not
+	possible (no SIGALRM on this platform, or not called from the main thread)"""
+	if not seconds or not hasattr(signal, "SIGALRM"):
+		return False
+	try:
+		signal.signal(signal.SIGALRM, _timeout)
+	except ValueError:
+		return False
+	signal.alarm(seconds)
+	return True
+
+def ListImages(source):
+	"""Returns the images below the directory source, or listed in the manifest file
+	source (one path per line, relative to the manifest, # starts a comment)"""
+	if os.path.isdir(source):
+		images = []
+		for (dirpath, dirnames, filenames) in os.walk(source):
+			dirnames.sort()
+			for filename in sorted(filenames):
+				images.append(os.path.join(dirpath, filename))
+		return (source, images)
+
+	base = os.path.dirname(os.path.abspath(source))
+	images = []
+	for line in open(source):
+		line = line.split("#", 1)[0].strip()
+		if line:
+			images.append(os.path.join(base, line))
+	return (base, images)
+
+def _outputName(base, image):
+	name = os.path.relpath(os.path.abspath(image), os.path.abspath(base))
+	if name.startswith(os.pardir):
+		name = os.path.basename(image)
+	return name
+
+def Summarize(image):
+	"""Counts the nodes of image, including everything in compressed sections and nested volumes"""
+	summary = {"volumes": 0, "files": 0, "sections": 0, "encapsulations": 0, "fileGuids": []}
+	pending = collections.deque(image.firmwareVolumes)
+	while pending:
+		node = pending.popleft()
+		if isinstance(node, EFI.EfiFirmwareVolume):
+			summary["volumes"] += 1
+			pending.extend(node.files)
+		elif isinstance(node, EFI.EfiFile):
+			summary["files"] += 1
+			summary["fileGuids"].append(str(node.Guid))
+			pending.extend(node.subsections)
+		else:
+			summary["sections"] += 1
+			if isinstance(node, EFI.EfiEncapsulationSection):
+				summary["encapsulations"] += 1
+			if isinstance(node, EFI.EfiFirmwareVolumeSection):
+				pending.extend(node.SubFirmware.firmwareVolumes)
+			else:
+				pending.extend(node.Subsections)
+	return summary
+
+def ProcessImage(job):
+	"""Runs operation on one image and returns a JSON serializable record. Errors are
+	reported in the record, they never propagate to the caller. Images without a
+	firmware volume are reported as errors, the operation is not run on them. So
+	are images taking longer than timeout seconds, where SIGALRM is available."""
+	(image, name, operation, outputDirectory, useMmap, timeout) = job
+	record = {"image": image, "operation": operation}
+	start = time.time()
+	timed = False
+	try:
+		timed = _startTimeout(timeout)
+		f = open(image, "rb")
+		try:
+			fw = EFI.OpenFirmwareImage(f, useMmap)
+			record["size"] = fw.length
+			destination = os.path.join(outputDirectory, name)
+
+			if not fw.firmwareVolumes:
+				record["error"] = "no firmware volume found"
+			elif operation == 'summary':
+				record.update(Summarize(fw))
+			elif operation == 'print':
+				if not os.path.isdir(os.path.dirname(destination)):
+					os.makedirs(os.path.dirname(destination))
+				output = open(destination + ".txt", "w")
+				EfiTreePrintVisitor(output=output).visit(fw)
+				output.close()
+				record["output"] = destination + ".txt"
+			elif operation == 'dump':
+				EfiTreeFileDumpVisitor(destination).visit(fw)
+				record["output"] = destination
+			elif operation == 'genfdf':
+				if not os.path.isdir(os.path.dirname(destination)):
+					os.makedirs(os.path.dirname(destination))
+				output = open(destination + ".fdf", "w")
+				FDFGenerator(destination).generate(fw, output)
+				output.close()
+				record["output"] = destination + ".fdf"
+		finally:
+			f.close()
+		record["status"] = "error" if "error" in record else "ok"
+	except Exception as e:
+		logger.debug("Processing %s failed", image, exc_info=True)
+		record["status"] = "error"
+		record["error"] = "%s: %s" % (type(e).__name__, e)
+	finally:
+		if timed:
+			signal.alarm(0)
+	record["seconds"] = round(time.time() - start, 6)
+	return record
+
+def ProcessBatch(source, operation, outputDirectory, jobs, output=sys.stdout, useMmap=True, timeout=DEFAULT_TIMEOUT):
+	"""Runs operation on every image of source on jobs worker processes and writes one
+	JSON line per image to output as soon as it is done. Images taking longer than
+	timeout seconds fail. Returns the number of failed images."""
+	(base, images) = ListImages(source)
+	tasks = [(image, _outputName(base, image), operation, outputDirectory, useMmap, timeout) for image in images]
+
+	pool = None
+	if jobs > 1:
+		pool = multiprocessing.Pool(jobs)
+		results = pool.imap_unordered(ProcessImage, tasks, 1)
+	else:
+		results = itertools.imap(ProcessImage, tasks)
+
+	failed = 0
+	try:
+		for record in results:
+			if record["status"] != "ok":
+				failed += 1
+			output.write(json.dumps(record, sort_keys=True) + "\n")
+			output.flush()
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	return failed
@@ -1,40 +1,61 @@
 # -*- coding: utf-8 -*-
+import struct
 
-class BitArray:
+class BitReader(object):
+	"""MSB first bit reader. Up to 64 bits are kept in an integer bit buffer which
+	is refilled 32 bits at a time, bits past the end of the data read as zero."""
 
 	def __init__(self, data):
 		self._Data = data
-		
-		self._DataBitsLeft = len(data) * 8
+		self._Length = len(data)
+		self._BytePos = 0
+		self._BitBuf = 0
+		self._BitCount = 0
 
-		self._ByteIdx = 0
-		self._BitIdx = 0
-	
-	def mask(self, bitcount):
-		return (1 << bitcount) - 1
+	def _fill(self, bitcount):
+		while self._BitCount < bitcount:
+			pos = self._BytePos
+			if pos + 4 <= self._Length:
+				(word,) = struct.unpack_from(">I", self._Data, pos)
+			else:
+				(word,) = struct.unpack(">I", (self._Data[pos:pos+4] + "\0\0\0\0")[:4])
+			self._BitBuf = (self._BitBuf << 32) | word
+			self._BitCount += 32
+			self._BytePos = pos + 4
 
-	def read(self, bitsleftcount):
+	def tell(self):
+		"""Returns the number of bits consumed so far"""
+		return self._BytePos * 8 - self._BitCount
 
-		result = 0
-		bitsdonecount = 0
-		while bitsleftcount:
-			curbitsleftcount = 8 - self._BitIdx
-			curdata = ord(self._Data[self._ByteIdx]) & self.mask(curbitsleftcount)
-			
-			if curbitsleftcount >= bitsleftcount:
-				result <<= bitsleftcount				
-				result |= curdata >> (curbitsleftcount - bitsleftcount)
-				self._BitIdx += bitsleftcount
-				bitsleftcount = 0
-			else:
-				result <<= curbitsleftcount
-				result |= curdata
-				bitsleftcount -= curbitsleftcount
-				self._BitIdx += curbitsleftcount
-			
-			if self._BitIdx >= 8:
-				self._BitIdx = 0
-				self._ByteIdx += 1
-				
+	def peek(self, bitcount):
+		"""Returns the next bitcount bits without consuming them"""
+		if self._BitCount < bitcount:
+			self._fill(bitcount)
+		return (self._BitBuf >> (self._BitCount - bitcount)) & ((1 << bitcount) - 1)
+
+	def skip(self, bitcount):
+		if self._BitCount < bitcount:
+			self._fill(bitcount)
+		self._BitCount -= bitcount
+		self._BitBuf &= (1 << self._BitCount) - 1
+
+	def read(self, bitcount):
+		if self._BitCount < bitcount:
+			self._fill(bitcount)
+		self._BitCount -= bitcount
+		result = self._BitBuf >> self._BitCount
+		self._BitBuf &= (1 << self._BitCount) - 1
 		return result
 
+class BitArray(BitReader):
+	"""Compatibility wrapper around BitReader. Like the former byte wise
+	implementation it raises an IndexError when reading past the end. The bounds
+	check makes it slower than BitReader, which the decompressor uses."""
+
+	def mask(self, bitcount):
+		return (1 << bitcount) - 1
+
+	def read(self, bitsleftcount):
+		if self._BytePos * 8 - self._BitCount + bitsleftcount > self._Length * 8:
+			raise IndexError("BitArray read past the end of the data")
+		return super(BitArray, self).read(bitsleftcount)
@@ -0,0 +1,142 @@
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+class DecompressionCache(object):
+	"""Content addressed on-disk cache of decompressed section payloads.
+
+	Entries are keyed by a hash of the algorithm name and the compressed payload
+	and live in 256 subdirectories of the cache directory. Entries are written to
+	a temporary file and renamed into place, so several processes can share one
+	cache directory. A hit refreshes the modification time of an entry, trim()
+	evicts the least recently used entries until the cache fits into maxSize."""
+
+	def __init__(self, directory, maxSize=DEFAULT_MAX_SIZE):
+		self.Directory = os.path.abspath(directory)
+		self.MaxSize = maxSize
+		self.Hits = 0
+		self.Misses = 0
+		self.Stores = 0
+		self.Evictions = 0
+		self._writtenSinceTrim = 0
+		if not os.path.isdir(self.Directory):
+			try:
+				os.makedirs(self.Directory)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+	def key(self, algorithm, payload):
+		h = hashlib.sha256(algorithm)
+		h.update(b"\0")
+		h.update(payload)
+		return h.hexdigest()
+
+	def _path(self, key):
+		return os.path.join(self.Directory, key[:2], key)
+
+	def get(self, algorithm, payload):
+		"""Returns the cached decompressed payload or None"""
+		path = self._path(self.key(algorithm, payload))
+		try:
+			f = open(path, "rb")
+		except IOError:
+			self.Misses += 1
+			return None
+
+		data = f.read()
+		f.close()
+		try:
+			os.utime(path, None)
+		except OSError:
+			#Evicted by another process in the meantime, the data is still valid
+			pass
+		self.Hits += 1
+		return data
+
+	def put(self, algorithm, payload, data):
+		"""Stores data for the payload. The cache is optional, if the entry cannot be
+		written (e.g. the disk is full) that is logged and False is returned."""
+		path = self._path(self.key(algorithm, payload))
+		subdir = os.path.dirname(path)
+		tmppath = None
+		try:
+			if not os.path.isdir(subdir):
+				try:
+					os.makedirs(subdir)
+				except OSError as e:
+					if e.errno != errno.EEXIST:
+						raise
+
+			(fd, tmppath) = tempfile.mkstemp(dir=subdir, prefix=".tmp-")
+			f = os.fdopen(fd, "wb")
+			try:
+				f.write(data)
+			finally:
+				f.close()
+			os.rename(tmppath, path)
+		except (IOError, OSError) as e:
+			if tmppath is not None and os.path.exists(tmppath):
+				try:
+					os.unlink(tmppath)
+				except OSError:
+					pass
+			#Another process may have stored the same entry first (rename does not replace on Windows)
+			if not os.path.exists(path):
+				logger.warning("Cannot store %s in the decompression cache: %s", path, e)
+				return False
+
+		self.Stores += 1
+		self._writtenSinceTrim += len(data)
+		if self._writtenSinceTrim > self.MaxSize // 10:
+			self.trim()
+		return True
+
+	def decompress(self, algorithm, payload, decompressor):
+		"""Returns decompressor(payload), from the cache if possible"""
+		data = self.get(algorithm, payload)
+		if data is None:
+			data = decompressor(payload)
+			self.put(algorithm, payload, data)
+		return data
+
+	def trim(self):
+		"""Evicts the least recently used entries until the cache fits into MaxSize"""
+		self._writtenSinceTrim = 0
+		entries = []
+		total = 0
+		for subdir in os.listdir(self.Directory):
+			subdir = os.path.join(self.Directory, subdir)
+			if not os.path.isdir(subdir):
+				continue
+			for name in os.listdir(subdir):
+				if name.startswith(".tmp-"):
+					continue
+				path = os.path.join(subdir, name)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+				total += st.st_size
+
+		entries.sort()
+		for (mtime, size, path) in entries:
+			if total <= self.MaxSize:
+				break
+			try:
+				os.unlink(path)
+				self.Evictions += 1
+			except OSError:
+				pass
+			total -= size
+		return total
+
+	def __str__(self):
+		return "%u hits, %u misses, %u stores, %u evictions" % (self.Hits, self.Misses, self.Stores, self.Evictions)
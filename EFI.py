@@ -1,11 +1,23 @@
+import abc
+import ast
 import logging
 import os
+import re
+import sys
+import mmap
+import time
 import uuid
 import struct
-import tempfile
-import subprocess
-import StringIO
+try:
+	import audioop
+except ImportError:
+	#Not available everywhere, Sum8 and Sum16 fall back to summing in python
+	audioop = None
+import Stats
+import EfiCompressor
 import EfiDecompressor
+import LzmaCompressor
+import LzmaDecompressor
 
 logger = logging.getLogger(__name__)
 
@@ -14,95 +26,357 @@ class EFIGUIDS:
 	FIRMWARE_VOLUME2 = uuid.UUID('{8c8ce578-8a3d-4f1c-9935-896185c32dd3}')
 	FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED = uuid.UUID('{ee4e5898-3914-4259-9d6e-dc7bd79403cf}')
 
+def BufferView(data, offset, length=None):
+	"""Returns a zero-copy view of length bytes of data starting at offset"""
+	if length is None:
+		return buffer(data, offset)
+	return buffer(data, offset, length)
+
+def _bulkSum(data, width):
+	#audioop sums the little endian words of a buffer in C. avg() divides the exact
+	#sum by the number of words and truncates, but with the words scaled up to 32
+	#bit the sum is a multiple of the scale and can be recovered from the average
+	#as long as a chunk has fewer than half the scale words. The words are signed,
+	#which does not change the sum modulo the word size. Chunks are kept small, the
+	#scaled copy of a chunk is up to four times its size.
+	if isinstance(data, bytearray):
+		data = buffer(data)
+	scale = 1 << (8 * (4 - width))
+	chunk = min(scale // 2, 1 << 18) * width
+	length = len(data) - len(data) % width
+	total = 0
+	for offset in xrange(0, length, chunk):
+		words = BufferView(data, offset, min(chunk, length - offset))
+		average = audioop.avg(audioop.lin2lin(words, width, 4), 4)
+		total += int(round(average * (len(words) // width) / float(scale)))
+	return total
+
+def Sum8(data):
+	"""The 8 bit sum of the bytes of data"""
+	if audioop is None:
+		return sum(bytearray(data)) & 0xFF
+	return _bulkSum(data, 1) & 0xFF
+
+def Sum16(data):
+	"""The 16 bit sum of the little endian words of data, a trailing odd byte is ignored"""
+	if audioop is None or sys.byteorder != "little":
+		#audioop reads native words
+		data = str(data)
+		return sum(struct.unpack("<%uH" % (len(data) // 2), data[0:len(data) & ~1])) & 0xFFFF
+	return _bulkSum(data, 2) & 0xFFFF
+
+class BufferStream(object):
+	"""A read-only file-like stream on top of a string, an mmap or another buffer.
+	Headers are read as small copies, payloads are handed out as views into the
+	underlying buffer by view()."""
+	def __init__(self, data):
+		self.Data = data
+		self.pos = 0
+
+	def __len__(self):
+		return len(self.Data)
+
+	def read(self, size=-1):
+		if size < 0:
+			size = len(self.Data) - self.pos
+		result = self.Data[self.pos:self.pos+size]
+		self.pos += len(result)
+		return result
+
+	def view(self, size):
+		result = BufferView(self.Data, self.pos, size)
+		self.pos += len(result)
+		return result
+
+	def seek(self, offset, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			offset += self.pos
+		elif whence == os.SEEK_END:
+			offset += len(self.Data)
+		self.pos = max(offset, 0)
+
+	def tell(self):
+		return self.pos
+
+#GUIDs of the file systems a firmware volume header may carry. Extend this list
+#to make FindFirmwareVolumes accept vendor specific file systems as well.
+FIRMWARE_VOLUME_GUIDS = [EFIGUIDS.FIRMWARE_VOLUME1, EFIGUIDS.FIRMWARE_VOLUME2]
+
+FV_SIGNATURE = '_FVH'
+FV_SIGNATURE_OFFSET = 40
+FV_HEADER_FORMAT = "<16s16sQ4sIHH3sB"
+FV_HEADER_LENGTH = struct.calcsize(FV_HEADER_FORMAT)
+FV_CHECKSUM_OFFSET = 50
+FVB2_ERASE_POLARITY = 0x00000800
+
+_fvSignatureRegex = re.compile(re.escape(FV_SIGNATURE))
+
+#A DecompressionCache.DecompressionCache to look up decompressed payloads in
+DECOMPRESSION_CACHE = None
+
+def CachedDecompress(algorithm, decompressor, payload):
+	"""Returns decompressor(payload), through DECOMPRESSION_CACHE if one is set"""
+	if DECOMPRESSION_CACHE is None:
+		return decompressor(payload)
+	return DECOMPRESSION_CACHE.decompress(algorithm, payload, decompressor)
+
+def FindFirmwareVolumes(data, start=0, end=None, guids=None):
+	"""Returns the offsets of all firmware volume headers in data[start:end].
+
+	The buffer is scanned in one pass for the _FVH signature, every hit is
+	validated as a header (file system GUID, header and volume length). Hits
+	inside an already accepted volume are skipped, nested volumes are found
+	through their firmware volume image sections."""
+	if end is None:
+		end = len(data)
+	if guids is None:
+		guids = FIRMWARE_VOLUME_GUIDS
+	guidBytes = frozenset(guid.bytes_le for guid in guids)
+
+	scanStart = time.time()
+	offsets = []
+	nextFree = start
+	for match in _fvSignatureRegex.finditer(data, start + FV_SIGNATURE_OFFSET, end):
+		offset = match.start() - FV_SIGNATURE_OFFSET
+		if offset < nextFree or offset + FV_HEADER_LENGTH > end:
+			continue
+
+		(zero, guid, length, sig, attrib, headerlength, checksum, reserved, revision) = struct.unpack_from(FV_HEADER_FORMAT, data, offset)
+		if guid not in guidBytes:
+			continue
+		if headerlength < FV_HEADER_LENGTH or headerlength > length:
+			logger.debug("Ignoring firmware volume signature at 0x%X with header length 0x%X", offset, headerlength)
+			continue
+		if offset + length > end:
+			logger.warning("Ignoring firmware volume at 0x%X, its length 0x%X exceeds the image", offset, length)
+			continue
+
+		offsets.append(offset)
+		nextFree = offset + length
+
+	if Stats.STATS is not None:
+		Stats.STATS.addTime("fvscan", time.time() - scanStart)
+		Stats.STATS.add("fvscan.bytes", max(end - start, 0))
+	return offsets
+
+def OpenFirmwareImage(f, useMmap=True):
+	"""Parses the firmware image in the open file f, memory-mapped unless useMmap is False"""
+	f.seek(0, os.SEEK_END)
+	length = f.tell()
+	f.seek(0, os.SEEK_SET)
+
+	stream = f
+	if useMmap and length:
+		stream = BufferStream(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+	return EfiFirmwareImage(stream, length)
+
 class EfiElement(object):
+	#Nodes have no __dict__, a tree of tens of thousands of sections is dominated
+	#by their per-node overhead. Subclasses list their fields in __slots__ as well
+	#and derive payloads from Data on demand instead of storing more views.
+	__slots__ = ("Parent", "Dirty")
+
 	def __init__(self):
-		pass
+		#The element this one was parsed from, set when it is yielded by iterChildren
+		self.Parent = None
+		#Set by markDirty on modified elements and everything above them
+		self.Dirty = False
+
+	def markDirty(self):
+		"""Flags the element and all its ancestors as modified, Repacker only rebuilds
+		dirty elements"""
+		node = self
+		while node is not None and not node.Dirty:
+			node.Dirty = True
+			node = node.Parent
+
+	def iterChildren(self):
+		"""Yields (offset, child) for the direct children of the element without
+		keeping them. Offsets are relative to the buffer the children are parsed
+		from, i.e. the image, the volume data, the file data or the decoded content
+		of an encapsulation section."""
+		return iter(())
+
+def _adopt(parent, children):
+	for (offset, child) in children:
+		child.Parent = parent
+		yield (offset, child)
+
+START = "start"
+END = "end"
+
+def CachedChildren(node):
+	"""Returns the (offset, child) tuples of a node like iterChildren, but from the
+	children the node keeps, so a parsed tree is walked without parsing or
+	decompressing anything twice"""
+	if isinstance(node, EfiFirmwareImage):
+		return [(v.Base, v) for v in node.firmwareVolumes]
+	if isinstance(node, EfiFirmwareVolume):
+		return [(f.Base, f) for f in node.files]
+	if isinstance(node, EfiFile):
+		sections = node.subsections
+	elif isinstance(node, EfiFirmwareVolumeSection):
+		return [(v.Base, v) for v in node.SubFirmware.firmwareVolumes]
+	else:
+		sections = node.Subsections
+
+	#Sections have no offset, they follow each other 4 byte aligned
+	result = []
+	offset = 0
+	for s in sections:
+		offset += (-offset) % 4
+		result.append((offset, s))
+		offset += len(s.Data)
+	return result
+
+def IterEvents(root, descend=None, children=None):
+	"""SAX-style walk over root and everything below it in image order.
+
+	Yields (event, node, offset, depth) tuples where event is START or END. Nodes
+	are parsed when they are reached and released after their END event unless the
+	consumer keeps them, so memory is bounded by the nesting depth instead of the
+	image size. Volumes found in firmware volume image sections are children of
+	that section. If descend is given, descend(node, depth) is called after the
+	START event of every node and its children are skipped if it returns False.
+	children(node) returns the (offset, child) tuples of a node, iterChildren by
+	default. Pass CachedChildren to walk a tree which is already parsed."""
+	if children is None:
+		children = lambda node: node.iterChildren()
+
+	yield (START, root, 0, 0)
+	if descend is not None and not descend(root, 0):
+		yield (END, root, 0, 0)
+		return
+
+	stack = [(root, 0, iter(children(root)))]
+	while stack:
+		(node, offset, remaining) = stack[-1]
+		depth = len(stack)
+		for (childOffset, child) in remaining:
+			yield (START, child, childOffset, depth)
+			if descend is None or descend(child, depth):
+				stack.append((child, childOffset, iter(children(child))))
+			else:
+				yield (END, child, childOffset, depth)
+			break
+		else:
+			stack.pop()
+			yield (END, node, offset, depth - 1)
 
 class EfiFirmwareImage(EfiElement):
+	__slots__ = ("stream", "length", "_start", "_firmwareVolumes")
+
 	def __init__(self, stream, length):
+		super(EfiFirmwareImage, self).__init__()
+		#The parser works on views into one buffer. Plain file streams are read
+		#into memory once, pass a BufferStream on top of an mmap to avoid that copy.
+		if not isinstance(stream, BufferStream):
+			start = stream.tell()
+			stream.seek(0, os.SEEK_SET)
+			stream = BufferStream(stream.read(length))
+			stream.seek(start, os.SEEK_SET)
+
 		self.stream = stream
 		self.length = length
-		self.firmwareVolumes = []
+		self._start = stream.tell()
+		self._firmwareVolumes = None
 
-		self._parse()
+	@property
+	def IsExpanded(self):
+		"""True once the children were parsed and kept, i.e. they may have been modified"""
+		return self._firmwareVolumes is not None
 
-	def _parse(self):
+	@property
+	def firmwareVolumes(self):
+		if self._firmwareVolumes is None:
+			self._firmwareVolumes = [v for (base, v) in self.iterChildren()]
+		return self._firmwareVolumes
+
+	def iterChildren(self):
 		logger.debug("Parsing EfiFirmwareImage with length %u", self.length)
 
-		base = self.stream.tell()
-		while base < self.length:
-			#Align to 8 bytes
-			if self.stream.tell() % 8:
-				tmp = 8 - (self.stream.tell() % 8)
-				self.stream.seek(tmp, os.SEEK_CUR)
-				base += tmp
-
-			#search for firmware volume GUID
-			guidBytes = self.stream.read(16)
-			while base < self.length and uuid.UUID(bytes_le=guidBytes) != EFIGUIDS.FIRMWARE_VOLUME1 and uuid.UUID(bytes_le=guidBytes) != EFIGUIDS.FIRMWARE_VOLUME2:
-				guidBytes = self.stream.read(16)
-				if len(guidBytes) < 16:
-					return
-				base += 16
-
-			#seems a firmware volume was found
-			#rewind the stream back to the beginning
-			base -=16
-			self.stream.seek(-32, os.SEEK_CUR)
-			logger.debug("Found firmware volume at 0x%X", self.stream.tell())
-
-			(zero, guid, length, sig, attrib, headerlength, checksum, reserved, revision) = struct.unpack("<16s16sQ4sIHH3sB", self.stream.read(16 + 16 + 8 + 4 + 4 + 2 + 2 + 3 + 1))
-			guid = uuid.UUID(bytes_le=guid)
-			self.firmwareVolumes.append(EfiFirmwareVolume(base, headerlength, length - headerlength, sig, attrib, self.stream))
-
-			#skip blockmap
-			while True:
-				(numBlocks, blockLength) = struct.unpack("<II", self.stream.read(8))
-				if numBlocks == 0 and blockLength == 0:
- 					break;
-
-			self.stream.seek(length - headerlength, os.SEEK_CUR)
-			base += length
+		for base in FindFirmwareVolumes(self.stream.Data, self._start, self.length):
+			logger.debug("Found firmware volume at 0x%X", base)
+			yield (base, self._volumeAt(base))
+
+	def _volumeAt(self, base):
+		(zero, guid, length, sig, attrib, headerlength, checksum, reserved, revision) = struct.unpack_from(FV_HEADER_FORMAT, self.stream.Data, base)
+		volume = EfiFirmwareVolume(base, headerlength, length - headerlength, sig, attrib, self.stream)
+		volume.Parent = self
+		return volume
+
+	def reload(self, data):
+		"""Switches the image to data, the repacked image. Only the dirty volumes are
+		parsed again, the others are kept with everything parsed and decompressed
+		below them (and keep referencing the previous data)."""
+		self.stream = BufferStream(data)
+		self.length = len(data)
+		if self._firmwareVolumes is not None:
+			self._firmwareVolumes = [self._volumeAt(v.Base) if v.Dirty else v for v in self._firmwareVolumes]
+		self.Dirty = False
 
 class EfiFirmwareVolume(EfiElement):
+	__slots__ = ("Base", "HeaderLength", "DataLength", "Signature", "Attributes", "stream", "_files", "volumeIndex")
+
 	def __init__(self, base, headerLength, dataLength, signature, attributes, stream):
+		super(EfiFirmwareVolume, self).__init__()
 		self.Base = base
 		self.HeaderLength = headerLength
 		self.DataLength = dataLength
 		self.Signature = signature
 		self.Attributes = attributes
 		self.stream = stream
-		self.files = []
-		self._parse()
-
-	def _parse(self):
-		streamPos = self.stream.tell()
-
-		self.stream.seek(self.Base + self.HeaderLength, os.SEEK_SET)
+		self._files = None
+		#Set by FDFGenerator
+		self.volumeIndex = None
+
+	@property
+	def IsExpanded(self):
+		return self._files is not None
+
+	@property
+	def FileSystemGuid(self):
+		"""The file system GUID of the volume header, FFS1 or FFS2 for the volumes found"""
+		return uuid.UUID(bytes_le=str(self.stream.Data[self.Base+16:self.Base+32]))
+
+	@property
+	def ErasePolarity(self):
+		"""The value of erased bytes, 0xFF unless EFI_FVB2_ERASE_POLARITY is cleared"""
+		return 0xFF if self.Attributes & FVB2_ERASE_POLARITY else 0x00
+
+	@property
+	def files(self):
+		if self._files is None:
+			self._files = [f for (base, f) in self.iterChildren()]
+		return self._files
+
+	def iterChildren(self):
+		data = self.stream.Data
+		start = self.Base + self.HeaderLength
 		base = 0
 		while base < self.DataLength:
 			#Align to 8 byte
-			if self.stream.tell() % 8:
-				tmp = 8 - (self.stream.tell() % 8)
-				self.stream.seek(tmp, os.SEEK_CUR)
-				base += tmp
+			if (start + base) % 8:
+				base += 8 - ((start + base) % 8)
 
 			if base >= self.DataLength:
 				break
 
-			logger.debug("Parsing firmware file at 0x%X", self.stream.tell())
-			(guid, checksum, type, attrib, length, state) = struct.unpack("<16sHBB3sB", self.stream.read(16 + 2 + 1 + 1 + 3 + 1))
-			guid = uuid.UUID(bytes_le=guid)
+			logger.debug("Parsing firmware file at 0x%X", start + base)
+			(guid, checksum, type, attrib, length, state) = struct.unpack_from("<16sHBB3sB", data, start + base)
 			length = struct.unpack("<I", length + '\0')[0]
-			self.stream.seek(self.Base + self.HeaderLength + base + 24)
-			filedata = self.stream.read(length - 24)
+			if length < 24:
+				raise ValueError("File at offset 0x%X is shorter than its header (%u bytes)" % (start + base, length))
 			if type != 0xFF:
-				self.files.append(EfiFile(base, length - 24, guid, type, attrib, state, filedata))
+				filedata = BufferView(data, start + base + 24, length - 24)
+				f = EfiFile(base, length - 24, guid, type, attrib, state, filedata, checksum)
+				f.Parent = self
+				if Stats.STATS is not None:
+					Stats.STATS.count("File types", f._strfiletype())
+				yield (base, f)
 
 			base += length
 
-		self.stream.seek(streamPos, os.SEEK_SET)
-
 	def __str__(self):
 		result = "EFI_FIRMWARE_VOLUME:\n"
 		result += "\tBase Offset: 0x%08x\n" % self.Base
@@ -127,68 +401,75 @@ class EfiFile(EfiElement):
 		EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE	= 0x0b
 		EFI_FV_FILETYPE_FFS_PAD					= 0xf0
 
-	def __init__(self, base, length, guid, type, attributes, state, filedata):
+	#Names of the file types for printing, others are UNKNOWN
+	TYPE_NAMES = {
+		EFI_FILETYPES.EFI_FV_FILETYPE_RAW:						"RAW",
+		EFI_FILETYPES.EFI_FV_FILETYPE_FREEFORM:					"FREEFORM",
+		EFI_FILETYPES.EFI_FV_FILETYPE_SECURITY_CORE:			"SECURITY_CORE",
+		EFI_FILETYPES.EFI_FV_FILETYPE_PEI_CORE:					"PEI_CORE",
+		EFI_FILETYPES.EFI_FV_FILETYPE_DXE_CORE:					"DXE_CORE",
+		EFI_FILETYPES.EFI_FV_FILETYPE_PEIM:						"PEIM",
+		EFI_FILETYPES.EFI_FV_FILETYPE_DRIVER:					"DRIVER",
+		EFI_FILETYPES.EFI_FV_FILETYPE_COMBINED_PEIM_DRIVER:		"COMBINED_PEIM_DRIVER",
+		EFI_FILETYPES.EFI_FV_FILETYPE_APPLICATION:				"APPLICATION",
+		EFI_FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE:	"FIRMWARE_VOLUME_IMAGE",
+		EFI_FILETYPES.EFI_FV_FILETYPE_FFS_PAD:					"PAD",
+	}
+
+	#File types whose data is a list of sections
+	SECTIONED_TYPES = frozenset([
+		EFI_FILETYPES.EFI_FV_FILETYPE_FREEFORM,
+		EFI_FILETYPES.EFI_FV_FILETYPE_SECURITY_CORE,
+		EFI_FILETYPES.EFI_FV_FILETYPE_PEI_CORE,
+		EFI_FILETYPES.EFI_FV_FILETYPE_DXE_CORE,
+		EFI_FILETYPES.EFI_FV_FILETYPE_PEIM,
+		EFI_FILETYPES.EFI_FV_FILETYPE_DRIVER,
+		EFI_FILETYPES.EFI_FV_FILETYPE_COMBINED_PEIM_DRIVER,
+		EFI_FILETYPES.EFI_FV_FILETYPE_APPLICATION,
+		EFI_FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE,
+	])
+
+	__slots__ = ("Base", "Length", "_guid", "Type", "Attributes", "State", "Data", "Checksum", "_subsections")
+
+	def __init__(self, base, length, guid, type, attributes, state, filedata, checksum=None):
+		super(EfiFile, self).__init__()
 		self.Base = base
 		self.Length = length
-		self.Guid = guid
+		#The GUID as stored in the header, guid may be a uuid.UUID as well
+		self._guid = guid.bytes_le if isinstance(guid, uuid.UUID) else guid
 		self.Type = type
 		self.Attributes = attributes
 		self.State = state
 		self.Data = filedata
-		self.subsections = []
-		self._parse()
-
-	def _parse(self):
-		if (self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_FREEFORM or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_PEI_CORE or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_DXE_CORE or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_PEIM or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_DRIVER or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_COMBINED_PEIM_DRIVER or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_APPLICATION or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_SECURITY_CORE or
-		self.Type == EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE):
-			base = 0
-			while base < len(self.Data):
-				if base % 4:
-					base += 4 - (base % 4)
-
-				if base >= len(self.Data):
-					break
-
-				logger.debug("Parsing firmware file section at file-relative-offset 0x%X", base)
-				(length, efitype) = struct.unpack("<3sB", self.Data[base:base+4])
-				length = struct.unpack("<I", length + '\0')[0]
-
-				sectionData = self.Data[base:base+length]
-				self.subsections.append(InstantiateSectionFromType(efitype, sectionData))
-
-				base += length
+		#IntegrityCheck of the header, the header checksum in the low byte, the data checksum in the high byte
+		self.Checksum = checksum
+		self._subsections = None
+
+	@property
+	def Guid(self):
+		return uuid.UUID(bytes_le=self._guid)
+
+	@property
+	def IsExpanded(self):
+		return self._subsections is not None
+
+	@property
+	def HasSections(self):
+		return self.Type in self.SECTIONED_TYPES
+
+	@property
+	def subsections(self):
+		if self._subsections is None:
+			self._subsections = [s for (base, s) in self.iterChildren()]
+		return self._subsections
+
+	def iterChildren(self):
+		if self.HasSections:
+			return _adopt(self, IterSections(self.Data))
+		return iter(())
 
 	def _strfiletype(self):
-		if self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_RAW:
-			return "RAW"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_FREEFORM:
-			return "FREEFORM"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_SECURITY_CORE:
-			return "SECURITY_CORE"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_PEI_CORE:
-			return "PEI_CORE"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_DXE_CORE:
-			return "DXE_CORE"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_PEIM:
-			return "PEIM"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_DRIVER:
-			return "DRIVER"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_COMBINED_PEIM_DRIVER:
-			return "COMBINED_PEIM_DRIVER"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_APPLICATION:
-			return "APPLICATION"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE:
-			return "FIRMWARE_VOLUME_IMAGE"
-		elif self.Type == self.EFI_FILETYPES.EFI_FV_FILETYPE_FFS_PAD:
-			return "PAD"
-		return "UNKNOWN"
+		return self.TYPE_NAMES.get(self.Type, "UNKNOWN")
 
 	def __str__(self):
 		result = "EFI_FIRMWARE_FILE:\n"
@@ -200,21 +481,90 @@ class EfiFile(EfiElement):
 		result += "\tState: 0x%x\n" % self.State
 		return result
 
+def IterSections(data):
+	"""Yields (offset, section) for the 4 byte aligned sections in data"""
+	base = 0
+	while base < len(data):
+		if base % 4:
+			base += 4 - (base % 4)
+
+		if base >= len(data):
+			break
+
+		logger.debug("Parsing section at offset 0x%X", base)
+		(length, efitype) = struct.unpack("<3sB", data[base:base+4])
+		length = struct.unpack("<I", length + '\0')[0]
+		if length < 4:
+			raise ValueError("Section at offset 0x%X is shorter than its header (%u bytes)" % (base, length))
+
+		sectionData = BufferView(data, base, length)
+		section = InstantiateSectionFromType(efitype, sectionData)
+		if Stats.STATS is not None:
+			Stats.STATS.count("Section types", section._strsectiontype())
+		yield (base, section)
+
+		base += length
+
+#Section classes by section type, sections of other types are EfiGenericSection.
+#Filled at the end of this module, see RegisterSectionClass.
+SECTION_CLASSES = {}
+
+#Decoders of GUID defined sections by GUID (as stored, i.e. bytes_le), see RegisterGuidDecoder
+GUID_DECODERS = {}
+
+def RegisterSectionClass(sectionType, cls):
+	"""Makes sections of sectionType instances of cls, an EfiSection subclass taking
+	(sectionType, data)"""
+	SECTION_CLASSES[sectionType] = cls
+
+def RegisterGuidDecoder(guid, decoder):
+	"""Decodes GUID defined sections with the uuid.UUID guid with the Decoder decoder,
+	replacing the one registered before. Sections parsed before are not affected
+	once they have been decoded."""
+	GUID_DECODERS[guid.bytes_le] = decoder
+
 def InstantiateSectionFromType(type, data):
-	if type == EfiSection.EFI_SECTIONTYPES.EFI_SECTION_COMPRESSION:
-		return EfiCompressedSection(type, data)
-	if type == EfiSection.EFI_SECTIONTYPES.EFI_SECTION_GUID_DEFINED:
-		return EfiGuidDefinedSection(type, data)
-	elif type == EfiSection.EFI_SECTIONTYPES.EFI_SECTION_VERSION:
-		return EfiVersionSection(type, data)
-	elif type == EfiSection.EFI_SECTIONTYPES.EFI_SECTION_USER_INTERFACE:
-		return EfiUserInterfaceSection(type, data)
-	elif type == EfiSection.EFI_SECTIONTYPES.EFI_SECTION_FREEFORM_SUBTYPE_GUID:
-		return EfiFreeformSubtypeGuidSection(type, data)
-	elif type == EfiSection.EFI_SECTIONTYPES.EFI_SECTION_FIRMWARE_VOLUME_IMAGE:
-		return EfiFirmwareVolumeSection(type, data)
-	else:
-		return EfiGenericSection(type, data)
+	return SECTION_CLASSES.get(type, EfiGenericSection)(type, data)
+
+def FindHandler(handlers, prefix, node):
+	"""Returns the method prefix_<class> of handlers for the class of node or the
+	closest of its base classes, so classes registered with RegisterSectionClass
+	are handled like the class they derive from. None if there is none."""
+	for cls in type(node).__mro__:
+		handler = getattr(handlers, prefix + "_" + cls.__name__, None)
+		if handler is not None:
+			return handler
+	return None
+
+class EfiNodeVisitor(ast.NodeVisitor):
+	"""ast.NodeVisitor for the parsed tree, visit_<class> handles a node of that class
+	and of subclasses without a visit method of their own (see FindHandler)"""
+	def visit(self, node):
+		handler = FindHandler(self, "visit", node)
+		if handler is None:
+			return self.generic_visit(node)
+		return handler(node)
+
+class Decoder(object):
+	"""Decodes the content of encapsulation sections and encodes it again.
+
+	decode(payload) returns the content, encode(content) returns the payload or is
+	None if the encoding cannot be reproduced, Repacker refuses to encode modified
+	sections again then. name is the algorithm for the decompression cache and --stats.
+	ParallelDecompressor runs decoders with workerSafe set in worker processes, so
+	their decode has to be picklable (e.g. a module level function) and must not
+	depend on state of this process. Others always run in-process."""
+	def __init__(self, name, decode, encode=None, workerSafe=True):
+		self.Name = name
+		self.Decode = decode
+		self.Encode = encode
+		self.WorkerSafe = workerSafe
+
+	def __repr__(self):
+		return "Decoder(%r)" % self.Name
+
+TIANO_DECODER = Decoder("tiano", EfiDecompressor.Decompress, EfiCompressor.Compress)
+LZMA_DECODER = Decoder("lzma", LzmaDecompressor.Decompress, LzmaCompressor.Compress)
 
 class EfiSection(EfiElement):
 	class EFI_SECTIONTYPES:
@@ -232,58 +582,41 @@ class EfiSection(EfiElement):
 		EFI_SECTION_RAW							= 0x19
 		EFI_SECTION_PEI_DEPEX					= 0x1b
 
+	#Names of the section types for printing, others are UNKNOWN
+	TYPE_NAMES = {
+		EFI_SECTIONTYPES.EFI_SECTION_COMPRESSION:				"COMPRESSION",
+		EFI_SECTIONTYPES.EFI_SECTION_GUID_DEFINED:				"GUID_DEFINED",
+		EFI_SECTIONTYPES.EFI_SECTION_PE32:						"PE32",
+		EFI_SECTIONTYPES.EFI_SECTION_PIC:						"PIC",
+		EFI_SECTIONTYPES.EFI_SECTION_TE:						"TE",
+		EFI_SECTIONTYPES.EFI_SECTION_DXE_DEPEX:					"DXE_DEPEX",
+		EFI_SECTIONTYPES.EFI_SECTION_VERSION:					"VERSION",
+		EFI_SECTIONTYPES.EFI_SECTION_USER_INTERFACE:			"USER_INTERFACE",
+		EFI_SECTIONTYPES.EFI_SECTION_COMPATABILITY16:			"COMPATABILITY16",
+		EFI_SECTIONTYPES.EFI_SECTION_FIRMWARE_VOLUME_IMAGE:		"FIRMWARE_VOLUME_IMAGE",
+		EFI_SECTIONTYPES.EFI_SECTION_FREEFORM_SUBTYPE_GUID:		"FREEFORM_SUBTYPE_GUID",
+		EFI_SECTIONTYPES.EFI_SECTION_RAW:						"RAW",
+		EFI_SECTIONTYPES.EFI_SECTION_PEI_DEPEX:					"PEI_DEPEX",
+	}
+
+	__slots__ = ("SectionType", "Data")
+
 	def __init__(self, sectionType, data):
+		super(EfiSection, self).__init__()
 		self.SectionType = sectionType
 		self.Data = data
-		self.RawContent = data[4:]
-		self.Subsections = []
 
-	def _parseSubsections(self, data):
-		base = 0
-		while base < len(data):
-			if base % 4:
-				base += 4 - (base % 4)
-
-			if base >= len(data):
-				break
+	@property
+	def RawContent(self):
+		"""The content of the section after the common header"""
+		return BufferView(self.Data, 4)
 
-			logger.debug("Parsing subsection section at section-relative-offset 0x%X", base)
-			(length, efitype) = struct.unpack("<3sB", data[base:base+4])
-			length = struct.unpack("<I", length + '\0')[0]
-
-			sectionData = data[base:base+length]
-			self.Subsections.append(InstantiateSectionFromType(efitype, sectionData))
-
-			base += length
+	@property
+	def Subsections(self):
+		return []
 
 	def _strsectiontype(self):
-		if self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_COMPRESSION:
-			return "COMPRESSION"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_GUID_DEFINED:
-			return "GUID_DEFINED"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_PE32:
-			return "PE32"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_PIC:
-			return "PIC"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_TE:
-			return "TE"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_DXE_DEPEX:
-			return "DXE_DEPEX"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_VERSION:
-			return "VERSION"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_USER_INTERFACE:
-			return "USER_INTERFACE"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_COMPATABILITY16:
-			return "COMPATABILITY16"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_FIRMWARE_VOLUME_IMAGE:
-			return "FIRMWARE_VOLUME_IMAGE"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_FREEFORM_SUBTYPE_GUID:
-			return "FREEFORM_SUBTYPE_GUID"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_RAW:
-			return "RAW"
-		elif self.SectionType == self.EFI_SECTIONTYPES.EFI_SECTION_PEI_DEPEX:
-			return "PEI_DEPEX"
-		return "UNKNOWN"
+		return self.TYPE_NAMES.get(self.SectionType, "UNKNOWN")
 
 	def __str__(self):
 		result = "EFI_FIRMWARE_SECTION:\n"
@@ -292,28 +625,124 @@ class EfiSection(EfiElement):
 		return result
 
 class EfiGenericSection(EfiSection):
+	__slots__ = ()
+
 	def __init__(self, sectionType, data):
 		super(EfiGenericSection, self).__init__(sectionType, data)
 		#self._parseSubsections(self.RawContent)
 
-class EfiCompressedSection(EfiSection):
-	def __init__(self, sectionType, data):
-		super(EfiCompressedSection, self).__init__(sectionType, data)
-		(self.UncompressedDataLength, self.CompressionType) = struct.unpack("<IB", self.Data[4:4+4+1])
-		uncomp_data = self.Data[4+4+1:]
+class EfiEncapsulationSection(EfiSection):
+	"""A section whose content has to be decoded before its subsections can be parsed.
+	Only the header is parsed up front, decoding happens on the first access of
+	UncompressedData or Subsections. Subclasses implement Payload and _decode."""
+	__metaclass__ = abc.ABCMeta
+	__slots__ = ("_uncompressedData", "_subsections")
 
+	def __init__(self, sectionType, data):
+		super(EfiEncapsulationSection, self).__init__(sectionType, data)
+		self._uncompressedData = None
+		self._subsections = None
+
+	@abc.abstractmethod
+	def _decode(self):
+		"""Returns the decoded content of the section"""
+
+	@property
+	def Decoder(self):
+		"""The Decoder of the payload, None if it is stored as is or unknown"""
+		return None
+
+	@abc.abstractproperty
+	def Payload(self):
+		"""The encoded content after the headers"""
+
+	def pendingDecompression(self):
+		"""Returns (algorithm, decompressor, payload) while decoding the content still
+		needs a decompressor, None otherwise"""
+		decoder = self.Decoder
+		if self.IsDecoded or decoder is None:
+			return None
+		return (decoder.Name, decoder.Decode, self.Payload)
+
+	@property
+	def IsExpanded(self):
+		return self._subsections is not None
+
+	def setUncompressedData(self, data):
+		"""Stores content which was decompressed elsewhere, e.g. by ParallelDecompressor"""
+		self._uncompressedData = data
+
+	@property
+	def IsDecoded(self):
+		return self._uncompressedData is not None
+
+	@property
+	def UncompressedData(self):
+		if self._uncompressedData is None:
+			if Stats.STATS is None:
+				self._uncompressedData = self._decode()
+			else:
+				self._uncompressedData = self._decodeMeasured()
+		return self._uncompressedData
+
+	def statsKey(self):
+		"""Name the decompression time of the section is accounted to"""
+		return self._strsectiontype()
+
+	def _decodeMeasured(self):
+		decompression = self.pendingDecompression()
+		start = time.time()
+		data = self._decode()
+		seconds = time.time() - start
+		if decompression is not None:
+			(algorithm, decompressor, payload) = decompression
+			Stats.STATS.addTime("decompress." + algorithm, seconds)
+			Stats.STATS.add("decompress.%s.in" % algorithm, len(payload))
+			Stats.STATS.add("decompress.%s.out" % algorithm, len(data))
+			Stats.STATS.count("Decompression time by GUID", self.statsKey(), seconds)
+		return data
+
+	@property
+	def Subsections(self):
+		if self._subsections is None:
+			self._subsections = [s for (base, s) in self.iterChildren()]
+		return self._subsections
+
+	def iterChildren(self):
+		return _adopt(self, IterSections(self.UncompressedData))
+
+class EfiCompressedSection(EfiEncapsulationSection):
+	__slots__ = ()
+
+	@property
+	def UncompressedDataLength(self):
+		return struct.unpack_from("<I", self.Data, 4)[0]
+
+	@property
+	def CompressionType(self):
+		return struct.unpack_from("<B", self.Data, 8)[0]
+
+	@property
+	def Decoder(self):
+		#FIXME: The EfiDecompressor handles TianoCompression, what about EfiCompression?
+		#The used compression algo is either PI_NONE or PI_STD in an FDF file
+		#To use TianoCompression, edit the CompressFunction pointer in GenSec.c in the EDK2
+		if self.CompressionType == 1:
+			return TIANO_DECODER
+		return None
+
+	@property
+	def Payload(self):
+		return BufferView(self.Data, 4+4+1)
+
+	def _decode(self):
 		if self.CompressionType == 0:
-			self.UncompressedData = uncomp_data
+			return self.Payload
 		elif self.CompressionType == 1:
-			#FIXME: The EfiDecompressor handles TianoCompression, what about EfiCompression?
-			#The used compression algo is either PI_NONE or PI_STD in an FDF file
-			#To use TianoCompression, edit the CompressFunction pointer in GenSec.c in the EDK2
-			self.UncompressedData = EfiDecompressor.Decompress(uncomp_data)
+			return CachedDecompress(*self.pendingDecompression())
 		else:
 			logger.warning("Found unsupported CompressionType %u", self.CompressionType)
-			self.UncompressedData = ""
-
-		self._parseSubsections(self.UncompressedData)
+			return ""
 
 	def __str__(self):
 		result = super(EfiCompressedSection, self).__str__()
@@ -322,19 +751,37 @@ class EfiCompressedSection(EfiSection):
 		return result
 
 class EfiFirmwareVolumeSection(EfiSection):
+	__slots__ = ("_subFirmware",)
+
 	def __init__(self, sectionType, data):
 		super(EfiFirmwareVolumeSection, self).__init__(sectionType, data)
-		stringStream = StringIO.StringIO(self.RawContent)
-		stringStream.seek(0, os.SEEK_END)
-		streamLen = stringStream.tell()
-		stringStream.seek(0, os.SEEK_SET)
-		self.SubFirmware = EfiFirmwareImage(stringStream, streamLen)
+		self._subFirmware = None
+
+	@property
+	def IsExpanded(self):
+		return self._subFirmware is not None
+
+	@property
+	def SubFirmware(self):
+		if self._subFirmware is None:
+			content = self.RawContent
+			self._subFirmware = EfiFirmwareImage(BufferStream(content), len(content))
+			self._subFirmware.Parent = self
+		return self._subFirmware
+
+	def iterChildren(self):
+		return self.SubFirmware.iterChildren()
 
 class EfiVersionSection(EfiSection):
-	def __init__(self, sectionType, data):
-		super(EfiVersionSection, self).__init__(sectionType, data)
-		#(self.BuildNumber,) = struct.unpack("<H", self.Data[4:6])
-		self.VersionString = unicode(self.Data[4:len(self.Data)-2], "utf-16")
+	__slots__ = ()
+
+	#@property
+	#def BuildNumber(self):
+	#	return struct.unpack_from("<H", self.Data, 4)[0]
+
+	@property
+	def VersionString(self):
+		return unicode(str(self.Data[4:len(self.Data)-2]), "utf-16")
 
 	def __str__(self):
 		result = super(EfiVersionSection, self).__str__()
@@ -343,9 +790,11 @@ class EfiVersionSection(EfiSection):
 		return result
 
 class EfiUserInterfaceSection(EfiSection):
-	def __init__(self, sectionType, data):
-		super(EfiUserInterfaceSection, self).__init__(sectionType, data)
-		self.String = unicode(self.Data[4:len(data)-2], "utf-16")
+	__slots__ = ()
+
+	@property
+	def String(self):
+		return unicode(str(self.Data[4:len(self.Data)-2]), "utf-16")
 
 	def __str__(self):
 		result = super(EfiUserInterfaceSection, self).__str__()
@@ -353,12 +802,19 @@ class EfiUserInterfaceSection(EfiSection):
 		return result
 
 class EfiFreeformSubtypeGuidSection(EfiSection):
-	def __init__(self, sectionType, data):
-		super(EfiFreeformSubtypeGuidSection, self).__init__(sectionType, data)
-		(self.Guid,) = struct.unpack("<16s", self.Data[4:4+16])
-		self.Guid = uuid.UUID(bytes_le=self.Guid)
-		self.ContentData = self.Data
-		self.DataLength = len(self.ContentData)
+	__slots__ = ()
+
+	@property
+	def Guid(self):
+		return uuid.UUID(bytes_le=str(self.Data[4:4+16]))
+
+	@property
+	def ContentData(self):
+		return self.Data
+
+	@property
+	def DataLength(self):
+		return len(self.Data)
 
 	def __str__(self):
 		result = super(EfiFreeformSubtypeGuidSection, self).__str__()
@@ -366,36 +822,49 @@ class EfiFreeformSubtypeGuidSection(EfiSection):
 		result += "\tDataLength (including full header): 0x%08x\n" % self.DataLength
 		return result
 
-class EfiGuidDefinedSection(EfiSection):
-	def __init__(self, sectionType, data):
-		super(EfiGuidDefinedSection, self).__init__(sectionType, data)
-		(self.Guid, self.DataOffset, self.Attributes) = struct.unpack("<16sHH", self.Data[4:4+16+2+2])
-		self.Guid = uuid.UUID(bytes_le=self.Guid)
-		self.ContentData = data[24:]
-		self.DataLength = len(self.ContentData)
+class EfiGuidDefinedSection(EfiEncapsulationSection):
+	__slots__ = ()
+
+	@property
+	def Guid(self):
+		return uuid.UUID(bytes_le=str(self.Data[4:4+16]))
+
+	@property
+	def Decoder(self):
+		#Data may be a bytearray, whose slices cannot be looked up
+		return GUID_DECODERS.get(str(self.Data[4:4+16]))
 
-		if self.Guid == EFIGUIDS.FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED:
-			logger.debug("Decompressing EFI GUID defined section containing LZMA")
-			#FIXME: use pylzma...
-			tmpfileIn = open("extractIn", "w+b")
-			tmpfileIn.write(self.ContentData)
-			tmpfileIn.close()
+	@property
+	def DataOffset(self):
+		return struct.unpack_from("<H", self.Data, 4+16)[0]
 
-			#tmpfileOut = open("extractOut", "w+b")
-			#tmpfileOut.close()
+	@property
+	def Attributes(self):
+		return struct.unpack_from("<H", self.Data, 4+16+2)[0]
 
-			fnull = open(os.devnull, 'w')
-			subprocess.check_call(["<path to edk2>/edk2/BaseTools/BinWrappers/PosixLike/LzmaCompress", "-d", "extractIn", "-o", "extractOut"], stdout = fnull, stderr = fnull)
-			fnull.close()
+	@property
+	def ContentData(self):
+		return BufferView(self.Data, 24)
 
-			tmpfileOut = open("extractOut", "rb")
-			self.UncompressedData = tmpfileOut.read()
-			tmpfileOut.close()
+	@property
+	def DataLength(self):
+		return len(self.ContentData)
 
-			os.unlink("extractIn")
-			os.unlink("extractOut")
+	@property
+	def Payload(self):
+		return BufferView(self.Data, max(self.DataOffset, 4+16+2+2))
 
-			self._parseSubsections(self.UncompressedData)
+	def statsKey(self):
+		return str(self.Guid)
+
+	def _decode(self):
+		decompression = self.pendingDecompression()
+		if decompression is None:
+			#Unknown encoding, there are no subsections to parse
+			return ""
+
+		logger.debug("Decoding EFI GUID defined section containing %s", decompression[0])
+		return CachedDecompress(*decompression)
 
 	def __str__(self):
 		result = super(EfiGuidDefinedSection, self).__str__()
@@ -404,3 +873,12 @@ class EfiGuidDefinedSection(EfiSection):
 		result += "\tDataOffset: 0x%04x\n" % self.DataOffset
 		result += "\tAttributes: 0x%04x\n" % self.Attributes
 		return result
+
+RegisterSectionClass(EfiSection.EFI_SECTIONTYPES.EFI_SECTION_COMPRESSION, EfiCompressedSection)
+RegisterSectionClass(EfiSection.EFI_SECTIONTYPES.EFI_SECTION_GUID_DEFINED, EfiGuidDefinedSection)
+RegisterSectionClass(EfiSection.EFI_SECTIONTYPES.EFI_SECTION_VERSION, EfiVersionSection)
+RegisterSectionClass(EfiSection.EFI_SECTIONTYPES.EFI_SECTION_USER_INTERFACE, EfiUserInterfaceSection)
+RegisterSectionClass(EfiSection.EFI_SECTIONTYPES.EFI_SECTION_FREEFORM_SUBTYPE_GUID, EfiFreeformSubtypeGuidSection)
+RegisterSectionClass(EfiSection.EFI_SECTIONTYPES.EFI_SECTION_FIRMWARE_VOLUME_IMAGE, EfiFirmwareVolumeSection)
+
+RegisterGuidDecoder(EFIGUIDS.FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED, LZMA_DECODER)
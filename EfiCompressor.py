@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import struct
+import heapq
+
+MAXMATCH = 256
+THRESHOLD = 3
+NC = 256 + MAXMATCH - THRESHOLD + 1
+NT = 19
+NP = 19
+WINDOWBITS = 16
+MAXCODELEN = 16
+MAXBLOCKSIZE = 0x4000
+
+
+class BitWriter(object):
+	def __init__(self):
+		self._Bytes = bytearray()
+		self._Acc = 0
+		self._Count = 0
+
+	def write(self, bitcount, value):
+		self._Acc = (self._Acc << bitcount) | (value & ((1 << bitcount) - 1))
+		self._Count += bitcount
+		while self._Count >= 8:
+			self._Count -= 8
+			self._Bytes.append((self._Acc >> self._Count) & 0xFF)
+		self._Acc &= (1 << self._Count) - 1
+
+	def getvalue(self):
+		if self._Count:
+			self._Bytes.append((self._Acc << (8 - self._Count)) & 0xFF)
+			self._Acc = 0
+			self._Count = 0
+		return str(self._Bytes)
+
+
+def HuffmanLengths(freqs, maxlen):
+	"""Compute code lengths (limited to maxlen) for the symbols with a non-zero frequency"""
+	used = [sym for sym in xrange(len(freqs)) if freqs[sym]]
+	lengths = [0] * len(freqs)
+	if len(used) == 1:
+		lengths[used[0]] = 1
+		return lengths
+
+	scaled = list(freqs)
+	while True:
+		heap = [(scaled[sym], sym, (sym,)) for sym in used]
+		heapq.heapify(heap)
+		depth = dict((sym, 0) for sym in used)
+		uid = len(freqs)
+		while len(heap) > 1:
+			(f1, _, s1) = heapq.heappop(heap)
+			(f2, _, s2) = heapq.heappop(heap)
+			for sym in s1 + s2:
+				depth[sym] += 1
+			heapq.heappush(heap, (f1 + f2, uid, s1 + s2))
+			uid += 1
+		if max(depth.values()) <= maxlen:
+			break
+		scaled = [(f + 1) >> 1 if f else 0 for f in scaled]
+
+	for sym in used:
+		lengths[sym] = depth[sym]
+	return lengths
+
+
+def CanonicalCodes(lengths):
+	"""Assign codes the same way LoadHuffmanSyms does: ordered by length, then by symbol"""
+	syms = sorted([sym for sym in xrange(len(lengths)) if lengths[sym]], key=lambda sym: lengths[sym])
+	codes = [0] * len(lengths)
+	for idx in xrange(1, len(syms)):
+		codes[syms[idx]] = (codes[syms[idx-1]] + 1) << (lengths[syms[idx]] - lengths[syms[idx-1]])
+	return codes
+
+
+def _ensureTwoSymbols(freqs):
+	#A single used symbol would need the zero-length code special case, which
+	#decoders treat differently. Always provide a second symbol instead.
+	used = [sym for sym in xrange(len(freqs)) if freqs[sym]]
+	if len(used) == 0:
+		freqs[0] = 1
+		freqs[1] = 1
+	elif len(used) == 1:
+		freqs[1 if used[0] == 0 else 0] = 1
+
+
+def _findMatches(data):
+	"""Greedy LZ77 parse using hash chains. Yields literals (int) and (length, distance) tuples."""
+	n = len(data)
+	head = {}
+	prev = {}
+	window = 1 << WINDOWBITS
+	pos = 0
+	symbols = []
+	while pos < n:
+		bestlen = 0
+		bestdist = 0
+		if pos + THRESHOLD <= n:
+			key = data[pos:pos+THRESHOLD]
+			candidate = head.get(key)
+			chain = 0
+			while candidate is not None and pos - candidate < window and chain < 32:
+				maxlen = min(MAXMATCH, n - pos)
+				length = THRESHOLD
+				while length < maxlen and data[candidate+length] == data[pos+length]:
+					length += 1
+				if length > bestlen:
+					bestlen = length
+					bestdist = pos - candidate
+					if length == maxlen:
+						break
+				candidate = prev.get(candidate)
+				chain += 1
+
+		if bestlen >= THRESHOLD:
+			symbols.append((bestlen, bestdist))
+			step = bestlen
+		else:
+			symbols.append(ord(data[pos]))
+			step = 1
+
+		for i in xrange(pos, min(pos + step, n - THRESHOLD + 1)):
+			key = data[i:i+THRESHOLD]
+			if key in head:
+				prev[i] = head[key]
+			head[key] = i
+		pos += step
+	return symbols
+
+
+def _positionCode(distance):
+	return (distance - 1).bit_length()
+
+
+def _writeHuffmanSyms(bits, lengths, symscountbits, zeroskipidx):
+	count = len(lengths)
+	while count and lengths[count-1] == 0:
+		count -= 1
+	bits.write(symscountbits, count)
+	idx = 0
+	while idx < count:
+		bitlen = lengths[idx]
+		if bitlen < 7:
+			bits.write(3, bitlen)
+		else:
+			bits.write(3, 7)
+			for i in xrange(bitlen - 7):
+				bits.write(1, 1)
+			bits.write(1, 0)
+		idx += 1
+		if idx == zeroskipidx:
+			skip = 0
+			while skip < 3 and idx + skip < count and lengths[idx + skip] == 0:
+				skip += 1
+			bits.write(2, skip)
+			idx += skip
+
+
+def _charLenRuns(lengths):
+	count = len(lengths)
+	while count and lengths[count-1] == 0:
+		count -= 1
+	runs = []
+	idx = 0
+	while idx < count:
+		if lengths[idx]:
+			runs.append((lengths[idx] + 2, 0, 0))
+			idx += 1
+			continue
+		run = 0
+		while idx + run < count and lengths[idx + run] == 0:
+			run += 1
+		if run >= 20:
+			run = min(run, 20 + 511)
+			runs.append((2, 9, run - 20))
+		elif run >= 3:
+			run = min(run, 18)
+			runs.append((1, 4, run - 3))
+		else:
+			run = 1
+			runs.append((0, 0, 0))
+		idx += run
+	return (count, runs)
+
+
+def _sendBlock(bits, symbols):
+	cfreq = [0] * NC
+	pfreq = [0] * NP
+	for s in symbols:
+		if type(s) == int:
+			cfreq[s] += 1
+		else:
+			cfreq[256 + s[0] - THRESHOLD] += 1
+			pfreq[_positionCode(s[1])] += 1
+	_ensureTwoSymbols(cfreq)
+	_ensureTwoSymbols(pfreq)
+
+	clen = HuffmanLengths(cfreq, MAXCODELEN)
+	ccode = CanonicalCodes(clen)
+	plen = HuffmanLengths(pfreq, MAXCODELEN)
+	pcode = CanonicalCodes(plen)
+
+	(ccount, runs) = _charLenRuns(clen)
+	tfreq = [0] * NT
+	for r in runs:
+		tfreq[r[0]] += 1
+	_ensureTwoSymbols(tfreq)
+	tlen = HuffmanLengths(tfreq, MAXCODELEN)
+	tcode = CanonicalCodes(tlen)
+
+	bits.write(16, len(symbols))
+	_writeHuffmanSyms(bits, tlen, 5, 3)
+	bits.write(9, ccount)
+	for (sym, extrabits, extra) in runs:
+		bits.write(tlen[sym], tcode[sym])
+		if extrabits:
+			bits.write(extrabits, extra)
+	_writeHuffmanSyms(bits, plen, 5, -1)
+
+	for s in symbols:
+		if type(s) == int:
+			bits.write(clen[s], ccode[s])
+		else:
+			c = 256 + s[0] - THRESHOLD
+			bits.write(clen[c], ccode[c])
+			p = _positionCode(s[1])
+			bits.write(plen[p], pcode[p])
+			if p > 1:
+				bits.write(p - 1, (s[1] - 1) - (1 << (p - 1)))
+
+
+def Compress(data):
+	"""Compresses data into the Tiano format understood by EfiDecompressor.Decompress.
+	The parse is greedy and every block gets freshly built codes, the output is
+	valid but larger than what EDK2's TianoCompress produces."""
+	data = str(data)
+	symbols = _findMatches(data)
+	bits = BitWriter()
+	for start in xrange(0, len(symbols), MAXBLOCKSIZE):
+		_sendBlock(bits, symbols[start:start+MAXBLOCKSIZE])
+	compressed = bits.getvalue()
+	return struct.pack("<II", len(compressed), len(data)) + compressed
@@ -2,6 +2,7 @@
 import struct
 import os
 import sys
+import Stats
 import BitArray
 
 
@@ -28,6 +29,9 @@ def LoadHuffmanSyms(bits, symscountbits, zeroskipidx):
 			if idx == zeroskipidx:
 				idx += bits.read(2)
 		
+		if not huffsyms:
+			raise ValueError("No huffman code has a length")
+
 		# Now, sort them by bit length
 		huffsyms = sorted(huffsyms, key=lambda length: length[1])
 
@@ -40,8 +44,22 @@ def LoadHuffmanSyms(bits, symscountbits, zeroskipidx):
 
 
 
-def BuildHuffmanTree(huffsyms):
-	hufftree = [None, None]
+# EDK2 never emits codes longer than 16 bits, which also bounds the table size
+MAXCODELEN = 16
+
+# Table entry of bit patterns no code starts with, corrupt data may contain them
+INVALID_CODE = 0
+
+def MakeTable(huffsyms):
+	"""Builds a flat lookup table for the canonical codes in huffsyms like MakeTable
+	in the EDK2 decompressor. Peeking tablebits bits and indexing the table resolves
+	a symbol in one step, each entry holds (symbol << 5) | bitlen. Patterns not
+	covered by any code hold INVALID_CODE."""
+	tablebits = max(huffsym[1] for huffsym in huffsyms)
+	if tablebits > MAXCODELEN:
+		raise ValueError("Huffman code length %u exceeds %u bits" % (tablebits, MAXCODELEN))
+
+	table = [INVALID_CODE] * (1 << tablebits)
 	for huffsym in huffsyms:
 		symbol = huffsym[0]
 		bitlen = huffsym[1]
@@ -49,28 +67,26 @@ def BuildHuffmanTree(huffsyms):
 		if bitlen == 0:
 			continue
 
-		huffsubtree = hufftree
-		for bit in xrange(0, bitlen):
-			lr = huffcode & (1 << (bitlen - bit - 1)) != 0
-
-			if bit < bitlen - 1:
-				if huffsubtree[lr] == None:
-					huffsubtree[lr] = [None, None]
-				huffsubtree = huffsubtree[lr]
-			else:
-				huffsubtree[lr] = symbol
-	return hufftree
+		span = 1 << (tablebits - bitlen)
+		start = huffcode << (tablebits - bitlen)
+		if start + span > len(table):
+			raise ValueError("Invalid huffman code 0x%x for symbol %u" % (huffcode, symbol))
+		table[start:start+span] = [(symbol << 5) | bitlen] * span
+	return (tablebits, table)
 
 
 
-def HuffmanDecode(hufftree, bits):
-	while type(hufftree) == list:
-		hufftree = hufftree[bits.read(1)]
-	return hufftree
+def HuffmanDecode(table, bits):
+	(tablebits, entries) = table
+	entry = entries[bits.peek(tablebits)]
+	if entry == INVALID_CODE:
+		raise ValueError("Invalid huffman code")
+	bits.skip(entry & 0x1F)
+	return entry >> 5
 
 
 
-def LoadCharLenHuffmanSyms(bits, extra_hufftree):
+def LoadCharLenHuffmanSyms(bits, extra_table):
 	huffsyms = None
 	symscount = bits.read(9)
 
@@ -82,7 +98,7 @@ def LoadCharLenHuffmanSyms(bits, extra_hufftree):
 		huffsyms = []
 		idx = 0
 		while idx < symscount:
-			bitlen = HuffmanDecode(extra_hufftree, bits)
+			bitlen = HuffmanDecode(extra_table, bits)
 			
 			if bitlen == 0:
 				bitlen = 0
@@ -100,6 +116,9 @@ def LoadCharLenHuffmanSyms(bits, extra_hufftree):
 				
 			idx += 1
 
+		if not huffsyms:
+			raise ValueError("No huffman code has a length")
+
 		# Now, sort them by bit length
 		huffsyms = sorted(huffsyms, key=lambda length: length[1])
 
@@ -111,38 +130,76 @@ def LoadCharLenHuffmanSyms(bits, extra_hufftree):
 	return huffsyms
 
 
+# A single symbol takes at least one bit and produces at most MAXMATCH bytes. A
+# match is (symbol & 0xFF) + 3 bytes long, which the 9 bit char/length symbols
+# allow up to 258 bytes. The EDK2 compressor only emits matches of up to 256 bytes.
+MAXMATCH = 258
+
 def Decompress(buf):
+	if len(buf) < 8:
+		raise ValueError("Compressed data of %u bytes is shorter than its header" % len(buf))
 	(compressed_size, decompressed_size) =  struct.unpack("<II", buf[0:8])
-	bits = BitArray.BitArray(buf[8:])
-
-	outbuf = ''
+	if compressed_size > len(buf) - 8:
+		raise ValueError("Declared compressed size of %u bytes exceeds the %u bytes of data" % (compressed_size, len(buf) - 8))
+	if decompressed_size > compressed_size * 8 * MAXMATCH:
+		raise ValueError("Declared size of %u bytes is impossible for %u bytes of compressed data" % (decompressed_size, compressed_size))
+	#Like EDK2, bits past the compressed data read as zero
+	bits = BitArray.BitReader(buffer(buf, 8, compressed_size))
+
+	#The declared size may still be far more than the data decompresses to, the
+	#output grows as it is produced instead of being allocated up front
+	outbuf = bytearray()
+	outpos = 0
 	blocksize = 0
-	charlen_hufftree = None
-	positionset_hufftree = None
-	while decompressed_size:
+	charlen_bits = charlen_table = None
+	position_bits = position_table = None
+	while outpos < decompressed_size:
 		if blocksize == 0:		
+			#Past the end the bits read as zero and would start empty blocks forever
+			if bits.tell() >= compressed_size * 8:
+				raise ValueError("Compressed data ends before %u bytes were decompressed" % decompressed_size)
 			blocksize = bits.read(16)		
-			extra_hufftree = BuildHuffmanTree(LoadHuffmanSyms(bits, 5, 3))
-			charlen_hufftree = BuildHuffmanTree(LoadCharLenHuffmanSyms(bits, extra_hufftree))
-
-	#		positionset_hufftree = BuildHuffmanTree(LoadHuffmanSyms(bits, 4, -1))
-			positionset_hufftree = BuildHuffmanTree(LoadHuffmanSyms(bits, 5, -1))
-
-		c = HuffmanDecode(charlen_hufftree, bits)
+			if blocksize == 0:
+				raise ValueError("Empty block")
+			Stats.add("tiano.blocks")
+			extra_table = MakeTable(LoadHuffmanSyms(bits, 5, 3))
+			(charlen_bits, charlen_table) = MakeTable(LoadCharLenHuffmanSyms(bits, extra_table))
+
+	#		(position_bits, position_table) = MakeTable(LoadHuffmanSyms(bits, 4, -1))
+			(position_bits, position_table) = MakeTable(LoadHuffmanSyms(bits, 5, -1))
+
+		entry = charlen_table[bits.peek(charlen_bits)]
+		if entry == INVALID_CODE:
+			raise ValueError("Invalid huffman code")
+		bits.skip(entry & 0x1F)
+		c = entry >> 5
 		blocksize -= 1
 		if c < 256:
-			outbuf += chr(c)
-			decompressed_size -= 1
+			outbuf.append(c)
+			outpos += 1
 		else:
 			data_length = (c & 0xff) + 3
-			pos_bitlen = HuffmanDecode(positionset_hufftree, bits)
+			entry = position_table[bits.peek(position_bits)]
+			if entry == INVALID_CODE:
+				raise ValueError("Invalid huffman code")
+			bits.skip(entry & 0x1F)
+			pos_bitlen = entry >> 5
 			data_offset = pos_bitlen
 			if pos_bitlen > 1:
 				data_offset = (1 << (pos_bitlen - 1)) + bits.read(pos_bitlen - 1)
-			data_idx = len(outbuf) - data_offset -1
+			data_idx = outpos - data_offset -1
+
+			if data_idx < 0:
+				raise ValueError("Back reference to offset %d before the start of the output" % data_idx)
+			if outpos + data_length > decompressed_size:
+				raise ValueError("Decompressed data exceeds the declared size of %u bytes" % decompressed_size)
 
-			for i in xrange(0, data_length):
-				outbuf += outbuf[data_idx+i]
-			decompressed_size -= data_length
+			if data_offset + 1 >= data_length:
+				outbuf += outbuf[data_idx:data_idx+data_length]
+			else:
+				#The match overlaps the output, it repeats the last data_offset + 1 bytes
+				pattern = outbuf[data_idx:outpos]
+				outbuf += (pattern * (data_length // len(pattern) + 1))[:data_length]
+			outpos += data_length
 
-	return outbuf
+	return str(outbuf)
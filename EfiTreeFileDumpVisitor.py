@@ -1,37 +1,227 @@
-import ast, os, logging
+import os, errno, hashlib, tempfile, logging, threading, Queue
 import EFI
+import Stats
 
 logger = logging.getLogger(__name__)
 
-class EfiTreeFileDumpVisitor(ast.NodeVisitor):
-  def __init__(self, destinationDirectory):
+#Number of threads writing dumped files
+DUMP_WRITER_THREADS = 8
+
+#Directory inside the destination holding the payloads of a deduplicated dump
+CONTENT_STORE_DIR = ".objects"
+
+class DumpWriter(object):
+  """Writes files on a pool of threads. Every thread has a queue of at most
+  maxPending writes, write() blocks when it is full. Writes to the same path go
+  to the same thread and happen in order. close() waits for all writes and
+  raises the first error one of them ran into.
+
+  If store is given, every payload is written once to store/<hash[:2]>/<hash>
+  and the requested paths become hardlinks to it, or relative symlinks where
+  hardlinks are not possible. The thread writing an object links its path right
+  away, others with the same payload wait until the object is in place."""
+  def __init__(self, threads=None, maxPending=4, store=None):
+    if threads is None:
+      threads = DUMP_WRITER_THREADS
+    self.Store = store
+    self.FilesWritten = 0
+    self.BytesWritten = 0
+    self.ObjectsStored = 0
+    self.BytesStored = 0
+    #Content hash -> threading.Event set once the object is written
+    self._objects = {}
+    self._lock = threading.Lock()
+    self._error = None
+    self._queues = []
+    self._threads = []
+    for i in xrange(max(threads, 1)):
+      q = Queue.Queue(maxPending)
+      t = threading.Thread(target=self._run, args=(q,), name="DumpWriter-%u" % i)
+      t.daemon = True
+      t.start()
+      self._queues.append(q)
+      self._threads.append(t)
+
+  def _run(self, queue):
+    while True:
+      item = queue.get()
+      if item is None:
+        return
+      (path, data) = item
+      try:
+        if self.Store is None:
+          length = self._writeFile(path, data)
+        else:
+          length = self._writeLinked(path, data)
+        with self._lock:
+          self.FilesWritten += 1
+          self.BytesWritten += length
+      except Exception as e:
+        with self._lock:
+          if self._error is None:
+            self._error = e
+
+  def _writeFile(self, path, data):
+    f = open(path, "w+b")
+    try:
+      f.write(data)
+      return f.tell()
+    finally:
+      f.close()
+
+  def _writeLinked(self, path, data):
+    if isinstance(data, unicode):
+      #Like file.write() does
+      data = data.encode("ascii")
+    data = str(data)
+    digest = hashlib.sha256(data).hexdigest()
+    objectPath = os.path.join(self.Store, digest[:2], digest)
+
+    with self._lock:
+      written = self._objects.get(digest)
+      owner = written is None
+      if owner:
+        written = self._objects[digest] = threading.Event()
+    if owner:
+      try:
+        self._storeObject(objectPath, data)
+      finally:
+        written.set()
+    else:
+      written.wait()
+
+    if os.path.lexists(path):
+      os.unlink(path)
+    try:
+      os.link(objectPath, path)
+    except (AttributeError, OSError):
+      try:
+        os.symlink(os.path.relpath(objectPath, os.path.dirname(path)), path)
+      except (AttributeError, OSError):
+        self._writeFile(path, data)
+    return len(data)
+
+  def _storeObject(self, objectPath, data):
+    if os.path.exists(objectPath):
+      return
+    subdir = os.path.dirname(objectPath)
+    try:
+      os.makedirs(subdir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    (fd, tmppath) = tempfile.mkstemp(dir=subdir, prefix=".tmp-")
+    f = os.fdopen(fd, "wb")
+    f.write(data)
+    f.close()
+    os.rename(tmppath, objectPath)
+    with self._lock:
+      self.ObjectsStored += 1
+      self.BytesStored += len(data)
+
+  def write(self, path, data):
+    if self._error is not None:
+      raise self._error
+    self._queues[hash(path) % len(self._queues)].put((path, data))
+
+  def close(self):
+    for q in self._queues:
+      q.put(None)
+    for t in self._threads:
+      t.join()
+    self._threads = []
+    if self._error is not None:
+      raise self._error
+
+  def addStats(self):
+    Stats.add("dump.files", self.FilesWritten)
+    Stats.add("dump.bytes", self.BytesWritten)
+    if self.Store is not None:
+      Stats.add("dump.objects", self.ObjectsStored)
+      Stats.add("dump.objects.bytes", self.BytesStored)
+
+  def __str__(self):
+    result = "%u files, %u bytes" % (self.FilesWritten, self.BytesWritten)
+    if self.Store is not None:
+      result += " (%u unique payloads, %u bytes stored)" % (self.ObjectsStored, self.BytesStored)
+    return result
+
+def _contentStore(destination, dedup):
+  if dedup:
+    return os.path.join(destination, CONTENT_STORE_DIR)
+  return None
+
+class EfiTreeFileDumpVisitor(EFI.EfiNodeVisitor):
+  """Dumps the tree in two steps. Visiting only plans the layout: the directories
+  in creation order and the payload of every file. write() then creates all
+  directories in one pass and hands the files to a DumpWriter. With dedup,
+  identical payloads are stored once in CONTENT_STORE_DIR and linked."""
+  def __init__(self, destinationDirectory, threads=None, dedup=False):
     logger.debug("Dumping EFI Tree into %s: " % destinationDirectory)
-    self.curDir = os.path.abspath(destinationDirectory)
+    self.destination = os.path.abspath(destinationDirectory)
+    self.threads = threads
+    self.dedup = dedup
+    self.dirs = [self.destination]
+    self.directories = []
+    self.files = {}
     self.fvCount = 0
     self.uniquenessSuffix = 0
     self.sectionUniquenessSuffix = 0
 
+  def visit(self, node):
+    result = super(EfiTreeFileDumpVisitor, self).visit(node)
+    if isinstance(node, EFI.EfiFirmwareImage) and len(self.dirs) == 1:
+      self.write()
+    return result
+
+  def write(self):
+    if not os.path.isdir(self.destination):
+      os.makedirs(self.destination)
+    #Parents are planned before their children, the visit order is a valid creation order
+    with Stats.timer("dump.mkdir"):
+      for path in self.directories:
+        os.mkdir(path)
+
+    writer = DumpWriter(self.threads, store=_contentStore(self.destination, self.dedup))
+    with Stats.timer("dump.write"):
+      try:
+        for (path, data) in self.files.iteritems():
+          writer.write(path, data)
+      finally:
+        writer.close()
+    writer.addStats()
+    logger.info("Dumped %s into %s", writer, self.destination)
+    return writer
+
+  def _enter(self, dirname):
+    path = os.path.join(self.dirs[-1], dirname)
+    self.directories.append(path)
+    self.dirs.append(path)
+
+  def _leave(self):
+    self.dirs.pop()
+
+  def _write(self, filename, data):
+    #A later section with the same name replaces the earlier one like it did on disk
+    self.files[os.path.join(self.dirs[-1], filename)] = data
+
   def generic_visit(self, node):
     logger.error("Unrecognized node: %s " % (type(node).__name__))
     raise Exception("Unrecognized node: %s " % (type(node).__name__))
 
   def visit_EfiFirmwareImage(self, node):
-    if not os.path.isdir(self.curDir):
-      os.makedirs(self.curDir)
-
     for v in node.firmwareVolumes:
       self.visit(v)
 
   def visit_EfiFirmwareVolume(self, node):
-    self.curDir = os.path.join(self.curDir, "firmwareVolume" + str(self.fvCount))
-    logger.debug("Dumping Firmware Volume %i into directory %s: " % (self.fvCount, self.curDir))
+    self._enter("firmwareVolume" + str(self.fvCount))
+    logger.debug("Dumping Firmware Volume %i into directory %s: " % (self.fvCount, self.dirs[-1]))
     self.fvCount += 1
-    os.makedirs(self.curDir)
-    
+
     for f in node.files:
       self.visit(f)
 
-    self.curDir = os.path.abspath(os.path.join(self.curDir, ".."))
+    self._leave()
 
   def visit_EfiFile(self, node):
     dirname = str(node.Guid)
@@ -39,87 +229,163 @@ class EfiTreeFileDumpVisitor(ast.NodeVisitor):
       dirname = dirname + "_" + str(self.uniquenessSuffix)
       self.uniquenessSuffix += 1
 
-    self.curDir = os.path.join(self.curDir, dirname)
-    logger.debug("Dumping Firmware File %s into directory %s: " % (str(node.Guid), self.curDir))
-    os.makedirs(self.curDir)
-    
+    self._enter(dirname)
+    logger.debug("Dumping Firmware File %s into directory %s: " % (str(node.Guid), self.dirs[-1]))
+
     if node.Type == EFI.EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_RAW:
-      f = open(os.path.join(self.curDir, "raw_filecontent"), "w+b")
-      f.write(node.Data)
-      f.close()
+      self._write("raw_filecontent", node.Data)
 
     if node.Type == EFI.EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_FFS_PAD:
-      f = open(os.path.join(self.curDir, "pad_filecontent"), "w+b")
-      f.write(node.Data)
-      f.close()
+      self._write("pad_filecontent", node.Data)
 
     for s in node.subsections:
       self.visit(s)
 
-    self.curDir = os.path.abspath(os.path.join(self.curDir, ".."))
+    self._leave()
 
   def visit_EfiGenericSection(self, node):
-    logger.debug("Dumping version generic section content into directory %s: " % (self.curDir))
-    f = open(os.path.join(self.curDir, node._strsectiontype() + "_" + str(self.sectionUniquenessSuffix)), "w+b")
+    logger.debug("Dumping version generic section content into directory %s: " % (self.dirs[-1]))
+    self._write(node._strsectiontype() + "_" + str(self.sectionUniquenessSuffix), node.RawContent)
     self.sectionUniquenessSuffix += 1
-    f.write(node.RawContent)
-    f.close()
 
     for s in node.Subsections:
       self.visit(s)
 
   def visit_EfiVersionSection(self, node):
-    logger.debug("Dumping version section content into directory %s: " % (self.curDir))
-    f = open(os.path.join(self.curDir, "version.txt"), "w+b")
-    f.write(node.VersionString)
-    #f.write("\n")
-    #f.write(str(node.BuildNumber))
-    f.close()
+    logger.debug("Dumping version section content into directory %s: " % (self.dirs[-1]))
+    self._write("version.txt", node.VersionString)
 
   def visit_EfiGuidDefinedSection(self, node):
-    if node.Guid == EFI.EFIGUIDS.FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED:
-      self.curDir = os.path.join(self.curDir, "LZMA_uncompressed")
-      os.makedirs(self.curDir)
+    if node.Decoder is not None:
+      self._enter(node.Decoder.Name.upper() + "_uncompressed")
 
-      logger.debug("Dumping LZMA compressed GUID defined section content into directory %s: " % (self.curDir))
+      logger.debug("Dumping %s compressed GUID defined section content into directory %s: " % (node.Decoder.Name, self.dirs[-1]))
       for s in node.Subsections:
         self.visit(s)
 
-      self.curDir = os.path.abspath(os.path.join(self.curDir, ".."))
+      self._leave()
     else:
-      logger.debug("Dumping GUID defined section content into directory %s: " % (self.curDir))
-      f = open(os.path.join(self.curDir, "GUID_DEFINED_" + str(node.Guid)), "w+b")
-      f.write(str(node.ContentData))
-      f.close()
+      logger.debug("Dumping GUID defined section content into directory %s: " % (self.dirs[-1]))
+      self._write("GUID_DEFINED_" + str(node.Guid), str(node.ContentData))
 
   def visit_EfiUserInterfaceSection(self, node):
-    logger.debug("Dumping UI section content into directory %s: " % (self.curDir))
-    f = open(os.path.join(self.curDir, "uistring.txt"), "w+b")
-    f.write(str(node.String))
-    f.close()
+    logger.debug("Dumping UI section content into directory %s: " % (self.dirs[-1]))
+    self._write("uistring.txt", str(node.String))
 
   def visit_EfiFreeformSubtypeGuidSection(self, node):
-    logger.debug("Dumping freeform guid defined section content into directory %s: " % (self.curDir))
-    f = open(os.path.join(self.curDir, "freeform_guid_defined_" + str(node.Guid)), "w+b")
-    f.write(str(node.ContentData))
-    f.close()
+    logger.debug("Dumping freeform guid defined section content into directory %s: " % (self.dirs[-1]))
+    self._write("freeform_guid_defined_" + str(node.Guid), str(node.ContentData))
 
   def visit_EfiCompressedSection(self, node):
-    self.curDir = os.path.join(self.curDir, "compressedSectionContents")
-    logger.debug("Dumping compressed sections in EFI Compressed Section into %s: " % (self.curDir))
-    os.makedirs(self.curDir)
-    
+    self._enter("compressedSectionContents")
+    logger.debug("Dumping compressed sections in EFI Compressed Section into %s: " % (self.dirs[-1]))
+
     for s in node.Subsections:
         self.visit(s)
 
-    self.curDir = os.path.abspath(os.path.join(self.curDir, ".."))
+    self._leave()
 
   def visit_EfiFirmwareVolumeSection(self, node):
-    self.curDir = os.path.join(self.curDir, "firmwareVolumeSectionContents")
-    logger.debug("Dumping Firmware Volume in Firmware Volume Section into directory %s: " % (self.curDir))
-    os.makedirs(self.curDir)
-    
+    self._enter("firmwareVolumeSectionContents")
+    logger.debug("Dumping Firmware Volume in Firmware Volume Section into directory %s: " % (self.dirs[-1]))
+
     self.visit(node.SubFirmware)
 
-    self.curDir = os.path.abspath(os.path.join(self.curDir, ".."))
+    self._leave()
+
+
+class EfiStreamFileDumper(object):
+  """Writes the same layout as EfiTreeFileDumpVisitor from EFI.IterEvents. Every
+  payload is queued on a DumpWriter as soon as its node is reached, only the nodes
+  on the path from the root to the current node and the queued payloads are
+  alive at any time."""
+  def __init__(self, destinationDirectory, threads=None, dedup=False):
+    logger.debug("Streaming EFI Tree into %s: " % destinationDirectory)
+    self.dirs = [os.path.abspath(destinationDirectory)]
+    self.threads = threads
+    self.dedup = dedup
+    self.writer = None
+    self.fvCount = 0
+    self.uniquenessSuffix = 0
+    self.sectionUniquenessSuffix = 0
+
+  def process(self, root):
+    self.writer = DumpWriter(self.threads, store=_contentStore(self.dirs[0], self.dedup))
+    try:
+      for (event, node, offset, depth) in EFI.IterEvents(root):
+        handler = EFI.FindHandler(self, event, node)
+        if handler is not None:
+          handler(node)
+    finally:
+      self.writer.close()
+    self.writer.addStats()
+    logger.info("Dumped %s into %s", self.writer, self.dirs[0])
+    return self.writer
+
+  def _enter(self, dirname):
+    path = os.path.join(self.dirs[-1], dirname)
+    os.mkdir(path)
+    self.dirs.append(path)
+
+  def _leave(self, node=None):
+    self.dirs.pop()
+
+  def _write(self, filename, data):
+    self.writer.write(os.path.join(self.dirs[-1], filename), data)
+
+  def start_EfiFirmwareImage(self, node):
+    if not os.path.isdir(self.dirs[-1]):
+      os.makedirs(self.dirs[-1])
+
+  def start_EfiFirmwareVolume(self, node):
+    self._enter("firmwareVolume" + str(self.fvCount))
+    self.fvCount += 1
+
+  end_EfiFirmwareVolume = _leave
+
+  def start_EfiFile(self, node):
+    dirname = str(node.Guid)
+    if dirname == 'ffffffff-ffff-ffff-ffff-ffffffffffff':
+      dirname = dirname + "_" + str(self.uniquenessSuffix)
+      self.uniquenessSuffix += 1
+    self._enter(dirname)
+
+    if node.Type == EFI.EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_RAW:
+      self._write("raw_filecontent", node.Data)
+    if node.Type == EFI.EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_FFS_PAD:
+      self._write("pad_filecontent", node.Data)
+
+  end_EfiFile = _leave
+
+  def start_EfiGenericSection(self, node):
+    self._write(node._strsectiontype() + "_" + str(self.sectionUniquenessSuffix), node.RawContent)
+    self.sectionUniquenessSuffix += 1
+
+  def start_EfiVersionSection(self, node):
+    self._write("version.txt", node.VersionString)
+
+  def start_EfiGuidDefinedSection(self, node):
+    if node.Decoder is not None:
+      self._enter(node.Decoder.Name.upper() + "_uncompressed")
+    else:
+      self._write("GUID_DEFINED_" + str(node.Guid), str(node.ContentData))
+
+  def end_EfiGuidDefinedSection(self, node):
+    if node.Decoder is not None:
+      self._leave()
+
+  def start_EfiUserInterfaceSection(self, node):
+    self._write("uistring.txt", str(node.String))
+
+  def start_EfiFreeformSubtypeGuidSection(self, node):
+    self._write("freeform_guid_defined_" + str(node.Guid), str(node.ContentData))
+
+  def start_EfiCompressedSection(self, node):
+    self._enter("compressedSectionContents")
+
+  end_EfiCompressedSection = _leave
+
+  def start_EfiFirmwareVolumeSection(self, node):
+    self._enter("firmwareVolumeSectionContents")
 
+  end_EfiFirmwareVolumeSection = _leave
@@ -1,134 +1,179 @@
-from mako.template import Template
-import ast, logging, os
+from mako.lookup import TemplateLookup
+import logging, os, StringIO
 import EFI
+import Stats
 
 logger = logging.getLogger(__name__)
 
-TEMPLATEDIR = "templates"
+TEMPLATEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
 
-class FDFGenerator(ast.NodeVisitor):
+#If set, compiled templates are kept as python modules in this directory across runs
+TEMPLATE_MODULE_DIR = None
+
+#Stands in for the children while rendering a template, see FDFGenerator._renderAround
+CHILDREN_MARKER = u"\0FDFGENERATOR_CHILDREN\0"
+
+_lookups = {}
+
+def GetTemplateLookup():
+	"""Returns the TemplateLookup for TEMPLATEDIR and TEMPLATE_MODULE_DIR. Lookups are
+	shared, so every template is compiled at most once per process."""
+	key = (TEMPLATEDIR, TEMPLATE_MODULE_DIR)
+	if key not in _lookups:
+		_lookups[key] = TemplateLookup(directories=[TEMPLATEDIR], module_directory=TEMPLATE_MODULE_DIR)
+	return _lookups[key]
+
+class FDFGenerator(EFI.EfiNodeVisitor):
+	"""Writes an FDF file for a dump of the visited image to self.output.
+
+	Templates get their children rendered in place. To avoid holding the children
+	as one string, each template is rendered with CHILDREN_MARKER instead, the text
+	before the marker is written, the children are visited and then the text after
+	it is written. Nested firmware volumes go to the end of the file and are
+	buffered until then."""
 	def __init__(self, directoryPrefix):
 		self.fvCount = 0
 		self.sectionUniquenessSuffix = 0
 		self.directoryPrefix = directoryPrefix
 		self.nestedFirmwareVolumes = []
 		self.curDir = os.path.normpath(directoryPrefix)
-		self.fdTemplate = open(TEMPLATEDIR + "/fd.tmpl").read()
-		self.fvTemplate = open(TEMPLATEDIR + "/fv.tmpl").read()
-		self.ffTemplate = open(TEMPLATEDIR + "/ff.tmpl").read()
-		self.fsTemplate = open(TEMPLATEDIR + "/fs.tmpl").read()
+		self.output = None
+		with Stats.timer("fdf.templates"):
+			lookup = GetTemplateLookup()
+			self.fdTemplate = lookup.get_template("fd.tmpl")
+			self.fvTemplate = lookup.get_template("fv.tmpl")
+			self.ffTemplate = lookup.get_template("ff.tmpl")
+			self.fsTemplate = lookup.get_template("fs.tmpl")
+
+	def generate(self, node, output):
+		"""Writes the FDF for node to the file object output"""
+		self.output = output
+		self.visit(node)
+
+	def render(self, node):
+		"""Returns the FDF for node as a string"""
+		output = StringIO.StringIO()
+		self.generate(node, output)
+		return output.getvalue()
+
+	def _renderTemplate(self, tmpl, **kwargs):
+		with Stats.timer("fdf.render"):
+			return tmpl.render(**kwargs)
+
+	def _renderAround(self, tmpl, childrenName, children, **kwargs):
+		kwargs[childrenName] = CHILDREN_MARKER
+		self._writeAround(self._renderTemplate(tmpl, **kwargs).split(CHILDREN_MARKER), children)
+
+	def _writeAround(self, parts, children):
+		#parts is a rendered template split at CHILDREN_MARKER, children either a list
+		#of nodes to visit or a function writing the children to self.output
+		if not callable(children):
+			nodes = children
+			children = lambda: [self.visit(c) for c in nodes]
+
+		if len(parts) == 2:
+			self.output.write(parts[0])
+			children()
+			self.output.write(parts[1])
+			return
+
+		#The template drops the children or uses them more than once
+		output = self.output
+		self.output = StringIO.StringIO()
+		children()
+		rendered = self.output.getvalue()
+		self.output = output
+		self.output.write(rendered.join(parts))
+
+	def _numberVolumes(self, volumes):
+		#The FD template lists the indices of the top level volumes before they are
+		#visited, number them up front in the order they are visited
+		for v in volumes:
+			v.volumeIndex = self.fvCount
+			self.fvCount += 1
+			pending = [s for f in v.files for s in f.subsections]
+			while pending:
+				s = pending.pop(0)
+				if isinstance(s, EFI.EfiFirmwareVolumeSection):
+					self._numberVolumes(s.SubFirmware.firmwareVolumes[0:1])
+				else:
+					pending[0:0] = s.Subsections
 
 	def generic_visit(self, node):
 		logger.error("Unrecognized node: %s " % (type(node).__name__))
 		raise Exception("Unrecognized node: %s " % (type(node).__name__))
 
 	def visit_EfiFirmwareImage(self, node):
-		firmwareVolumes = ""
-		tmpl = Template(text=self.fdTemplate)
-		
-		for v in node.firmwareVolumes:
-			firmwareVolumes += self.visit(v)
+		self._numberVolumes(node.firmwareVolumes)
+
+		def firmwareVolumes():
+			for v in node.firmwareVolumes:
+				self.visit(v)
+			for v in self.nestedFirmwareVolumes:
+				self.output.write(v)
 
-		nestedVolumes = ""
-		for v in self.nestedFirmwareVolumes:
-			nestedVolumes += v
-		return tmpl.render(firmwareImage=node, firmwareVolumes=(firmwareVolumes + nestedVolumes))
+		self._renderAround(self.fdTemplate, "firmwareVolumes", firmwareVolumes, firmwareImage=node)
 
 	def visit_EfiFirmwareVolume(self, node):
-		volume = ""
-		files = ""
-		thisFirmwareVolumeIndex = self.fvCount
-		node.volumeIndex = thisFirmwareVolumeIndex
-		self.fvCount += 1
+		thisFirmwareVolumeIndex = node.volumeIndex
 		self.curDir = os.path.join(self.curDir, "firmwareVolume" + str(thisFirmwareVolumeIndex))
-		
-		tmpl = Template(text=self.fvTemplate)
-		
-		for f in node.files:
-			files += self.visit(f)
 
-		volume = tmpl.render(firmwareVolume=node, fvNum=thisFirmwareVolumeIndex, files=files)
+		self._renderAround(self.fvTemplate, "files", node.files, firmwareVolume=node, fvNum=thisFirmwareVolumeIndex)
 
 		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
 
-		return volume
-
 	def visit_EfiFile(self, node):
 		self.curDir = os.path.join(self.curDir, str(node.Guid))
 
-		sectionsForFile = ""
-		for s in node.subsections:
-			sectionsForFile += self.visit(s)
-
-		tmpl = Template(text=self.ffTemplate)
-		curFile = tmpl.render(firmwareFile=node, sections=sectionsForFile, curDir=self.curDir)
+		self._renderAround(self.ffTemplate, "sections", node.subsections, firmwareFile=node, curDir=self.curDir)
 
 		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
-		return curFile
 
 	def visit_EfiGuidDefinedSection(self, node):
-		subsections = ""
-		if node.Guid == EFI.EFIGUIDS.FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED:
-			lzmaContents = ""
-			self.curDir = os.path.join(self.curDir, "LZMA_uncompressed")
+		if node.Decoder is not None:
+			self.curDir = os.path.join(self.curDir, node.Decoder.Name.upper() + "_uncompressed")
 
-			for s in node.Subsections:
-				subsections += self.visit(s)
-
-			tmpl = Template(text=self.fsTemplate)
-			lzmaContents = tmpl.render(section=node, curDir=self.curDir, subsections=subsections)
+			self._renderAround(self.fsTemplate, "subsections", node.Subsections, section=node, curDir=self.curDir)
 
 			self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
-			return lzmaContents
 		else:
-			for s in node.Subsections:
-				subsections += self.visit(s)
-
-			tmpl = Template(text=self.fsTemplate)
-			return tmpl.render(section=node, curDir=self.curDir, subsections=subsections)
-		
+			self._renderAround(self.fsTemplate, "subsections", node.Subsections, section=node, curDir=self.curDir)
 
 	def visit_EfiGenericSection(self, node):
-		tmpl = Template(text=self.fsTemplate)
-		section = tmpl.render(section=node, curDir=self.curDir, sectionUniquenessSuffix=self.sectionUniquenessSuffix)
+		self.output.write(self._renderTemplate(self.fsTemplate, section=node, curDir=self.curDir, sectionUniquenessSuffix=self.sectionUniquenessSuffix))
 		self.sectionUniquenessSuffix += 1
-		return section
 
 	def visit_EfiUserInterfaceSection(self, node):
-		tmpl = Template(text=self.fsTemplate)
-		return tmpl.render(section=node, curDir=self.curDir)
+		self.output.write(self._renderTemplate(self.fsTemplate, section=node, curDir=self.curDir))
 
 	def visit_EfiVersionSection(self, node):
-		tmpl = Template(text=self.fsTemplate)
-		return tmpl.render(section=node, curDir=self.curDir)
+		self.output.write(self._renderTemplate(self.fsTemplate, section=node, curDir=self.curDir))
 
 	def visit_EfiCompressedSection(self, node):
-		subsections = ""
-		self.curDir = os.path.join(self.curDir, "compressedSectionContents")
-
-		for s in node.Subsections:
-			subsections += self.visit(s)
-
-		tmpl = Template(text=self.fsTemplate)
 		compressionType = "PI_NONE"
 		if node.CompressionType == 1:
 			compressionType = "PI_STD"
+
+		#The section is rendered with the directory of the compressed section itself,
+		#its children live in compressedSectionContents
+		parts = self._renderTemplate(self.fsTemplate, section=node, curDir=self.curDir, subsections=CHILDREN_MARKER, compressionType=compressionType).split(CHILDREN_MARKER)
+		self.curDir = os.path.join(self.curDir, "compressedSectionContents")
+		self._writeAround(parts, node.Subsections)
 		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
-		return tmpl.render(section=node, curDir=self.curDir, subsections=subsections, compressionType=compressionType)
 
 	def visit_EfiFreeformSubtypeGuidSection(self, node):
-		tmpl = Template(text=self.fsTemplate)
-		return tmpl.render(section=node, curDir=self.curDir)
+		self.output.write(self._renderTemplate(self.fsTemplate, section=node, curDir=self.curDir))
 
 	def visit_EfiFirmwareVolumeSection(self, node):
 		self.curDir = os.path.join(self.curDir, "firmwareVolumeSectionContents")
 
 		volume = node.SubFirmware.firmwareVolumes[0]
-		self.nestedFirmwareVolumes.append(self.visit(volume))
+		output = self.output
+		self.output = StringIO.StringIO()
+		self.visit(volume)
+		self.nestedFirmwareVolumes.append(self.output.getvalue())
+		self.output = output
 
-		tmpl = Template(text=self.fsTemplate)
-		section = tmpl.render(section=node, curDir=self.curDir, fvname="FV_" + str(volume.volumeIndex))
+		self.output.write(self._renderTemplate(self.fsTemplate, section=node, curDir=self.curDir, fvname="FV_" + str(volume.volumeIndex)))
 
 		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
-
-		return section
@@ -0,0 +1,99 @@
+import heapq
+import logging
+import collections
+
+import EFI
+
+logger = logging.getLogger(__name__)
+
+def NodeGuid(node):
+	"""Returns the GUID a node is looked up by, None for nodes without one"""
+	if isinstance(node, (EFI.EfiFile, EFI.EfiFreeformSubtypeGuidSection, EFI.EfiGuidDefinedSection)):
+		return node.Guid
+	return None
+
+def NodeName(node):
+	if isinstance(node, EFI.EfiFirmwareVolume):
+		return "FV@0x%X" % node.Base
+	if isinstance(node, EFI.EfiFile):
+		return str(node.Guid)
+	if isinstance(node, (EFI.EfiFreeformSubtypeGuidSection, EFI.EfiGuidDefinedSection)):
+		return "%s(%s)" % (node._strsectiontype(), node.Guid)
+	return node._strsectiontype()
+
+def FormatPath(path):
+	"""Formats a list of nodes from a top level volume down, e.g.
+	FV@0x1000/<file GUID>/COMPRESSION/FIRMWARE_VOLUME_IMAGE/FV@0x0/<file GUID>"""
+	return "/".join(NodeName(n) for n in path)
+
+class GuidIndex(object):
+	"""Maps the GUIDs of files, freeform subtype GUID sections and GUID defined
+	sections anywhere in an image, nested volumes and compressed sections
+	included, to (node, path) tuples, path being the nodes from the top level
+	volume down to the node.
+
+	The tree is indexed as far as lookups need it: everything that can be reached
+	without decompressing comes first, then encapsulation sections are decoded one
+	by one in image order, depth first, until the GUID shows up. The sections
+	inside a decoded one come before the ones after it. A GUID near the end of the
+	image still costs decoding almost every section in front of it; SidecarIndex
+	answers repeated lookups without decoding. Nodes come from the cached children
+	of the image, so they can be modified and repacked."""
+	def __init__(self, image):
+		self.Image = image
+		self._entries = {}
+		self._pending = collections.deque([(image, [], ())])
+		#(position, node, path) heap, position being the child indices from the image
+		#down to the node, so the smallest one comes first in the image
+		self._encoded = []
+
+	def __len__(self):
+		return sum(len(matches) for matches in self._entries.itervalues())
+
+	def __contains__(self, guid):
+		return bool(self.lookup(guid))
+
+	@property
+	def IsComplete(self):
+		return not self._pending and not self._encoded
+
+	def lookup(self, guid):
+		"""Returns the (node, path) tuples for guid, indexing until there is one. Use
+		lookupAll to get every node with this GUID."""
+		while guid not in self._entries and self._expand():
+			pass
+		return self._entries.get(guid, [])
+
+	def lookupAll(self, guid):
+		self.complete()
+		return self._entries.get(guid, [])
+
+	def complete(self):
+		"""Indexes the whole image"""
+		while self._expand():
+			pass
+		return self
+
+	def guids(self):
+		return self.complete()._entries.keys()
+
+	def _expand(self):
+		if self._pending:
+			(node, path, position) = self._pending.popleft()
+		elif self._encoded:
+			(position, node, path) = heapq.heappop(self._encoded)
+			logger.debug("Decoding %s to look further", FormatPath(path))
+		else:
+			return False
+
+		for (index, (offset, child)) in enumerate(EFI.CachedChildren(node)):
+			childPath = path + [child]
+			childPosition = position + (index,)
+			guid = NodeGuid(child)
+			if guid is not None:
+				self._entries.setdefault(guid, []).append((child, childPath))
+			if isinstance(child, EFI.EfiEncapsulationSection) and not child.IsDecoded:
+				heapq.heappush(self._encoded, (childPosition, child, childPath))
+			else:
+				self._pending.append((child, childPath, childPosition))
+		return True
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import itertools
+
+import EFI
+from GuidIndex import FormatPath
+
+logger = logging.getLogger(__name__)
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+#The file decodes to the same content, only its encoding (e.g. the compression) differs
+REENCODED = "reencoded"
+
+FILETYPES = EFI.EfiFile.EFI_FILETYPES
+
+def RawBytes(node):
+	"""Returns a view of the bytes of a node in its buffer, header included"""
+	if isinstance(node, EFI.EfiFirmwareVolume):
+		return EFI.BufferView(node.stream.Data, node.Base, node.HeaderLength + node.DataLength)
+	return node.Data
+
+def SameBytes(a, b):
+	"""Compares two strings or buffers without copying them"""
+	return len(a) == len(b) and buffer(a) == buffer(b)
+
+def FileName(f):
+	"""Returns the user interface name of a file if it can be read without decompressing"""
+	pending = list(f.subsections)
+	while pending:
+		s = pending.pop(0)
+		if isinstance(s, EFI.EfiUserInterfaceSection):
+			return s.String
+		if isinstance(s, EFI.EfiEncapsulationSection) and s.IsDecoded:
+			pending[0:0] = s.Subsections
+	return None
+
+class ImageDiff(object):
+	"""Compares two images structurally and reports added, removed and changed FFS
+	files by GUID, nested volumes included.
+
+	Two subtrees with the same bytes are equal as a whole, so the comparison stops
+	at the first node whose bytes are identical on both sides without parsing or
+	decompressing anything below it. Volumes are paired by position, files by
+	GUID (and occurrence), sections by position. Changed files get Merkle hashes,
+	computed bottom-up over their decoded content, which tell real changes from
+	files that were only compressed differently.
+
+	Changes are (status, guid, path, oldFile, newFile) sequences, path being the
+	nodes down to the file in the new image (the old one for removed files). Files
+	holding changed volumes are reported as changed, followed by the changes in
+	those volumes."""
+	def __init__(self):
+		self.Changes = []
+		self.VolumesCompared = 0
+		self.FilesCompared = 0
+		self.Pruned = 0
+		self._hashes = {}
+
+	def diff(self, old, new):
+		self._diffVolumes(old.firmwareVolumes, new.firmwareVolumes, [], [])
+		return self.Changes
+
+	def _diffVolumes(self, oldVolumes, newVolumes, oldPath, newPath):
+		for (o, n) in itertools.izip_longest(oldVolumes, newVolumes):
+			if n is None:
+				self._all(REMOVED, o.files, oldPath + [o])
+			elif o is None:
+				self._all(ADDED, n.files, newPath + [n])
+			else:
+				self.VolumesCompared += 1
+				if SameBytes(RawBytes(o), RawBytes(n)):
+					self.Pruned += 1
+					continue
+				self._diffFiles(o.files, n.files, oldPath + [o], newPath + [n])
+
+	def _all(self, status, files, path):
+		for f in files:
+			if f.Type != FILETYPES.EFI_FV_FILETYPE_FFS_PAD:
+				self.Changes.append((status, f.Guid, path + [f], f if status == REMOVED else None, f if status == ADDED else None))
+
+	def _keyed(self, files):
+		occurrences = {}
+		result = []
+		for f in files:
+			if f.Type == FILETYPES.EFI_FV_FILETYPE_FFS_PAD:
+				continue
+			occurrence = occurrences.get(f.Guid, 0)
+			occurrences[f.Guid] = occurrence + 1
+			result.append(((f.Guid, occurrence), f))
+		return result
+
+	def _diffFiles(self, oldFiles, newFiles, oldPath, newPath):
+		old = self._keyed(oldFiles)
+		oldByKey = dict(old)
+		newKeys = set()
+		for (key, n) in self._keyed(newFiles):
+			newKeys.add(key)
+			o = oldByKey.get(key)
+			if o is None:
+				self.Changes.append((ADDED, n.Guid, newPath + [n], None, n))
+				continue
+
+			self.FilesCompared += 1
+			if self._sameFile(o, n):
+				self.Pruned += 1
+				continue
+			#Report what changed in the volumes inside the file as well. If nothing did, the
+			#hashes are only computed for the file itself, most of it is decoded by now.
+			change = [CHANGED, n.Guid, newPath + [n], o, n]
+			self.Changes.append(change)
+			reported = len(self.Changes)
+			self._diffSections(o.subsections, n.subsections, oldPath + [o], newPath + [n])
+			if len(self.Changes) == reported and self.hash(o) == self.hash(n):
+				change[0] = REENCODED
+
+		for (key, o) in old:
+			if key not in newKeys:
+				self.Changes.append((REMOVED, o.Guid, oldPath + [o], o, None))
+
+	def _sameFile(self, o, n):
+		return (o.Type, o.Attributes, o.State) == (n.Type, n.Attributes, n.State) and SameBytes(o.Data, n.Data)
+
+	def _diffSections(self, oldSections, newSections, oldPath, newPath):
+		for (o, n) in itertools.izip_longest(oldSections, newSections):
+			if o is None or n is None or type(o) is not type(n) or SameBytes(o.Data, n.Data):
+				continue
+			if isinstance(n, EFI.EfiFirmwareVolumeSection):
+				self._diffVolumes(o.SubFirmware.firmwareVolumes, n.SubFirmware.firmwareVolumes, oldPath + [o], newPath + [n])
+			elif isinstance(n, EFI.EfiEncapsulationSection):
+				self._diffSections(o.Subsections, n.Subsections, oldPath + [o], newPath + [n])
+
+	def hash(self, node):
+		"""Merkle hash of the decoded content of node: leaves hash their bytes, other
+		nodes their header fields and the hashes of their children, so the encoding
+		of encapsulation sections does not matter. Encapsulation sections which
+		decode to nothing (unknown GUIDs, CRC32 sections, unsupported compression
+		types) hash their payload instead."""
+		key = id(node)
+		if key not in self._hashes:
+			h = hashlib.sha256(type(node).__name__)
+			if isinstance(node, EFI.EfiFirmwareVolume):
+				h.update(str(node.stream.Data[node.Base:node.Base+node.HeaderLength]))
+				children = node.files
+			elif isinstance(node, EFI.EfiFile):
+				h.update(node.Guid.bytes + chr(node.Type) + chr(node.Attributes) + chr(node.State))
+				children = node.subsections
+				if not node.HasSections:
+					h.update(node.Data)
+			elif isinstance(node, EFI.EfiFirmwareVolumeSection):
+				children = node.SubFirmware.firmwareVolumes
+			elif isinstance(node, EFI.EfiEncapsulationSection):
+				h.update(chr(node.SectionType))
+				if isinstance(node, EFI.EfiGuidDefinedSection):
+					h.update(node.Guid.bytes)
+				children = node.Subsections
+				if not children:
+					h.update(node.Payload)
+			else:
+				h.update(node.Data)
+				children = []
+			for c in children:
+				h.update(self.hash(c))
+			#Keep the node alive, its id could be reused otherwise
+			self._hashes[key] = (h.digest(), node)
+		return self._hashes[key][0]
+
+def FormatChanges(changes):
+	"""One line per change: status, GUID, name and path"""
+	lines = []
+	for (status, guid, path, oldFile, newFile) in changes:
+		name = FileName(newFile if newFile is not None else oldFile)
+		lines.append("%-9s %s %-24s %s" % (status, guid, name or "-", FormatPath(path[:-1])))
+	return "\n".join(lines)
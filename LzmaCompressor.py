@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import struct
+
+from LzmaDecompressor import lzma, HEADER_LENGTH, NUM_STATES, NUM_LEN_TO_POS_STATES, NUM_ALIGN_BITS, START_POS_MODEL_INDEX, END_POS_MODEL_INDEX, NUM_FULL_DISTANCES, MATCH_MIN_LEN, PROB_INIT
+
+MATCH_MAX_LEN = MATCH_MIN_LEN + 8 + 8 + 256 - 1
+MIN_MATCH = 3
+MAX_CHAIN = 16
+DEFAULT_DICT_SIZE = 1 << 20
+
+
+
+class RangeEncoder(object):
+	def __init__(self):
+		self.Low = 0
+		self.Range = 0xFFFFFFFF
+		self._Cache = 0
+		self._CacheSize = 1
+		self._Out = bytearray()
+
+	def _shiftLow(self):
+		if (self.Low & 0xFFFFFFFF) < 0xFF000000 or self.Low >> 32:
+			carry = self.Low >> 32
+			temp = self._Cache
+			while True:
+				self._Out.append((temp + carry) & 0xFF)
+				temp = 0xFF
+				self._CacheSize -= 1
+				if self._CacheSize == 0:
+					break
+			self._Cache = (self.Low >> 24) & 0xFF
+		self._CacheSize += 1
+		self.Low = (self.Low & 0x00FFFFFF) << 8
+
+	def encodeBit(self, probs, idx, bit):
+		prob = probs[idx]
+		bound = (self.Range >> 11) * prob
+		if bit == 0:
+			self.Range = bound
+			probs[idx] = prob + ((2048 - prob) >> 5)
+		else:
+			self.Low += bound
+			self.Range -= bound
+			probs[idx] = prob - (prob >> 5)
+		while self.Range < 0x1000000:
+			self.Range <<= 8
+			self._shiftLow()
+
+	def encodeDirectBits(self, value, bitcount):
+		for i in xrange(bitcount - 1, -1, -1):
+			self.Range >>= 1
+			if (value >> i) & 1:
+				self.Low += self.Range
+			if self.Range < 0x1000000:
+				self.Range <<= 8
+				self._shiftLow()
+
+	def encodeTree(self, probs, offset, bitcount, symbol):
+		m = 1
+		for i in xrange(bitcount - 1, -1, -1):
+			bit = (symbol >> i) & 1
+			self.encodeBit(probs, offset + m, bit)
+			m = (m << 1) | bit
+
+	def encodeReverseTree(self, probs, offset, bitcount, symbol):
+		m = 1
+		for i in xrange(bitcount):
+			bit = symbol & 1
+			symbol >>= 1
+			self.encodeBit(probs, offset + m, bit)
+			m = (m << 1) | bit
+
+	def getvalue(self):
+		for i in xrange(5):
+			self._shiftLow()
+		return str(self._Out)
+
+
+
+class LenEncoder(object):
+	def __init__(self, posStates):
+		self.Choice = [PROB_INIT] * 2
+		self.Low = [PROB_INIT] * (posStates << 3)
+		self.Mid = [PROB_INIT] * (posStates << 3)
+		self.High = [PROB_INIT] * 256
+
+	def encode(self, rc, symbol, posState):
+		if symbol < 8:
+			rc.encodeBit(self.Choice, 0, 0)
+			rc.encodeTree(self.Low, posState << 3, 3, symbol)
+		elif symbol < 16:
+			rc.encodeBit(self.Choice, 0, 1)
+			rc.encodeBit(self.Choice, 1, 0)
+			rc.encodeTree(self.Mid, posState << 3, 3, symbol - 8)
+		else:
+			rc.encodeBit(self.Choice, 0, 1)
+			rc.encodeBit(self.Choice, 1, 1)
+			rc.encodeTree(self.High, 0, 8, symbol - 16)
+
+
+
+def _posSlot(distance):
+	if distance < START_POS_MODEL_INDEX:
+		return distance
+	bits = distance.bit_length() - 1
+	return (bits << 1) | ((distance >> (bits - 1)) & 1)
+
+def CompressPython(data, lc=3, lp=0, pb=2, dictSize=DEFAULT_DICT_SIZE):
+	"""Pure python LZMA encoder, the counterpart of LzmaDecompressor.DecompressPython.
+	It does a greedy parse with hash chains and never emits repeated matches, which
+	costs some ratio but keeps it short."""
+	data = str(data)
+	n = len(data)
+	rc = RangeEncoder()
+
+	posStates = 1 << pb
+	litProbs = [PROB_INIT] * (0x300 << (lc + lp))
+	isMatch = [PROB_INIT] * (NUM_STATES << 4)
+	isRep = [PROB_INIT] * NUM_STATES
+	posSlot = [PROB_INIT] * (NUM_LEN_TO_POS_STATES << 6)
+	posSpecial = [PROB_INIT] * (1 + NUM_FULL_DISTANCES - END_POS_MODEL_INDEX)
+	align = [PROB_INIT] * (1 << NUM_ALIGN_BITS)
+	lenEncoder = LenEncoder(posStates)
+
+	state = 0
+	rep0 = 0
+	posMask = posStates - 1
+	litPosMask = (1 << lp) - 1
+	head = {}
+	prev = {}
+	pos = 0
+	while pos < n:
+		posState = pos & posMask
+
+		bestlen = 0
+		bestdist = 0
+		if pos + MIN_MATCH <= n:
+			candidate = head.get(data[pos:pos+MIN_MATCH])
+			chain = 0
+			maxlen = min(MATCH_MAX_LEN, n - pos)
+			while candidate is not None and pos - candidate <= dictSize and chain < MAX_CHAIN:
+				length = MIN_MATCH
+				while length < maxlen and data[candidate+length] == data[pos+length]:
+					length += 1
+				if length > bestlen:
+					(bestlen, bestdist) = (length, pos - candidate - 1)
+					if length == maxlen:
+						break
+				candidate = prev.get(candidate)
+				chain += 1
+
+		if bestlen >= MIN_MATCH:
+			rc.encodeBit(isMatch, (state << 4) + posState, 1)
+			rc.encodeBit(isRep, state, 0)
+			lenSymbol = bestlen - MATCH_MIN_LEN
+			lenEncoder.encode(rc, lenSymbol, posState)
+			state = 7 if state < 7 else 10
+
+			slot = _posSlot(bestdist)
+			rc.encodeTree(posSlot, min(lenSymbol, NUM_LEN_TO_POS_STATES - 1) << 6, 6, slot)
+			if slot >= START_POS_MODEL_INDEX:
+				directBits = (slot >> 1) - 1
+				base = (2 | (slot & 1)) << directBits
+				reduced = bestdist - base
+				if slot < END_POS_MODEL_INDEX:
+					rc.encodeReverseTree(posSpecial, base - slot - 1, directBits, reduced)
+				else:
+					rc.encodeDirectBits(reduced >> NUM_ALIGN_BITS, directBits - NUM_ALIGN_BITS)
+					rc.encodeReverseTree(align, -1, NUM_ALIGN_BITS, reduced & ((1 << NUM_ALIGN_BITS) - 1))
+			rep0 = bestdist
+			step = bestlen
+		else:
+			rc.encodeBit(isMatch, (state << 4) + posState, 0)
+			prevByte = ord(data[pos-1]) if pos else 0
+			base = 0x300 * (((pos & litPosMask) << lc) + (prevByte >> (8 - lc)))
+			byte = ord(data[pos])
+			symbol = 1
+			matched = state >= 7
+			matchByte = ord(data[pos - rep0 - 1]) if matched else 0
+			for i in xrange(7, -1, -1):
+				bit = (byte >> i) & 1
+				if matched:
+					matchBit = (matchByte >> i) & 1
+					rc.encodeBit(litProbs, base + ((1 + matchBit) << 8) + symbol, bit)
+					matched = matchBit == bit
+				else:
+					rc.encodeBit(litProbs, base + symbol, bit)
+				symbol = (symbol << 1) | bit
+			state = 0 if state < 4 else (state - 3 if state < 10 else state - 6)
+			step = 1
+
+		for i in xrange(pos, min(pos + step, n - MIN_MATCH + 1)):
+			key = data[i:i+MIN_MATCH]
+			if key in head:
+				prev[i] = head[key]
+			head[key] = i
+		pos += step
+
+	properties = (pb * 5 + lp) * 9 + lc
+	return struct.pack("<BIQ", properties, dictSize, n) + rc.getvalue()
+
+def Compress(data):
+	"""Compresses data into an EDK2 LZMA section payload (properties, dictionary size
+	and 64 bit uncompressed size followed by the LZMA stream), with the lzma module
+	if it is available"""
+	if lzma is not None:
+		compressed = lzma.compress(str(data), format=lzma.FORMAT_ALONE, filters=[{"id": lzma.FILTER_LZMA1, "dict_size": DEFAULT_DICT_SIZE}])
+		#The alone format leaves the size unknown, EDK2 stores it
+		return compressed[0:5] + struct.pack("<Q", len(data)) + compressed[HEADER_LENGTH:]
+	return CompressPython(data)
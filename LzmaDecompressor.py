@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import shutil
+import logging
+import tempfile
+import subprocess
+import Stats
+
+logger = logging.getLogger(__name__)
+
+# Native LZMA implementations are optional, the pure python decoder below
+# is used when none of them is available
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+try:
+	import pylzma
+except ImportError:
+	pylzma = None
+
+# Path to EDK2's LzmaCompress binary (BaseTools/BinWrappers/PosixLike/LzmaCompress).
+# When set, it is used as a fallback for sections the in-process decoder rejects,
+# and instead of the pure python decoder when no lzma module is installed.
+LZMA_BINARY = None
+
+# The pure python decoder manages about 0.1-0.15 MB/s (some 40ms per typical
+# section), real images with megabytes of LZMA data take minutes with it
+_warnedPython = False
+
+HEADER_FORMAT = "<BIQ"
+HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+UNKNOWN_SIZE = 0xFFFFFFFFFFFFFFFF
+
+NUM_STATES = 12
+NUM_LEN_TO_POS_STATES = 4
+NUM_ALIGN_BITS = 4
+START_POS_MODEL_INDEX = 4
+END_POS_MODEL_INDEX = 14
+NUM_FULL_DISTANCES = 1 << (END_POS_MODEL_INDEX >> 1)
+MATCH_MIN_LEN = 2
+PROB_INIT = 1 << 10
+
+
+
+class RangeDecoder(object):
+	def __init__(self, data, offset):
+		self._Data = data
+		self._Pos = offset + 5
+		if self._Pos > len(data) or data[offset] != '\0':
+			raise ValueError("Invalid LZMA range coder stream")
+		(self.Code,) = struct.unpack(">I", data[offset+1:offset+5])
+		self.Range = 0xFFFFFFFF
+
+	def _nextByte(self):
+		if self._Pos >= len(self._Data):
+			raise ValueError("LZMA stream is truncated")
+		self._Pos += 1
+		return ord(self._Data[self._Pos - 1])
+
+	def decodeBit(self, probs, idx):
+		prob = probs[idx]
+		bound = (self.Range >> 11) * prob
+		if self.Code < bound:
+			self.Range = bound
+			probs[idx] = prob + ((2048 - prob) >> 5)
+			bit = 0
+		else:
+			self.Range -= bound
+			self.Code -= bound
+			probs[idx] = prob - (prob >> 5)
+			bit = 1
+		if self.Range < 0x1000000:
+			self.Range <<= 8
+			self.Code = (self.Code << 8) | self._nextByte()
+		return bit
+
+	def decodeDirectBits(self, bitcount):
+		result = 0
+		for i in xrange(bitcount):
+			self.Range >>= 1
+			bit = 0
+			if self.Code >= self.Range:
+				self.Code -= self.Range
+				bit = 1
+			result = (result << 1) | bit
+			if self.Range < 0x1000000:
+				self.Range <<= 8
+				self.Code = (self.Code << 8) | self._nextByte()
+		return result
+
+	def decodeTree(self, probs, offset, bitcount):
+		m = 1
+		for i in xrange(bitcount):
+			m = (m << 1) | self.decodeBit(probs, offset + m)
+		return m - (1 << bitcount)
+
+	def decodeReverseTree(self, probs, offset, bitcount):
+		m = 1
+		result = 0
+		for i in xrange(bitcount):
+			bit = self.decodeBit(probs, offset + m)
+			m = (m << 1) | bit
+			result |= bit << i
+		return result
+
+
+
+class LenDecoder(object):
+	def __init__(self, posStates):
+		self.Choice = [PROB_INIT] * 2
+		self.Low = [PROB_INIT] * (posStates << 3)
+		self.Mid = [PROB_INIT] * (posStates << 3)
+		self.High = [PROB_INIT] * 256
+
+	def decode(self, rc, posState):
+		if rc.decodeBit(self.Choice, 0) == 0:
+			return rc.decodeTree(self.Low, posState << 3, 3)
+		if rc.decodeBit(self.Choice, 1) == 0:
+			return 8 + rc.decodeTree(self.Mid, posState << 3, 3)
+		return 16 + rc.decodeTree(self.High, 0, 8)
+
+
+
+def ParseHeader(buf):
+	"""Returns (lc, lp, pb, dictionary size, uncompressed size) of an EDK2 LZMA header"""
+	if len(buf) < HEADER_LENGTH:
+		raise ValueError("LZMA data is shorter than its header")
+	(properties, dictSize, uncompressedSize) = struct.unpack(HEADER_FORMAT, buf[0:HEADER_LENGTH])
+	if properties >= 9 * 5 * 5:
+		raise ValueError("Invalid LZMA properties 0x%02x" % properties)
+	(lc, properties) = (properties % 9, properties // 9)
+	(lp, pb) = (properties % 5, properties // 5)
+	return (lc, lp, pb, dictSize, uncompressedSize)
+
+def DecompressPython(buf):
+	"""Pure python LZMA decoder following the reference decoder in the LZMA SDK"""
+	(lc, lp, pb, dictSize, uncompressedSize) = ParseHeader(buf)
+	data = str(buf)
+	rc = RangeDecoder(data, HEADER_LENGTH)
+	dictSize = max(dictSize, 1 << 12)
+	sizeKnown = uncompressedSize != UNKNOWN_SIZE
+
+	posStates = 1 << pb
+	litProbs = [PROB_INIT] * (0x300 << (lc + lp))
+	isMatch = [PROB_INIT] * (NUM_STATES << 4)
+	isRep = [PROB_INIT] * NUM_STATES
+	isRepG0 = [PROB_INIT] * NUM_STATES
+	isRepG1 = [PROB_INIT] * NUM_STATES
+	isRepG2 = [PROB_INIT] * NUM_STATES
+	isRep0Long = [PROB_INIT] * (NUM_STATES << 4)
+	posSlot = [PROB_INIT] * (NUM_LEN_TO_POS_STATES << 6)
+	posSpecial = [PROB_INIT] * (1 + NUM_FULL_DISTANCES - END_POS_MODEL_INDEX)
+	align = [PROB_INIT] * (1 << NUM_ALIGN_BITS)
+	lenDecoder = LenDecoder(posStates)
+	repLenDecoder = LenDecoder(posStates)
+
+	out = bytearray()
+	state = 0
+	(rep0, rep1, rep2, rep3) = (0, 0, 0, 0)
+	posMask = posStates - 1
+	litPosMask = (1 << lp) - 1
+	while not sizeKnown or len(out) < uncompressedSize:
+		posState = len(out) & posMask
+
+		if rc.decodeBit(isMatch, (state << 4) + posState) == 0:
+			prevByte = out[-1] if out else 0
+			base = 0x300 * (((len(out) & litPosMask) << lc) + (prevByte >> (8 - lc)))
+			symbol = 1
+			if state >= 7:
+				matchByte = out[-rep0 - 1]
+				while symbol < 0x100:
+					matchBit = (matchByte >> 7) & 1
+					matchByte <<= 1
+					bit = rc.decodeBit(litProbs, base + ((1 + matchBit) << 8) + symbol)
+					symbol = (symbol << 1) | bit
+					if matchBit != bit:
+						break
+			while symbol < 0x100:
+				symbol = (symbol << 1) | rc.decodeBit(litProbs, base + symbol)
+			out.append(symbol - 0x100)
+			state = 0 if state < 4 else (state - 3 if state < 10 else state - 6)
+			continue
+
+		if rc.decodeBit(isRep, state):
+			if not out:
+				raise ValueError("LZMA repeated match at the start of the output")
+			if rc.decodeBit(isRepG0, state) == 0:
+				if rc.decodeBit(isRep0Long, (state << 4) + posState) == 0:
+					state = 9 if state < 7 else 11
+					out.append(out[-rep0 - 1])
+					continue
+			else:
+				if rc.decodeBit(isRepG1, state) == 0:
+					distance = rep1
+				else:
+					if rc.decodeBit(isRepG2, state) == 0:
+						distance = rep2
+					else:
+						distance = rep3
+						rep3 = rep2
+					rep2 = rep1
+				rep1 = rep0
+				rep0 = distance
+			length = repLenDecoder.decode(rc, posState)
+			state = 8 if state < 7 else 11
+		else:
+			(rep3, rep2, rep1) = (rep2, rep1, rep0)
+			length = lenDecoder.decode(rc, posState)
+			state = 7 if state < 7 else 10
+
+			slot = rc.decodeTree(posSlot, min(length, NUM_LEN_TO_POS_STATES - 1) << 6, 6)
+			if slot < START_POS_MODEL_INDEX:
+				rep0 = slot
+			else:
+				directBits = (slot >> 1) - 1
+				rep0 = (2 | (slot & 1)) << directBits
+				if slot < END_POS_MODEL_INDEX:
+					rep0 += rc.decodeReverseTree(posSpecial, rep0 - slot - 1, directBits)
+				else:
+					rep0 += rc.decodeDirectBits(directBits - NUM_ALIGN_BITS) << NUM_ALIGN_BITS
+					rep0 += rc.decodeReverseTree(align, -1, NUM_ALIGN_BITS)
+					if rep0 == 0xFFFFFFFF:
+						#End marker
+						if sizeKnown and len(out) != uncompressedSize:
+							raise ValueError("LZMA end marker before the declared size")
+						break
+
+			if rep0 >= dictSize or rep0 >= len(out):
+				raise ValueError("LZMA match distance %u is out of range" % (rep0 + 1))
+
+		length += MATCH_MIN_LEN
+		if sizeKnown and len(out) + length > uncompressedSize:
+			raise ValueError("LZMA data exceeds the declared size of %u bytes" % uncompressedSize)
+
+		start = len(out) - rep0 - 1
+		if rep0 + 1 >= length:
+			out += out[start:start+length]
+		else:
+			pattern = out[start:]
+			out += (pattern * (length // len(pattern) + 1))[:length]
+
+	return str(out)
+
+def DecompressNative(buf):
+	"""Decodes with the lzma or pylzma module, returns None when neither is available"""
+	if lzma is not None:
+		return lzma.decompress(str(buf), format=lzma.FORMAT_ALONE)
+	if pylzma is not None:
+		(lc, lp, pb, dictSize, uncompressedSize) = ParseHeader(buf)
+		#pylzma expects the properties without the 64 bit size field
+		return pylzma.decompress(str(buf[0:5]) + str(buf[HEADER_LENGTH:]), maxlength=uncompressedSize)
+	return None
+
+def DecompressBinary(buf, binary):
+	"""Decodes with EDK2's LzmaCompress binary in a private temporary directory"""
+	Stats.count("LZMA decoder", "binary")
+	tmpdir = tempfile.mkdtemp(prefix="efipwn-lzma-")
+	try:
+		extractIn = os.path.join(tmpdir, "extractIn")
+		extractOut = os.path.join(tmpdir, "extractOut")
+		tmpfileIn = open(extractIn, "wb")
+		tmpfileIn.write(buf)
+		tmpfileIn.close()
+
+		fnull = open(os.devnull, 'w')
+		with Stats.timer("lzma.subprocess"):
+			subprocess.check_call([binary, "-d", extractIn, "-o", extractOut], stdout = fnull, stderr = fnull)
+		fnull.close()
+
+		tmpfileOut = open(extractOut, "rb")
+		result = tmpfileOut.read()
+		tmpfileOut.close()
+		return result
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+
+def _decompressPython(buf):
+	global _warnedPython
+	if not _warnedPython:
+		_warnedPython = True
+		logger.warning("No lzma, backports.lzma or pylzma module found, LZMA sections are decoded in pure python "
+			"(about 0.1 MB/s). Install one of them or pass --lzma-binary.")
+	Stats.count("LZMA decoder", "python")
+	return DecompressPython(buf)
+
+def Decompress(buf):
+	"""Decompresses the content of an LZMA GUID defined section (EDK2 format: properties,
+	dictionary size and 64 bit uncompressed size followed by the LZMA stream).
+
+	The lzma or pylzma module is used if installed, LZMA_BINARY (if set) otherwise, and
+	the slow pure python decoder last. LZMA_BINARY also takes the sections the
+	in-process decoders fail on."""
+	if lzma is None and pylzma is None:
+		if LZMA_BINARY is None:
+			return _decompressPython(buf)
+		try:
+			return DecompressBinary(buf, LZMA_BINARY)
+		except (OSError, subprocess.CalledProcessError) as e:
+			logger.warning("%s failed (%s), decoding in pure python", LZMA_BINARY, e)
+			return _decompressPython(buf)
+
+	try:
+		result = DecompressNative(buf)
+		Stats.count("LZMA decoder", "native")
+		return result
+	except Exception as e:
+		if LZMA_BINARY is None:
+			raise
+		logger.warning("In-process LZMA decoding failed (%s), falling back to %s", e, LZMA_BINARY)
+		return DecompressBinary(buf, LZMA_BINARY)
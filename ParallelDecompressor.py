@@ -0,0 +1,70 @@
+import logging
+import traceback
+import multiprocessing
+import EFI
+import Stats
+
+logger = logging.getLogger(__name__)
+
+def _decompress(job):
+	"""Runs in a worker process. Failures are reported back instead of raised, the
+	section then stays undecoded and fails again (with a fallback) on first access."""
+	(decompressor, payload) = job
+	try:
+		return (True, decompressor(payload))
+	except Exception:
+		return (False, traceback.format_exc())
+
+def _decompressed(section):
+	return not isinstance(section, EFI.EfiEncapsulationSection) or section.pendingDecompression() is None
+
+def _children(section):
+	if isinstance(section, EFI.EfiFirmwareVolumeSection):
+		return [s for v in section.SubFirmware.firmwareVolumes for f in v.files for s in f.subsections]
+	return section.Subsections
+
+def DecompressTree(image, jobs):
+	"""Decompresses all compressed and GUID defined sections of image on a pool of
+	jobs processes. The tree is processed one nesting level at a time: all pending
+	payloads of a level are decompressed in parallel and stored back into their
+	sections in image order, which makes the next level parseable."""
+	pool = multiprocessing.Pool(jobs)
+	try:
+		level = [s for v in image.firmwareVolumes for f in v.files for s in f.subsections]
+		while level:
+			pending = []
+			for section in level:
+				if not isinstance(section, EFI.EfiEncapsulationSection):
+					continue
+				decompression = section.pendingDecompression()
+				if decompression is None:
+					continue
+				if not section.Decoder.WorkerSafe:
+					#Decoded in-process, through the cache as well
+					section.UncompressedData
+					continue
+				(algorithm, decompressor, payload) = decompression
+				if EFI.DECOMPRESSION_CACHE is not None:
+					data = EFI.DECOMPRESSION_CACHE.get(algorithm, payload)
+					if data is not None:
+						section.setUncompressedData(data)
+						continue
+				pending.append((section, algorithm, decompressor, payload))
+
+			logger.debug("Decompressing %u sections on %u processes", len(pending), jobs)
+			with Stats.timer("decompress.parallel"):
+				results = pool.map(_decompress, [(decompressor, str(payload)) for (section, algorithm, decompressor, payload) in pending], 1)
+			for ((section, algorithm, decompressor, payload), (success, result)) in zip(pending, results):
+				if not success:
+					logger.warning("Decompressing a %s section failed in a worker process:\n%s", algorithm, result)
+					continue
+				section.setUncompressedData(result)
+				Stats.add("decompress.%s.in" % algorithm, len(payload))
+				Stats.add("decompress.%s.out" % algorithm, len(result))
+				if EFI.DECOMPRESSION_CACHE is not None:
+					EFI.DECOMPRESSION_CACHE.put(algorithm, payload, result)
+
+			level = [child for section in level if _decompressed(section) for child in _children(section)]
+	finally:
+		pool.close()
+		pool.join()
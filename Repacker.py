@@ -0,0 +1,333 @@
+import uuid
+import struct
+import logging
+
+import EFI
+import Stats
+from GuidIndex import GuidIndex
+
+logger = logging.getLogger(__name__)
+
+SECTIONTYPES = EFI.EfiSection.EFI_SECTIONTYPES
+FILETYPES = EFI.EfiFile.EFI_FILETYPES
+
+FFS_HEADER_LENGTH = 24
+FFS_ATTRIB_CHECKSUM = 0x40
+FFS_ATTRIB_DATA_ALIGNMENT = 0x38
+FFS_FIXED_CHECKSUM = 0xAA
+FFS_MAX_SIZE = 0xFFFFFF
+#The data alignments FFS_ATTRIB_DATA_ALIGNMENT encodes
+FFS_ALIGNMENTS = [1, 16, 128, 512, 1024, 4 * 1024, 32 * 1024, 64 * 1024]
+PAD_GUID = uuid.UUID('ffffffff-ffff-ffff-ffff-ffffffffffff')
+FV_LENGTH_OFFSET = 32
+#The block map follows the fixed part of the FV header, it ends with a (0, 0) entry
+FV_BLOCK_MAP_OFFSET = EFI.FV_HEADER_LENGTH
+
+def Align(offset, alignment):
+	return (offset + alignment - 1) // alignment * alignment
+
+def Checksum8(data):
+	"""The byte that makes the 8 bit sum of data and itself zero"""
+	return (-EFI.Sum8(data)) & 0xFF
+
+def Checksum16(data):
+	"""The word that makes the 16 bit sum of the little endian words of data and itself zero"""
+	return (-EFI.Sum16(data)) & 0xFFFF
+
+def SectionHeader(sectionType, length):
+	if length > FFS_MAX_SIZE:
+		raise ValueError("Sections of 0x%X bytes need an extended header, which is not supported" % length)
+	return struct.pack("<I", length)[0:3] + chr(sectionType)
+
+def MakeSection(sectionType, content):
+	"""Returns a section node of sectionType holding content (without the header)"""
+	content = str(content)
+	return EFI.InstantiateSectionFromType(sectionType, SectionHeader(sectionType, 4 + len(content)) + content)
+
+def FileHeader(guid, fileType, attributes, state, body, dataChecksum=FFS_FIXED_CHECKSUM):
+	"""Returns the FFS file header for body with both checksums computed. The data
+	checksum is only computed if FFS_ATTRIB_CHECKSUM is set, dataChecksum is used
+	otherwise."""
+	length = FFS_HEADER_LENGTH + len(body)
+	if length > FFS_MAX_SIZE:
+		raise ValueError("File %s is 0x%X bytes, large files are not supported" % (guid, length))
+	header = bytearray(guid.bytes_le + "\0\0" + chr(fileType) + chr(attributes) + struct.pack("<I", length)[0:3] + chr(state))
+	#The header checksum covers the header without the data checksum and the state
+	header[16] = Checksum8(header[0:23])
+	if attributes & FFS_ATTRIB_CHECKSUM:
+		header[17] = Checksum8(body)
+	else:
+		header[17] = dataChecksum
+	return str(header)
+
+def ParseFile(data):
+	"""Returns an EfiFile node for the FFS file (header and data) in data"""
+	data = str(data)
+	(guid, checksum, fileType, attributes, length, state) = struct.unpack_from("<16sHBB3sB", data)
+	length = struct.unpack("<I", length + '\0')[0]
+	if length < FFS_HEADER_LENGTH or length > len(data):
+		raise ValueError("Not an FFS file: length 0x%X, 0x%X bytes given" % (length, len(data)))
+	return EFI.EfiFile(0, length - FFS_HEADER_LENGTH, guid, fileType, attributes, state, EFI.BufferView(data, FFS_HEADER_LENGTH, length - FFS_HEADER_LENGTH), checksum)
+
+def FileAlignment(attributes):
+	return FFS_ALIGNMENTS[(attributes & FFS_ATTRIB_DATA_ALIGNMENT) >> 3]
+
+def IsNestedVolume(volume):
+	"""True for volumes inside a firmware volume image section, their size may change"""
+	return volume.Parent is not None and volume.Parent.Parent is not None
+
+def GrowVolumeHeader(header, length):
+	"""Adds blocks of the size of the last block map entry to the FV header (a
+	bytearray) until the volume holds length bytes and updates FvLength. Returns the
+	new length of the volume."""
+	entry = None
+	offset = FV_BLOCK_MAP_OFFSET
+	while offset + 8 <= len(header):
+		if struct.unpack_from("<II", header, offset) == (0, 0):
+			break
+		entry = offset
+		offset += 8
+	if entry is None:
+		raise ValueError("The firmware volume header has no block map")
+	(blocks, blockLength) = struct.unpack_from("<II", header, entry)
+	if blockLength == 0:
+		raise ValueError("The block map of the firmware volume has a block length of 0")
+
+	(current,) = struct.unpack_from("<Q", header, FV_LENGTH_OFFSET)
+	added = max(length - current + blockLength - 1, 0) // blockLength
+	header[entry:entry+8] = struct.pack("<II", blocks + added, blockLength)
+	header[FV_LENGTH_OFFSET:FV_LENGTH_OFFSET+8] = struct.pack("<Q", current + added * blockLength)
+	return current + added * blockLength
+
+class Repacker(EFI.EfiNodeVisitor):
+	"""Serializes a (modified) tree back into an image. visit() returns the bytes of
+	the visited node.
+
+	Only dirty nodes (see EfiElement.markDirty) are rebuilt from their children,
+	the bytes of all others are copied. Rebuilding recomputes section and file
+	lengths, FFS header and data checksums and FV header checksums and lays out
+	files with their alignment, with pad files where needed. Compressed and GUID
+	defined sections are only compressed again if their content changed. Top level
+	volumes keep their length and position, nested volumes grow by whole blocks
+	when their files need more room.
+
+	With full set, every node is rebuilt, which decompresses everything. Unmodified
+	images come out byte identical either way."""
+	def __init__(self, full=False):
+		self.Full = full
+		self.Recompressed = 0
+		self.FilesRebuilt = 0
+		self.VolumesRebuilt = 0
+
+	def _rebuild(self, node):
+		return self.Full or (node.Dirty and node.IsExpanded)
+
+	def generic_visit(self, node):
+		logger.error("Unrecognized node: %s " % (type(node).__name__))
+		raise Exception("Unrecognized node: %s " % (type(node).__name__))
+
+	def sections(self, sections):
+		"""Returns the 4 byte aligned sections serialized one after the other"""
+		data = ""
+		for s in sections:
+			if len(data) % 4:
+				data += "\0" * (4 - len(data) % 4)
+			data += self.visit(s)
+		return data
+
+	def visit_EfiFirmwareImage(self, node):
+		data = node.stream.Data
+		if not self._rebuild(node):
+			return str(data[0:node.length])
+
+		#Nested volumes may have grown, the bytes after them move along
+		image = []
+		position = 0
+		for v in node.firmwareVolumes:
+			volume = self.visit(v)
+			if len(volume) != v.HeaderLength + v.DataLength and not IsNestedVolume(v):
+				raise ValueError("The firmware volume at 0x%X changed its length" % v.Base)
+			image.append(str(data[position:v.Base]))
+			image.append(volume)
+			position = v.Base + v.HeaderLength + v.DataLength
+		image.append(str(data[position:node.length]))
+		return "".join(image)
+
+	def visit_EfiFirmwareVolume(self, node):
+		data = node.stream.Data
+		length = node.HeaderLength + node.DataLength
+		if not self._rebuild(node):
+			return str(data[node.Base:node.Base+length])
+
+		start = node.Base + node.HeaderLength
+		erase = chr(node.ErasePolarity)
+		#Where the files of the volume ended, the free space (or whatever else) after it is kept
+		filesEnd = max([0] + [f.Base + FFS_HEADER_LENGTH + f.Length for (base, f) in node.iterChildren()])
+
+		content = bytearray()
+		lastPad = None
+		for f in node.files:
+			body = self.visit(f)
+			if (start + len(content)) % 8:
+				content += erase * (8 - (start + len(content)) % 8)
+
+			alignment = FileAlignment(f.Attributes)
+			offset = node.HeaderLength + len(content)
+			if (offset + FFS_HEADER_LENGTH) % alignment:
+				#Move the file to the next aligned offset with room for a pad file in front of
+				#it, replacing a pad file right before it
+				if lastPad is not None:
+					del content[lastPad:]
+					offset = node.HeaderLength + len(content)
+				aligned = offset + (-(offset + FFS_HEADER_LENGTH)) % alignment
+				while 0 < aligned - offset < FFS_HEADER_LENGTH:
+					aligned += alignment
+				if aligned > offset:
+					content += self._padFile(node, aligned - offset)
+
+			lastPad = len(content) if f.Type == FILETYPES.EFI_FV_FILETYPE_FFS_PAD else None
+			content += body
+
+		header = bytearray(data[node.Base:start])
+		dataLength = node.DataLength
+		if len(content) > dataLength:
+			if not IsNestedVolume(node):
+				raise ValueError("The files of the firmware volume at 0x%X need 0x%X bytes, it only has 0x%X" % (node.Base, len(content), node.DataLength))
+			dataLength = GrowVolumeHeader(header, node.HeaderLength + len(content)) - node.HeaderLength
+			logger.debug("Growing the nested firmware volume at 0x%X from 0x%X to 0x%X bytes", node.Base, node.HeaderLength + node.DataLength, node.HeaderLength + dataLength)
+		if len(content) < filesEnd:
+			content += erase * (filesEnd - len(content))
+		content += data[start+len(content):start+node.DataLength]
+		content += erase * (dataLength - len(content))
+
+		header[EFI.FV_CHECKSUM_OFFSET:EFI.FV_CHECKSUM_OFFSET+2] = "\0\0"
+		header[EFI.FV_CHECKSUM_OFFSET:EFI.FV_CHECKSUM_OFFSET+2] = struct.pack("<H", Checksum16(header))
+		self.VolumesRebuilt += 1
+		return str(header + content)
+
+	def _padFile(self, volume, length):
+		state = 0xF8 if volume.ErasePolarity else 0x07
+		body = chr(volume.ErasePolarity) * (length - FFS_HEADER_LENGTH)
+		return FileHeader(PAD_GUID, FILETYPES.EFI_FV_FILETYPE_FFS_PAD, 0, state, body) + body
+
+	def visit_EfiFile(self, node):
+		if not self.Full and not node.Dirty and node.Checksum is not None:
+			return node.Guid.bytes_le + struct.pack("<HBB", node.Checksum, node.Type, node.Attributes) + struct.pack("<I", FFS_HEADER_LENGTH + node.Length)[0:3] + chr(node.State) + str(node.Data)
+
+		if node.HasSections and self._rebuild(node):
+			body = self.sections(node.subsections)
+		else:
+			body = str(node.Data)
+
+		dataChecksum = FFS_FIXED_CHECKSUM if node.Checksum is None else node.Checksum >> 8
+		self.FilesRebuilt += 1
+		return FileHeader(node.Guid, node.Type, node.Attributes, node.State, body, dataChecksum) + body
+
+	def _leaf(self, node):
+		return str(node.Data)
+
+	visit_EfiGenericSection = _leaf
+	visit_EfiVersionSection = _leaf
+	visit_EfiUserInterfaceSection = _leaf
+	visit_EfiFreeformSubtypeGuidSection = _leaf
+
+	def _changedContent(self, node):
+		"""Returns the serialized subsections of an encapsulation section if they differ
+		from its decoded content, None otherwise"""
+		if not self._rebuild(node):
+			return None
+		content = self.sections(node.Subsections)
+		if content == str(node.UncompressedData):
+			return None
+		self.Recompressed += 1
+		return content
+
+	def visit_EfiCompressedSection(self, node):
+		content = self._changedContent(node)
+		if content is None:
+			return str(node.Data)
+
+		if node.CompressionType == 0:
+			payload = content
+		elif node.Decoder is not None:
+			payload = self._encode(node.Decoder, content)
+		else:
+			raise ValueError("Cannot compress with CompressionType %u" % node.CompressionType)
+		return SectionHeader(node.SectionType, 4 + 4 + 1 + len(payload)) + struct.pack("<IB", len(content), node.CompressionType) + payload
+
+	def visit_EfiGuidDefinedSection(self, node):
+		content = self._changedContent(node)
+		if content is None:
+			return str(node.Data)
+
+		if node.Decoder is None:
+			raise ValueError("Cannot encode GUID defined sections of type %s" % node.Guid)
+		payload = self._encode(node.Decoder, content)
+		#Keep the GUID specific header data between the header and DataOffset
+		header = str(node.Data[4:max(node.DataOffset, 4 + 16 + 2 + 2)])
+		return SectionHeader(node.SectionType, 4 + len(header) + len(payload)) + header + payload
+
+	def _encode(self, decoder, content):
+		if decoder.Encode is None:
+			raise ValueError("Cannot encode %s sections" % decoder.Name)
+		with Stats.timer("compress." + decoder.Name):
+			return decoder.Encode(content)
+
+	def visit_EfiFirmwareVolumeSection(self, node):
+		if not self._rebuild(node):
+			return str(node.Data)
+		volume = self.visit(node.SubFirmware)
+		return SectionHeader(node.SectionType, 4 + len(volume)) + volume
+
+def Repack(image, full=False):
+	"""Returns the bytes of the (modified) image, see Repacker"""
+	return Repacker(full).visit(image)
+
+def Update(image):
+	"""Repacks image and switches it to the result, parsing only the modified volumes
+	again (see EfiFirmwareImage.reload). Returns the new bytes."""
+	data = Repack(image)
+	image.reload(data)
+	return data
+
+def FindFile(image, guid):
+	"""Returns (files, index) of a file named guid, files being the list of the
+	volume holding it. Only decompresses what is needed to find it, see GuidIndex."""
+	index = GuidIndex(image)
+	files = [node for (node, path) in index.lookup(guid) if isinstance(node, EFI.EfiFile)]
+	if not files:
+		files = [node for (node, path) in index.lookupAll(guid) if isinstance(node, EFI.EfiFile)]
+	if not files:
+		raise KeyError("No file %s in the image" % guid)
+	volumeFiles = files[0].Parent.files
+	return (volumeFiles, volumeFiles.index(files[0]))
+
+def _replace(nodes, index, node):
+	node.Parent = nodes[index].Parent
+	nodes[index] = node
+	node.markDirty()
+
+def ReplaceFile(image, guid, newFile):
+	"""Replaces the file named guid with the EfiFile newFile"""
+	(files, index) = FindFile(image, guid)
+	_replace(files, index, newFile)
+
+def _findSection(sections, sectionType):
+	for (index, s) in enumerate(sections):
+		if s.SectionType == sectionType:
+			return (sections, index)
+		if isinstance(s, EFI.EfiEncapsulationSection):
+			found = _findSection(s.Subsections, sectionType)
+			if found is not None:
+				return found
+	return None
+
+def ReplaceSection(image, guid, sectionType, content):
+	"""Replaces the content of the first section of sectionType in the file named
+	guid, looking into compressed and GUID defined sections"""
+	(files, index) = FindFile(image, guid)
+	found = _findSection(files[index].subsections, sectionType)
+	if found is None:
+		raise KeyError("File %s has no section of type 0x%02x" % (guid, sectionType))
+	(sections, index) = found
+	_replace(sections, index, MakeSection(sectionType, content))
@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import zlib
+import uuid
+import struct
+import hashlib
+import logging
+import tempfile
+
+import EFI
+from TreePrinter import indent, NodeFields
+
+logger = logging.getLogger(__name__)
+
+#The index of IMAGE is stored as IMAGE + INDEX_SUFFIX
+INDEX_SUFFIX = ".efipwn-index"
+#Bump when the records change, older indices are rebuilt
+INDEX_VERSION = 2
+
+IMAGE_BUFFER = -1
+
+def IndexPath(path):
+	return path + INDEX_SUFFIX
+
+def ImageHash(data):
+	h = hashlib.sha256()
+	h.update(data)
+	return h.hexdigest()
+
+def BuildIndex(image, imageHash):
+	"""Returns the index of a parsed image: one record per volume, file and section
+	in the order print shows them. A record holds the fields of the JSON records of
+	print (see TreePrinter.NodeFields), its parent and depth and the offset of the
+	node like EFI.CachedChildren returns it: behind the header of its parent, or in
+	the decoded content if the parent is an encapsulation section."""
+	records = []
+	_index(records, image, None, 0)
+	return {"version": INDEX_VERSION, "sha256": imageHash, "nodes": records}
+
+def _index(records, node, parent, depth):
+	for (offset, child) in EFI.CachedChildren(node):
+		number = len(records)
+		record = NodeFields(child)
+		record["parent"] = parent
+		record["depth"] = depth
+		record["offset"] = offset
+		records.append(record)
+		_index(records, child, number, depth + 1)
+
+def RecordText(record):
+	"""Returns what str() returns for the node of record"""
+	if record["kind"] == "volume":
+		result = "EFI_FIRMWARE_VOLUME:\n"
+		result += "\tBase Offset: 0x%08x\n" % record["offset"]
+		result += "\tHeader Length: 0x%x\n" % record["headerLength"]
+		result += "\tData Length: 0x%08x\n" % (record["length"] - record["headerLength"])
+		result += "\tTotal Length: 0x%08x\n" % record["length"]
+		result += "\tSignature: %s\n" % record["signature"]
+		result += "\tAttributes: 0x%04x\n" % record["attributes"]
+		return result
+	if record["kind"] == "file":
+		result = "EFI_FIRMWARE_FILE:\n"
+		result += "\tBase Offset: 0x%08x\n" % record["offset"]
+		result += "\tLength: 0x%08x\n" % (record["length"] - 24)
+		result += "\tGUID: 0x%s\n" % record["guid"]
+		result += "\tType: %s (0x%02x)\n" % (record["typeName"], record["type"])
+		result += "\tAttributes: 0x%02x\n" % record["attributes"]
+		result += "\tState: 0x%x\n" % record["state"]
+		return result
+
+	result = "EFI_FIRMWARE_SECTION:\n"
+	result += "\tType: %s (0x%02x)\n" % (record["typeName"], record["type"])
+	result += "\tLength: 0x%08x\n" % record["length"]
+	#Sections print the fields of the class registered for their type
+	cls = EFI.SECTION_CLASSES.get(record["type"], EFI.EfiGenericSection)
+	if issubclass(cls, EFI.EfiCompressedSection):
+		result += "\tCompressionType: %u\n" % record["compressionType"]
+		result += "\tUncompressedDataLength: %08x\n" % record["decodedLength"]
+	elif issubclass(cls, EFI.EfiVersionSection):
+		result += "\tVersionString: %s\n" % record["version"]
+	elif issubclass(cls, EFI.EfiUserInterfaceSection):
+		result += "\tString: %s\n" % record["name"]
+	elif issubclass(cls, EFI.EfiFreeformSubtypeGuidSection):
+		result += "\tGUID: %s\n" % record["guid"]
+		result += "\tDataLength (including full header): 0x%08x\n" % record["length"]
+	elif issubclass(cls, EFI.EfiGuidDefinedSection):
+		result += "\tGUID: %s\n" % record["guid"]
+		result += "\tDataLength: 0x%08x\n" % (record["length"] - 24)
+		result += "\tDataOffset: 0x%04x\n" % record["dataOffset"]
+		result += "\tAttributes: 0x%04x\n" % record["attributes"]
+	return result
+
+def LoadIndex(path, data):
+	"""Returns the index stored next to the image path if it belongs to data, the
+	content of the image, None otherwise"""
+	try:
+		f = open(IndexPath(path), "rb")
+	except IOError:
+		return None
+	try:
+		index = json.loads(zlib.decompress(f.read()))
+	except (ValueError, zlib.error):
+		logger.warning("Ignoring the unreadable index %s", IndexPath(path))
+		return None
+	finally:
+		f.close()
+
+	if index.get("version") != INDEX_VERSION or index.get("sha256") != ImageHash(data):
+		logger.info("The index %s is outdated", IndexPath(path))
+		return None
+	return index
+
+def SaveIndex(path, index):
+	"""Stores index next to the image path. Returns False if that is not possible,
+	e.g. in a read-only directory."""
+	directory = os.path.dirname(os.path.abspath(path))
+	try:
+		(fd, tmppath) = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=INDEX_SUFFIX)
+	except OSError as e:
+		logger.warning("Cannot write the index of %s: %s", path, e)
+		return False
+
+	try:
+		f = os.fdopen(fd, "wb")
+		f.write(zlib.compress(json.dumps(index, separators=(",", ":")), 9))
+		f.close()
+		os.rename(tmppath, IndexPath(path))
+	except (OSError, IOError) as e:
+		logger.warning("Cannot write the index of %s: %s", path, e)
+		try:
+			os.unlink(tmppath)
+		except OSError:
+			pass
+		return False
+	return True
+
+class IndexedImage(object):
+	"""Answers queries on an image from its index. Nodes are only parsed when asked
+	for with node(), which decodes just the encapsulation sections above them."""
+	def __init__(self, index, data):
+		self.Index = index
+		self.Nodes = index["nodes"]
+		self.Data = data
+		self._buffers = {}
+		self._guids = None
+
+	def buffer(self, number):
+		if number == IMAGE_BUFFER:
+			return self.Data
+		if number not in self._buffers:
+			self._buffers[number] = self.node(number).UncompressedData
+		return self._buffers[number]
+
+	def position(self, number):
+		"""Returns (buffer, offset): the buffer record number is in, IMAGE_BUFFER or
+		the number of the encapsulation section whose decoded content holds it, and
+		its offset there"""
+		record = self.Nodes[number]
+		parent = record["parent"]
+		if parent is None:
+			return (IMAGE_BUFFER, record["offset"])
+		if self.Nodes[parent].get("encapsulation"):
+			return (parent, record["offset"])
+		(buf, offset) = self.position(parent)
+		return (buf, offset + self.Nodes[parent]["headerLength"] + record["offset"])
+
+	def node(self, number):
+		"""Returns the EFI node of record number"""
+		record = self.Nodes[number]
+		(buf, offset) = self.position(number)
+		data = self.buffer(buf)
+		if record["kind"] == "volume":
+			if record["parent"] is not None:
+				#Nested volumes are parsed from the content of their firmware volume image section
+				parent = self.Nodes[record["parent"]]
+				data = EFI.BufferView(data, offset - record["offset"], parent["length"] - parent["headerLength"])
+				offset = record["offset"]
+			(zero, guid, length, sig, attrib, headerlength, checksum, reserved, revision) = struct.unpack_from(EFI.FV_HEADER_FORMAT, data, offset)
+			return EFI.EfiFirmwareVolume(offset, headerlength, length - headerlength, sig, attrib, EFI.BufferStream(data))
+		if record["kind"] == "file":
+			(guid, checksum, fileType, attributes, length, state) = struct.unpack_from("<16sHBB3sB", data, offset)
+			return EFI.EfiFile(record["offset"], record["length"] - 24, guid, fileType, attributes, state, EFI.BufferView(data, offset + 24, record["length"] - 24), checksum)
+		return EFI.InstantiateSectionFromType(record["type"], EFI.BufferView(data, offset, record["length"]))
+
+	def path(self, number):
+		"""Returns the record numbers from the top level volume down to record number"""
+		result = []
+		while number is not None:
+			result.append(number)
+			number = self.Nodes[number]["parent"]
+		return list(reversed(result))
+
+	def nodePath(self, number):
+		return [self.node(n) for n in self.path(number)]
+
+	def lookup(self, guid):
+		"""Returns the numbers of the records with guid, files as well as sections"""
+		if self._guids is None:
+			self._guids = {}
+			for (number, record) in enumerate(self.Nodes):
+				if "guid" in record:
+					self._guids.setdefault(uuid.UUID(record["guid"]), []).append(number)
+		return self._guids.get(guid, [])
+
+class IndexPrinter(object):
+	"""Prints the same output as EfiTreePrintVisitor from an index"""
+	def __init__(self, maxDepth=None, decompress=True, output=None):
+		self.output = output if output is not None else sys.stdout
+		self.maxDepth = maxDepth
+		self.decompress = decompress
+
+	def process(self, index):
+		#Records below a node which is not descended into are skipped up to the next
+		#record at its depth or above. Volumes are at depth 0 and the first of the
+		#maxDepth levels printed.
+		if self.maxDepth is not None and self.maxDepth < 1:
+			return
+		skipBelow = None
+		for record in index["nodes"]:
+			depth = record["depth"]
+			if skipBelow is not None:
+				if depth > skipBelow:
+					continue
+				skipBelow = None
+			print >>self.output, indent(RecordText(record), depth * 10)
+			if self.maxDepth is not None and depth + 1 >= self.maxDepth:
+				skipBelow = depth
+			elif not self.decompress and record.get("encapsulation"):
+				skipBelow = depth
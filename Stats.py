@@ -0,0 +1,109 @@
+import time
+import json
+import threading
+
+#The Statistics instance everything reports to, None while statistics are disabled.
+#Callers check it before doing any work, so disabled statistics cost one global
+#lookup per instrumented call.
+STATS = None
+
+def Enable():
+	"""Starts collecting into a new Statistics instance and returns it"""
+	global STATS
+	STATS = Statistics()
+	return STATS
+
+def Disable():
+	global STATS
+	STATS = None
+
+class _NullTimer(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+_nullTimer = _NullTimer()
+
+class _Timer(object):
+	def __init__(self, stats, name):
+		self.stats = stats
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		self.stats.addTime(self.name, time.time() - self.start)
+		return False
+
+def timer(name):
+	"""Context manager adding the time spent in it to the timer name"""
+	if STATS is None:
+		return _nullTimer
+	return _Timer(STATS, name)
+
+def add(name, value=1):
+	if STATS is not None:
+		STATS.add(name, value)
+
+def count(group, key, value=1):
+	if STATS is not None:
+		STATS.count(group, key, value)
+
+class Statistics(object):
+	"""Named timers (call count and seconds), counters and groups of counters keyed
+	by e.g. section type or GUID. Safe to use from several threads."""
+	def __init__(self):
+		self.Start = time.time()
+		self.Timers = {}
+		self.Counters = {}
+		self.Groups = {}
+		self._lock = threading.Lock()
+
+	def addTime(self, name, seconds):
+		with self._lock:
+			entry = self.Timers.setdefault(name, [0, 0.0])
+			entry[0] += 1
+			entry[1] += seconds
+
+	def add(self, name, value=1):
+		with self._lock:
+			self.Counters[name] = self.Counters.get(name, 0) + value
+
+	def count(self, group, key, value=1):
+		with self._lock:
+			counters = self.Groups.setdefault(group, {})
+			counters[key] = counters.get(key, 0) + value
+
+	def toDict(self):
+		return {
+			"total": time.time() - self.Start,
+			"timers": dict((name, {"calls": calls, "seconds": seconds}) for (name, (calls, seconds)) in self.Timers.iteritems()),
+			"counters": self.Counters,
+			"groups": self.Groups,
+		}
+
+	def toJson(self):
+		return json.dumps(self.toDict(), indent=2, sort_keys=True)
+
+	def __str__(self):
+		total = time.time() - self.Start
+		result = "Total: %.4fs\n" % total
+		result += "Timers (nested timers are included in their parents):\n"
+		for (name, (calls, seconds)) in sorted(self.Timers.iteritems(), key=lambda entry: -entry[1][1]):
+			result += "\t%-28s %10.4fs %6.1f%% %8u calls\n" % (name, seconds, seconds * 100 / total if total else 0.0, calls)
+		if self.Counters:
+			result += "Counters:\n"
+			for (name, value) in sorted(self.Counters.iteritems()):
+				result += "\t%-28s %12u\n" % (name, value)
+		for (group, counters) in sorted(self.Groups.iteritems()):
+			result += "%s:\n" % group
+			for (key, value) in sorted(counters.iteritems(), key=lambda entry: -entry[1]):
+				if isinstance(value, float):
+					result += "\t%-40s %10.4fs\n" % (key, value)
+				else:
+					result += "\t%-40s %10u\n" % (key, value)
+		return result
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import sys
+import uuid
+import random
+import struct
+import logging
+import argparse
+
+import EFI
+import EfiCompressor
+import LzmaCompressor
+
+logger = logging.getLogger(__name__)
+
+FILETYPES = EFI.EfiFile.EFI_FILETYPES
+SECTIONTYPES = EFI.EfiSection.EFI_SECTIONTYPES
+
+PAD_GUID = uuid.UUID('ffffffff-ffff-ffff-ffff-ffffffffffff')
+FV_ATTRIBUTES = 0x0004feff
+FV_BLOCK_SIZE = 0x1000
+
+def Align(data, alignment, fill):
+	if len(data) % alignment:
+		data += fill * (alignment - len(data) % alignment)
+	return data
+
+def Section(sectionType, body):
+	return struct.pack("<I", 4 + len(body))[0:3] + chr(sectionType) + body
+
+def Sections(sections):
+	"""Concatenates sections with the 4 byte alignment EfiFile and EfiSection expect"""
+	data = ""
+	for s in sections:
+		data = Align(data, 4, "\0")
+		data += s
+	return data
+
+def UserInterfaceSection(string):
+	return Section(SECTIONTYPES.EFI_SECTION_USER_INTERFACE, string.encode("utf-16-le") + "\0\0")
+
+def VersionSection(string, buildNumber=0):
+	return Section(SECTIONTYPES.EFI_SECTION_VERSION, struct.pack("<H", buildNumber) + string.encode("utf-16-le") + "\0\0")
+
+def FreeformSubtypeGuidSection(guid, body):
+	return Section(SECTIONTYPES.EFI_SECTION_FREEFORM_SUBTYPE_GUID, guid.bytes_le + body)
+
+def CompressedSection(sections, compress=True):
+	"""An EFI_SECTION_COMPRESSION, Tiano compressed unless compress is False"""
+	payload = Sections(sections)
+	if compress:
+		return Section(SECTIONTYPES.EFI_SECTION_COMPRESSION, struct.pack("<IB", len(payload), 1) + EfiCompressor.Compress(payload))
+	return Section(SECTIONTYPES.EFI_SECTION_COMPRESSION, struct.pack("<IB", len(payload), 0) + payload)
+
+def GuidDefinedSection(guid, body, attributes=0):
+	return Section(SECTIONTYPES.EFI_SECTION_GUID_DEFINED, guid.bytes_le + struct.pack("<HH", 24, attributes) + body)
+
+def LzmaSection(sections):
+	return GuidDefinedSection(EFI.EFIGUIDS.FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED, LzmaCompressor.Compress(Sections(sections)), 1)
+
+def FirmwareVolumeSection(volume):
+	return Section(SECTIONTYPES.EFI_SECTION_FIRMWARE_VOLUME_IMAGE, volume)
+
+def FfsFile(guid, fileType, body, attributes=0x40):
+	"""An FFS file with valid header and data checksums (the data checksum is only
+	used if bit 6 of attributes is set)"""
+	header = bytearray(guid.bytes_le + "\0\0" + chr(fileType) + chr(attributes) + struct.pack("<I", 24 + len(body))[0:3] + chr(0xF8))
+	header[16] = (-(sum(header) - header[23])) & 0xFF
+	if attributes & 0x40:
+		header[17] = (-sum(bytearray(body))) & 0xFF
+	else:
+		header[17] = 0xAA
+	return str(header) + body
+
+def FirmwareVolume(files, size=None, blockSize=FV_BLOCK_SIZE, fileSystem=EFI.EFIGUIDS.FIRMWARE_VOLUME2):
+	"""A firmware volume (file system 2 unless fileSystem says otherwise) with a one
+	entry block map. The volume is padded with 0xFF to size or to the next multiple
+	of blockSize."""
+	headerLength = EFI.FV_HEADER_LENGTH + 8 + 8
+	data = ""
+	for f in files:
+		data = Align(data, 8, "\xff")
+		data += f
+	if size is None:
+		size = (headerLength + len(data) + blockSize - 1) // blockSize * blockSize
+	if headerLength + len(data) > size:
+		raise ValueError("%u bytes of files do not fit into a volume of %u bytes" % (len(data), size))
+
+	header = bytearray("\0" * 16 + fileSystem.bytes_le + struct.pack("<Q", size) + EFI.FV_SIGNATURE
+		+ struct.pack("<IHH", FV_ATTRIBUTES, headerLength, 0) + "\0\0\0" + chr(2)
+		+ struct.pack("<II", size // blockSize, blockSize) + struct.pack("<II", 0, 0))
+	checksum = sum(struct.unpack("<%uH" % (headerLength // 2), str(header))) & 0xFFFF
+	header[50:52] = struct.pack("<H", (-checksum) & 0xFFFF)
+	return str(header) + data + "\xff" * (size - headerLength - len(data))
+
+class SyntheticImage(object):
+	"""Builds a valid firmware image with files of every type in EfiFile.EFI_FILETYPES,
+	Tiano compressed, LZMA and other GUID defined sections and firmware volumes nested
+	in compressed sections. Drivers are added until the image reaches size bytes, the
+	content is reproducible for a given seed."""
+	def __init__(self, size=1024*1024, seed=0, compressedShare=0.3):
+		self.Size = size
+		self.CompressedShare = compressedShare
+		self._random = random.Random(seed)
+		self._driverCount = 0
+
+	def guid(self):
+		return uuid.UUID(int=self._random.getrandbits(128))
+
+	def blob(self, length):
+		"""Code-like data: compressible, but not trivially"""
+		r = self._random
+		return "".join(chr(r.choice([0, 0, 1, 0x48, 0x8b, 0xff, r.randrange(256)])) for i in xrange(length))
+
+	def driver(self, fileType=FILETYPES.EFI_FV_FILETYPE_DRIVER, maxLength=16384):
+		r = self._random
+		name = u"Driver%u" % self._driverCount
+		self._driverCount += 1
+		sections = [Section(SECTIONTYPES.EFI_SECTION_DXE_DEPEX, self.blob(20)), Section(SECTIONTYPES.EFI_SECTION_PE32, self.blob(r.randrange(256, maxLength))), UserInterfaceSection(name), VersionSection(u"1.0")]
+
+		if r.random() < self.CompressedShare:
+			if r.random() < 0.5:
+				sections = [LzmaSection(sections)]
+			else:
+				sections = [CompressedSection(sections)]
+		return FfsFile(self.guid(), fileType, Sections(sections))
+
+	def everyFileType(self):
+		"""One file of every type EfiFile knows"""
+		g = self.guid
+		return [
+			FfsFile(g(), FILETYPES.EFI_FV_FILETYPE_SECURITY_CORE, Sections([Section(SECTIONTYPES.EFI_SECTION_PE32, self.blob(600)), UserInterfaceSection(u"Sec")])),
+			FfsFile(g(), FILETYPES.EFI_FV_FILETYPE_PEI_CORE, Sections([Section(SECTIONTYPES.EFI_SECTION_TE, self.blob(300))])),
+			FfsFile(g(), FILETYPES.EFI_FV_FILETYPE_PEIM, Sections([Section(SECTIONTYPES.EFI_SECTION_PEI_DEPEX, self.blob(10)), Section(SECTIONTYPES.EFI_SECTION_PE32, self.blob(700))])),
+			FfsFile(g(), FILETYPES.EFI_FV_FILETYPE_DXE_CORE, Sections([Section(SECTIONTYPES.EFI_SECTION_PE32, self.blob(900))])),
+			self.driver(FILETYPES.EFI_FV_FILETYPE_DRIVER),
+			self.driver(FILETYPES.EFI_FV_FILETYPE_COMBINED_PEIM_DRIVER),
+			FfsFile(g(), FILETYPES.EFI_FV_FILETYPE_APPLICATION, Sections([CompressedSection([Section(SECTIONTYPES.EFI_SECTION_RAW, "x" * 16)], False), GuidDefinedSection(g(), self.blob(40))])),
+			FfsFile(g(), FILETYPES.EFI_FV_FILETYPE_FREEFORM, Sections([FreeformSubtypeGuidSection(g(), self.blob(50)), Section(SECTIONTYPES.EFI_SECTION_RAW, self.blob(60))])),
+			FfsFile(g(), FILETYPES.EFI_FV_FILETYPE_RAW, self.blob(333)),
+			FfsFile(PAD_GUID, FILETYPES.EFI_FV_FILETYPE_FFS_PAD, "\xff" * 100, attributes=0),
+		]
+
+	def nestedVolume(self, depth, length):
+		"""A FIRMWARE_VOLUME_IMAGE file with depth levels of volumes nested in
+		compressed sections and about length bytes of drivers in the innermost one"""
+		files = []
+		while sum(len(f) for f in files) < length:
+			files.append(self.driver(maxLength=4096))
+		volume = FirmwareVolume(files)
+		for level in xrange(depth):
+			if level % 2:
+				volume = FirmwareVolume([FfsFile(self.guid(), FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE, LzmaSection([FirmwareVolumeSection(volume)]))])
+			else:
+				volume = FirmwareVolume([FfsFile(self.guid(), FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE, CompressedSection([FirmwareVolumeSection(volume)]))])
+		#The outermost volume becomes the FIRMWARE_VOLUME_IMAGE file itself
+		return FfsFile(self.guid(), FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE, CompressedSection([FirmwareVolumeSection(volume)]))
+
+	def build(self):
+		leading = "\xff" * 0x1000
+		headerLength = EFI.FV_HEADER_LENGTH + 16
+		files = self.everyFileType()
+		files.append(self.nestedVolume(2, min(self.Size // 16, 64 * 1024)))
+
+		mainVolumes = [FirmwareVolume(files)]
+		#Fill a second volume with drivers up to the requested size
+		budget = self.Size - len(leading) - len(mainVolumes[0]) - 2 * FV_BLOCK_SIZE
+		drivers = []
+		used = headerLength
+		while True:
+			f = self.driver()
+			if used + len(Align(f, 8, "\xff")) > budget:
+				break
+			drivers.append(f)
+			used += len(Align(f, 8, "\xff"))
+		if drivers:
+			mainVolumes.append(FirmwareVolume(drivers))
+		mainVolumes.append(FirmwareVolume([FfsFile(self.guid(), FILETYPES.EFI_FV_FILETYPE_DXE_CORE, Sections([Section(SECTIONTYPES.EFI_SECTION_PE32, self.blob(900))]))]))
+
+		image = leading + "".join(mainVolumes)
+		if len(image) < self.Size:
+			image += "\xff" * (self.Size - len(image))
+		logger.debug("Built a synthetic image of %u bytes with %u drivers", len(image), self._driverCount)
+		return image
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Generate a synthetic EFI firmware image')
+	parser.add_argument('-d', '--debug', action='store_true', dest='debug', help='Display debug information (DEBUG)')
+	parser.add_argument('--size', type=float, default=1, help='Approximate image size in MB (default: 1)')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+	parser.add_argument('--compressed', type=float, default=0.3, help='Share of drivers in compressed or LZMA sections (default: 0.3)')
+	parser.add_argument('output', nargs=1, type=argparse.FileType('wb'), help='The image file to write')
+
+	arguments = parser.parse_args(argv[1:])
+
+	if arguments.debug:
+		logging.basicConfig(level=logging.DEBUG)
+	else:
+		logging.basicConfig(level=logging.INFO)
+
+	image = SyntheticImage(int(arguments.size * 1024 * 1024), arguments.seed, arguments.compressed).build()
+	arguments.output[0].write(image)
+	arguments.output[0].close()
+
+if __name__ == '__main__':
+	main(sys.argv)
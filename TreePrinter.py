@@ -1,9 +1,27 @@
-import ast
-#import EFI
+import json, logging, struct, sys
+import EFI
+from GuidIndex import NodeName
 
-class EfiTreePrintVisitor(ast.NodeVisitor):
-  def __init__(self):
+logger = logging.getLogger(__name__)
+
+#BufferedWriter collects this many bytes before writing them
+WRITE_BUFFER_SIZE = 64 * 1024
+
+class EfiTreePrintVisitor(EFI.EfiNodeVisitor):
+  def __init__(self, maxDepth=None, decompress=True, output=None):
     self.indentation = 0
+    self.output = output if output is not None else sys.stdout
+    self.maxDepth = maxDepth
+    self.decompress = decompress
+
+  def _descend(self, node):
+    #Stop once maxDepth levels are printed, volumes being the first, and, unless
+    #asked to decompress, at encapsulation sections which have not been decoded yet
+    if self.maxDepth is not None and self.indentation >= (self.maxDepth - 1) * 10:
+      return False
+    if isinstance(node, EFI.EfiEncapsulationSection) and not self.decompress and not node.IsDecoded:
+      return False
+    return True
 
   def generic_visit(self, node):
     logger.error("Unrecognized node: %s " % (type(node).__name__))
@@ -11,76 +29,275 @@ class EfiTreePrintVisitor(ast.NodeVisitor):
     #ast.NodeVisitor.generic_visit(self, node)
 
   def visit_EfiFirmwareImage(self, node):
+    if self.maxDepth is not None and self.maxDepth < 1:
+      return
     for v in node.firmwareVolumes:
       self.visit(v)
 
   def visit_EfiFirmwareVolume(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
+    if not self._descend(node):
+      return
     self.indentation += 10
     for f in node.files:
       self.visit(f)
     self.indentation -= 10
 
   def visit_EfiFile(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
+    if not self._descend(node):
+      return
     self.indentation += 10
     for s in node.subsections:
       self.visit(s)
     self.indentation -= 10
 
   def visit_EfiGenericSection(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
     self.indentation += 10
 #    for n in node.subsubsections:
 #      self.visit(n)
     self.indentation -= 10
 
   def visit_EfiVersionSection(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
     self.indentation += 10
 #    for n in node.subsubsections:
 #      self.visit(n)
     self.indentation -= 10
 
   def visit_EfiGuidDefinedSection(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
+    if not self._descend(node):
+      return
     self.indentation += 10
     for n in node.Subsections:
       self.visit(n)
     self.indentation -= 10
 
   def visit_EfiUserInterfaceSection(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
     self.indentation += 10
 #    for n in node.subsubsections:
 #      self.visit(n)
     self.indentation -= 10
 
   def visit_EfiFreeformSubtypeGuidSection(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
+    if not self._descend(node):
+      return
     self.indentation += 10
     for n in node.Subsections:
       self.visit(n)
     self.indentation -= 10
 
   def visit_EfiCompressedSection(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
+    if not self._descend(node):
+      return
     self.indentation += 10
     for n in node.Subsections:
       self.visit(n)
     self.indentation -= 10
 
   def visit_EfiFirmwareVolumeSection(self, node):
-    print indent(str(node), self.indentation)
+    print >>self.output, indent(str(node), self.indentation)
+    if not self._descend(node):
+      return
     self.indentation += 10
     for s in node.SubFirmware.firmwareVolumes:
       self.visit(s)
     self.indentation -= 10
-    
+
+
+class EfiTreeStreamPrinter(object):
+  """Prints the same output as EfiTreePrintVisitor from EFI.IterEvents. Nodes are
+  printed when they are reached and not kept, the tree is never built."""
+  def __init__(self, maxDepth=None, decompress=True, output=None):
+    self.output = output if output is not None else sys.stdout
+    self.maxDepth = maxDepth
+    self.decompress = decompress
+
+  def _descend(self, node, depth):
+    #Volumes are at depth 1 and indentation 0 in EfiTreePrintVisitor
+    if self.maxDepth is not None and depth >= self.maxDepth:
+      return False
+    if isinstance(node, EFI.EfiEncapsulationSection) and not self.decompress and not node.IsDecoded:
+      return False
+    return True
+
+  def process(self, root):
+    if self.maxDepth is not None and self.maxDepth < 1:
+      return
+    for (event, node, offset, depth) in EFI.IterEvents(root, self._descend):
+      if event == EFI.START and depth > 0:
+        print >>self.output, indent(str(node), (depth - 1) * 10)
+
+
+class EfiTreeJsonPrinter(EfiTreeStreamPrinter):
+  """Writes one JSON record per node in the order print shows them, either one
+  record per line (format "ndjson") or all of them in one array ("json").
+
+  A record has the number of the node and of its parent, its path (see
+  GuidIndex.FormatPath), depth, kind ("volume", "file" or "section"), offset in
+  the buffer it was parsed from,
+  offset in the image (null inside decoded sections), length and header length,
+  type, GUID and name where it has them. Files are named after the user
+  interface section right in them, sections in encapsulation sections are not
+  decoded for that.
+
+  With stream set the nodes are parsed by EFI.IterEvents and not kept, as
+  EfiTreeStreamPrinter does, otherwise the parsed (and maybe already
+  decompressed) tree is walked."""
+  def __init__(self, maxDepth=None, decompress=True, output=None, format="ndjson", stream=False):
+    super(EfiTreeJsonPrinter, self).__init__(maxDepth, decompress, output)
+    self.format = format
+    self.stream = stream
+    self.encoder = json.JSONEncoder(separators=(",", ":"))
+
+  def process(self, root):
+    writer = BufferedWriter(self.output)
+    children = None if self.stream else EFI.CachedChildren
+    #(number, path, image offset of the buffer of its children) of the nodes above
+    stack = [(None, None, 0)]
+    count = 0
+    #Nothing is printed with maxDepth 0, the volumes are the first level
+    events = EFI.IterEvents(root, self._descend, children) if self.maxDepth is None or self.maxDepth >= 1 else []
+    for (event, node, offset, depth) in events:
+      if depth == 0:
+        continue
+      if event == EFI.END:
+        stack.pop()
+        continue
+
+      (parent, path, base) = stack[-1]
+      path = NodeName(node) if path is None else path + "/" + NodeName(node)
+      imageOffset = None if base is None else base + offset
+      record = NodeRecord(node, count, parent, path, depth - 1, offset, imageOffset)
+      stack.append((count, path, _childrenBase(node, imageOffset)))
+
+      if self.format == "ndjson":
+        writer.write(self.encoder.encode(record) + "\n")
+      else:
+        writer.write(("[\n" if count == 0 else ",\n") + self.encoder.encode(record))
+      count += 1
+
+    if self.format == "json":
+      writer.write("[]\n" if count == 0 else "\n]\n")
+    writer.flush()
+
+def _childrenBase(node, imageOffset):
+  #Encapsulation sections decode into buffers of their own
+  if imageOffset is None:
+    return None
+  if isinstance(node, EFI.EfiFirmwareVolume):
+    return imageOffset + node.HeaderLength
+  if isinstance(node, EFI.EfiFile):
+    return imageOffset + 24
+  if isinstance(node, EFI.EfiFirmwareVolumeSection):
+    return imageOffset + 4
+  return None
+
+def _fileName(f):
+  #Reads the section headers only, the sections are parsed by the walk
+  if not f.HasSections:
+    return None
+  data = f.Data
+  offset = 0
+  while offset + 4 <= len(data):
+    (length, lengthHigh, sectionType) = struct.unpack_from("<HBB", data, offset)
+    length |= lengthHigh << 16
+    if length < 4:
+      break
+    if sectionType == EFI.EfiSection.EFI_SECTIONTYPES.EFI_SECTION_USER_INTERFACE:
+      return unicode(str(data[offset+4:offset+length-2]), "utf-16")
+    offset += length + (-length) % 4
+  return None
+
+def NodeKind(node):
+  if isinstance(node, EFI.EfiFirmwareVolume):
+    return "volume"
+  if isinstance(node, EFI.EfiFile):
+    return "file"
+  return "section"
+
+def NodeRecord(node, number, parent, path, depth, offset, imageOffset):
+  """Returns the JSON record of node, see EfiTreeJsonPrinter"""
+  record = NodeFields(node)
+  record["id"] = number
+  record["parent"] = parent
+  record["path"] = path
+  record["depth"] = depth
+  record["offset"] = offset
+  record["imageOffset"] = imageOffset
+  return record
+
+def NodeFields(node):
+  """Returns the fields describing node itself, without its position in the tree.
+  They are the same in the JSON records and in the sidecar index."""
+  record = {"kind": NodeKind(node)}
+  if isinstance(node, EFI.EfiFirmwareVolume):
+    record["length"] = node.HeaderLength + node.DataLength
+    record["headerLength"] = node.HeaderLength
+    record["attributes"] = node.Attributes
+    record["signature"] = node.Signature
+  elif isinstance(node, EFI.EfiFile):
+    record["length"] = 24 + node.Length
+    record["headerLength"] = 24
+    record["guid"] = str(node.Guid)
+    record["type"] = node.Type
+    record["typeName"] = node._strfiletype()
+    record["attributes"] = node.Attributes
+    record["state"] = node.State
+    record["name"] = _fileName(node)
+  else:
+    record["length"] = len(node.Data)
+    record["headerLength"] = 4
+    record["type"] = node.SectionType
+    record["typeName"] = node._strsectiontype()
+    if isinstance(node, (EFI.EfiGuidDefinedSection, EFI.EfiFreeformSubtypeGuidSection)):
+      record["guid"] = str(node.Guid)
+    if isinstance(node, EFI.EfiUserInterfaceSection):
+      record["name"] = node.String
+    elif isinstance(node, EFI.EfiVersionSection):
+      record["version"] = node.VersionString
+    elif isinstance(node, EFI.EfiFreeformSubtypeGuidSection):
+      record["headerLength"] = 4 + 16
+    elif isinstance(node, EFI.EfiCompressedSection):
+      record["headerLength"] = 4 + 4 + 1
+      record["compressionType"] = node.CompressionType
+      record["decodedLength"] = node.UncompressedDataLength
+    elif isinstance(node, EFI.EfiGuidDefinedSection):
+      record["headerLength"] = max(node.DataOffset, 4 + 16 + 2 + 2)
+      record["dataOffset"] = node.DataOffset
+      record["attributes"] = node.Attributes
+    if isinstance(node, EFI.EfiEncapsulationSection):
+      record["encapsulation"] = True
+      if node.Decoder is not None:
+        record["algorithm"] = node.Decoder.Name
+  return record
+
+class BufferedWriter(object):
+  """Collects strings and writes them to output in blocks of about size bytes"""
+  def __init__(self, output, size=WRITE_BUFFER_SIZE):
+    self.output = output
+    self.size = size
+    self.parts = []
+    self.length = 0
+
+  def write(self, s):
+    self.parts.append(s)
+    self.length += len(s)
+    if self.length >= self.size:
+      self.flush()
+
+  def flush(self):
+    if self.parts:
+      self.output.write("".join(self.parts))
+      self.parts = []
+      self.length = 0
+
 
 def indent(s, i):
-  a = s.split("\n")
-  res = ""
-  for b in a:
-    res += " "*i + b + "\n"
-  return res
+  prefix = " " * i
+  return "".join(prefix + line + "\n" for line in s.split("\n"))
@@ -0,0 +1,99 @@
+import struct
+import logging
+
+import EFI
+from GuidIndex import FormatPath
+from Repacker import FFS_HEADER_LENGTH, FFS_ATTRIB_CHECKSUM, FFS_FIXED_CHECKSUM
+
+logger = logging.getLogger(__name__)
+
+FV_HEADER = "fv-header"
+FILE_HEADER = "file-header"
+FILE_DATA = "file-data"
+
+#The data checksum of files without FFS_ATTRIB_CHECKSUM, EDK1 (FFS1) volumes use 0x5A
+FFS_FIXED_CHECKSUMS = (FFS_FIXED_CHECKSUM, 0x5A)
+#FFS1 files may end in a 2 byte tail which the data checksum does not cover. FFS2
+#uses the bit for FFS_ATTRIB_LARGE_FILE, it only means a tail in FFS1 volumes.
+FFS_ATTRIB_TAIL_PRESENT = 0x01
+
+class Verifier(object):
+	"""Checks the FV header checksums of all volumes and the header and data
+	checksums of all FFS files of an image, nested volumes included. With decompress
+	set, volumes inside compressed and GUID defined sections are checked as well,
+	otherwise only those in sections which are already decoded or stored
+	uncompressed.
+
+	Problems are (kind, path, stored, expected) sequences, kind being FV_HEADER,
+	FILE_HEADER or FILE_DATA and path the nodes from the top level volume down to
+	the volume or file with the bad checksum."""
+	def __init__(self, decompress=True):
+		self.Decompress = decompress
+		self.Problems = []
+		self.VolumesChecked = 0
+		self.FilesChecked = 0
+		self.BytesSummed = 0
+
+	def verify(self, image):
+		self._volumes(image.firmwareVolumes, [])
+		return self.Problems
+
+	def _volumes(self, volumes, path):
+		for v in volumes:
+			self._volume(v, path + [v])
+
+	def _volume(self, volume, path):
+		self.VolumesChecked += 1
+		data = volume.stream.Data
+		header = EFI.BufferView(data, volume.Base, volume.HeaderLength)
+		self.BytesSummed += len(header)
+		total = EFI.Sum16(header)
+		if total:
+			(stored,) = struct.unpack_from("<H", header, EFI.FV_CHECKSUM_OFFSET)
+			self.Problems.append((FV_HEADER, path, stored, (stored - total) & 0xFFFF))
+
+		start = volume.Base + volume.HeaderLength
+		ffs1 = volume.FileSystemGuid == EFI.EFIGUIDS.FIRMWARE_VOLUME1
+		for f in volume.files:
+			self._file(f, EFI.BufferView(data, start + f.Base, FFS_HEADER_LENGTH), path + [f], ffs1)
+
+	def _file(self, f, header, path, ffs1):
+		self.FilesChecked += 1
+		header = bytearray(header)
+		(stored, dataChecksum) = (header[16], header[17])
+		#The header checksum is computed with the data checksum and the state set to zero
+		total = (sum(header) - dataChecksum - header[23]) & 0xFF
+		if total:
+			self.Problems.append((FILE_HEADER, path, stored, (stored - total) & 0xFF))
+
+		if f.Attributes & FFS_ATTRIB_CHECKSUM:
+			data = f.Data
+			if ffs1 and f.Attributes & FFS_ATTRIB_TAIL_PRESENT:
+				data = EFI.BufferView(data, 0, len(data) - 2)
+			self.BytesSummed += len(data)
+			expected = (-EFI.Sum8(data)) & 0xFF
+			if dataChecksum != expected:
+				self.Problems.append((FILE_DATA, path, dataChecksum, expected))
+		elif dataChecksum not in FFS_FIXED_CHECKSUMS:
+			self.Problems.append((FILE_DATA, path, dataChecksum, FFS_FIXED_CHECKSUM))
+
+		self._sections(f.subsections, path)
+
+	def _sections(self, sections, path):
+		for s in sections:
+			if isinstance(s, EFI.EfiFirmwareVolumeSection):
+				self._volumes(s.SubFirmware.firmwareVolumes, path + [s])
+			elif isinstance(s, EFI.EfiEncapsulationSection) and (self.Decompress or s.pendingDecompression() is None):
+				self._sections(s.Subsections, path + [s])
+
+def Verify(image, decompress=True):
+	"""Returns the checksum problems of image, see Verifier"""
+	return Verifier(decompress).verify(image)
+
+def FormatProblems(problems):
+	"""One line per problem: kind, stored and expected checksum and path"""
+	lines = []
+	for (kind, path, stored, expected) in problems:
+		width = 4 if kind == FV_HEADER else 2
+		lines.append("%-11s stored 0x%0*X expected 0x%0*X %s" % (kind, width, stored, width, expected, FormatPath(path)))
+	return "\n".join(lines)
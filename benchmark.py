@@ -0,0 +1,701 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import copy
+import random
+import time
+import mmap
+import uuid
+import json
+import shutil
+import struct
+import logging
+import argparse
+import resource
+import tempfile
+import traceback
+import multiprocessing
+
+from mako.template import Template
+
+import EFI
+import BitArray
+import EfiDecompressor
+import LzmaDecompressor
+import Repacker
+import Verifier
+import FDFGenerator as FDF
+from SyntheticImage import SyntheticImage
+from EfiTreeFileDumpVisitor import EfiTreeFileDumpVisitor
+from FDFGenerator import FDFGenerator
+
+def LegacyFindFirmwareVolumes(stream, length):
+	"""The 16 byte stride UUID loop EfiFirmwareImage._parse used before FindFirmwareVolumes"""
+	offsets = []
+	stream.seek(0, os.SEEK_SET)
+	while stream.tell() < length:
+		#Align to 8 bytes
+		if stream.tell() % 8:
+			stream.seek(8 - (stream.tell() % 8), os.SEEK_CUR)
+
+		#search for firmware volume GUID
+		guidBytes = stream.read(16)
+		while uuid.UUID(bytes_le=guidBytes) != EFI.EFIGUIDS.FIRMWARE_VOLUME1 and uuid.UUID(bytes_le=guidBytes) != EFI.EFIGUIDS.FIRMWARE_VOLUME2:
+			guidBytes = stream.read(16)
+			if len(guidBytes) < 16:
+				return offsets
+
+		base = stream.tell() - 32
+		stream.seek(base, os.SEEK_SET)
+		(zero, guid, fvlength) = struct.unpack("<16s16sQ", stream.read(16 + 16 + 8))
+		offsets.append(base)
+		stream.seek(base + fvlength, os.SEEK_SET)
+	return offsets
+
+class LegacyBitArray:
+	"""The byte wise bit reader BitArray was before it became a wrapper around BitReader"""
+
+	def __init__(self, data):
+		self._Data = data
+		self._ByteIdx = 0
+		self._BitIdx = 0
+
+	def mask(self, bitcount):
+		return (1 << bitcount) - 1
+
+	def read(self, bitsleftcount):
+		result = 0
+		while bitsleftcount:
+			curbitsleftcount = 8 - self._BitIdx
+			curdata = ord(self._Data[self._ByteIdx]) & self.mask(curbitsleftcount)
+
+			if curbitsleftcount >= bitsleftcount:
+				result <<= bitsleftcount
+				result |= curdata >> (curbitsleftcount - bitsleftcount)
+				self._BitIdx += bitsleftcount
+				bitsleftcount = 0
+			else:
+				result <<= curbitsleftcount
+				result |= curdata
+				bitsleftcount -= curbitsleftcount
+				self._BitIdx += curbitsleftcount
+
+			if self._BitIdx >= 8:
+				self._BitIdx = 0
+				self._ByteIdx += 1
+
+		return result
+
+def LegacyBuildHuffmanTree(huffsyms):
+	"""The nested list tree EfiDecompressor used before MakeTable"""
+	hufftree = [None, None]
+	for huffsym in huffsyms:
+		symbol = huffsym[0]
+		bitlen = huffsym[1]
+		huffcode = huffsym[2]
+		if bitlen == 0:
+			continue
+
+		huffsubtree = hufftree
+		for bit in xrange(0, bitlen):
+			lr = huffcode & (1 << (bitlen - bit - 1)) != 0
+
+			if bit < bitlen - 1:
+				if huffsubtree[lr] == None:
+					huffsubtree[lr] = [None, None]
+				huffsubtree = huffsubtree[lr]
+			else:
+				huffsubtree[lr] = symbol
+	return hufftree
+
+def LegacyHuffmanDecode(hufftree, bits):
+	while type(hufftree) == list:
+		hufftree = hufftree[bits.read(1)]
+	return hufftree
+
+class LegacyFDFGenerator(EFI.EfiNodeVisitor):
+	"""The FDFGenerator used before the templates were compiled once and the FDF was
+	streamed: every node compiles its template and returns its FDF as a string"""
+	def __init__(self, directoryPrefix):
+		self.fvCount = 0
+		self.sectionUniquenessSuffix = 0
+		self.directoryPrefix = directoryPrefix
+		self.nestedFirmwareVolumes = []
+		self.curDir = os.path.normpath(directoryPrefix)
+		self.fdTemplate = open(FDF.TEMPLATEDIR + "/fd.tmpl").read()
+		self.fvTemplate = open(FDF.TEMPLATEDIR + "/fv.tmpl").read()
+		self.ffTemplate = open(FDF.TEMPLATEDIR + "/ff.tmpl").read()
+		self.fsTemplate = open(FDF.TEMPLATEDIR + "/fs.tmpl").read()
+
+	def generic_visit(self, node):
+		raise Exception("Unrecognized node: %s " % (type(node).__name__))
+
+	def visit_EfiFirmwareImage(self, node):
+		tmpl = Template(text=self.fdTemplate)
+		firmwareVolumes = "".join(self.visit(v) for v in node.firmwareVolumes)
+		return tmpl.render(firmwareImage=node, firmwareVolumes=(firmwareVolumes + "".join(self.nestedFirmwareVolumes)))
+
+	def visit_EfiFirmwareVolume(self, node):
+		thisFirmwareVolumeIndex = self.fvCount
+		node.volumeIndex = thisFirmwareVolumeIndex
+		self.fvCount += 1
+		self.curDir = os.path.join(self.curDir, "firmwareVolume" + str(thisFirmwareVolumeIndex))
+		tmpl = Template(text=self.fvTemplate)
+		files = "".join(self.visit(f) for f in node.files)
+		volume = tmpl.render(firmwareVolume=node, fvNum=thisFirmwareVolumeIndex, files=files)
+		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
+		return volume
+
+	def visit_EfiFile(self, node):
+		self.curDir = os.path.join(self.curDir, str(node.Guid))
+		sectionsForFile = "".join(self.visit(s) for s in node.subsections)
+		tmpl = Template(text=self.ffTemplate)
+		curFile = tmpl.render(firmwareFile=node, sections=sectionsForFile, curDir=self.curDir)
+		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
+		return curFile
+
+	def visit_EfiGuidDefinedSection(self, node):
+		if node.Guid == EFI.EFIGUIDS.FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED:
+			self.curDir = os.path.join(self.curDir, "LZMA_uncompressed")
+			subsections = "".join(self.visit(s) for s in node.Subsections)
+			lzmaContents = Template(text=self.fsTemplate).render(section=node, curDir=self.curDir, subsections=subsections)
+			self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
+			return lzmaContents
+		subsections = "".join(self.visit(s) for s in node.Subsections)
+		return Template(text=self.fsTemplate).render(section=node, curDir=self.curDir, subsections=subsections)
+
+	def visit_EfiGenericSection(self, node):
+		section = Template(text=self.fsTemplate).render(section=node, curDir=self.curDir, sectionUniquenessSuffix=self.sectionUniquenessSuffix)
+		self.sectionUniquenessSuffix += 1
+		return section
+
+	def _leaf(self, node):
+		return Template(text=self.fsTemplate).render(section=node, curDir=self.curDir)
+
+	visit_EfiUserInterfaceSection = _leaf
+	visit_EfiVersionSection = _leaf
+	visit_EfiFreeformSubtypeGuidSection = _leaf
+
+	def visit_EfiCompressedSection(self, node):
+		self.curDir = os.path.join(self.curDir, "compressedSectionContents")
+		subsections = "".join(self.visit(s) for s in node.Subsections)
+		compressionType = "PI_NONE"
+		if node.CompressionType == 1:
+			compressionType = "PI_STD"
+		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
+		return Template(text=self.fsTemplate).render(section=node, curDir=self.curDir, subsections=subsections, compressionType=compressionType)
+
+	def visit_EfiFirmwareVolumeSection(self, node):
+		self.curDir = os.path.join(self.curDir, "firmwareVolumeSectionContents")
+		volume = node.SubFirmware.firmwareVolumes[0]
+		self.nestedFirmwareVolumes.append(self.visit(volume))
+		section = Template(text=self.fsTemplate).render(section=node, curDir=self.curDir, fvname="FV_" + str(volume.volumeIndex))
+		self.curDir = os.path.normpath(os.path.join(self.curDir, ".."))
+		return section
+
+def IterSections(image):
+	"""Yields every section of image, including the ones in encapsulation sections and nested volumes"""
+	pending = []
+	for v in image.firmwareVolumes:
+		for f in v.files:
+			pending.extend(f.subsections)
+	while pending:
+		section = pending.pop(0)
+		yield section
+		if isinstance(section, EFI.EfiFirmwareVolumeSection):
+			for v in section.SubFirmware.firmwareVolumes:
+				for f in v.files:
+					pending.extend(f.subsections)
+		else:
+			pending.extend(section.Subsections)
+
+def DecodeBlockSymbols(bits, table, position, decode, blocksize, remaining):
+	"""Decodes the symbols of one block without producing output, returns them and the remaining output size"""
+	symbols = []
+	while blocksize and remaining:
+		c = decode(table, bits)
+		blocksize -= 1
+		if c < 256:
+			remaining -= 1
+		else:
+			pos_bitlen = decode(position, bits)
+			if pos_bitlen > 1:
+				bits.read(pos_bitlen - 1)
+			remaining -= (c & 0xff) + 3
+		symbols.append(c)
+	return (symbols, remaining)
+
+def BenchBlocks(payload):
+	"""Decodes every block of a Tiano compressed payload with the tree and the table decoder.
+	Returns (symbols, tree build, tree decode, table build, table decode) per block."""
+	(compressed_size, decompressed_size) = struct.unpack("<II", payload[0:8])
+	bits = BitArray.BitReader(buffer(payload, 8))
+	methods = [(LegacyBuildHuffmanTree, LegacyHuffmanDecode), (EfiDecompressor.MakeTable, EfiDecompressor.HuffmanDecode)]
+
+	blocks = []
+	while decompressed_size:
+		blocksize = bits.read(16)
+		charlen = EfiDecompressor.LoadCharLenHuffmanSyms(bits, EfiDecompressor.MakeTable(EfiDecompressor.LoadHuffmanSyms(bits, 5, 3)))
+		position = EfiDecompressor.LoadHuffmanSyms(bits, 5, -1)
+
+		timings = []
+		results = []
+		for (build, decode) in methods:
+			methodBits = copy.copy(bits)
+			start = time.time()
+			tables = (build(charlen), build(position))
+			built = time.time()
+			results.append(DecodeBlockSymbols(methodBits, tables[0], tables[1], decode, blocksize, decompressed_size))
+			timings += [built - start, time.time() - built]
+
+		if results[0] != results[1]:
+			raise Exception("Tree and table decoder disagree in block %u" % len(blocks))
+		(symbols, decompressed_size) = results[1]
+		bits = methodBits
+		blocks.append(tuple([len(symbols)] + timings))
+	return blocks
+
+def measure(func, repeat):
+	"""Runs func repeat times, returns the best wall clock time and the last result"""
+	best = None
+	result = None
+	for i in xrange(repeat):
+		start = time.time()
+		result = func()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return (best, result)
+
+def report(name, seconds, length):
+	print "%-24s %10.4fs %10.2f MB/s" % (name, seconds, length / seconds / (1024 * 1024) if seconds else 0.0)
+
+def benchFvScan(arguments, f, data):
+	(legacyTime, legacyOffsets) = measure(lambda: LegacyFindFirmwareVolumes(f, len(data)), arguments.repeat)
+	(scanTime, offsets) = measure(lambda: EFI.FindFirmwareVolumes(data), arguments.repeat)
+
+	report("16 byte UUID loop", legacyTime, len(data))
+	report("signature scanner", scanTime, len(data))
+	print "Volumes found: %u (UUID loop), %u (scanner)" % (len(legacyOffsets), len(offsets))
+	if set(legacyOffsets) - set(offsets):
+		print "WARNING: the scanner missed volumes at %s" % ", ".join("0x%X" % o for o in sorted(set(legacyOffsets) - set(offsets)))
+	if scanTime:
+		print "Speedup: %.1fx" % (legacyTime / scanTime)
+
+def benchHuffman(arguments, f, data):
+	image = EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+	payloads = [str(s.Data[4+4+1:]) for s in IterSections(image) if isinstance(s, EFI.EfiCompressedSection) and s.CompressionType == 1]
+	if not payloads:
+		print "No Tiano compressed sections found"
+		return
+
+	print "%6s %8s %12s %12s %12s %12s %8s" % ("Block", "Symbols", "Tree build", "Tree decode", "Table build", "Table decode", "Speedup")
+	totals = [0, 0.0, 0.0, 0.0, 0.0]
+	blockCount = 0
+	for payload in payloads:
+		for block in BenchBlocks(payload):
+			if arguments.verbose:
+				print "%6u %8u %11.3fms %11.3fms %11.3fms %11.3fms %7.1fx" % ((blockCount, block[0]) + tuple(t * 1000 for t in block[1:]) + ((block[1] + block[2]) / max(block[3] + block[4], 1e-9),))
+			totals = [a + b for (a, b) in zip(totals, block)]
+			blockCount += 1
+
+	print "%6s %8u %11.3fms %11.3fms %11.3fms %11.3fms %7.1fx" % (("all", totals[0]) + tuple(t * 1000 for t in totals[1:]) + ((totals[1] + totals[2]) / max(totals[3] + totals[4], 1e-9),))
+	print "%u blocks in %u Tiano compressed sections, per block: %.3fms (tree) vs. %.3fms (table)" % (blockCount, len(payloads), (totals[1] + totals[2]) * 1000 / blockCount, (totals[3] + totals[4]) * 1000 / blockCount)
+
+def RandomBitstream(rng, length):
+	"""Returns random data and a list of read widths which consume it completely"""
+	data = "".join(chr(rng.randrange(256)) for i in xrange(length))
+	widths = []
+	left = length * 8
+	while left:
+		width = min(rng.choice([1, 1, 2, 3, 4, 5, 8, 9, 12, 16, 19, 32, 40]), left)
+		widths.append(width)
+		left -= width
+	return (data, widths)
+
+def benchBitReader(arguments):
+	rng = random.Random(arguments.seed)
+	streams = [RandomBitstream(rng, rng.randrange(1, arguments.size)) for i in xrange(arguments.streams)]
+
+	def readAll(cls):
+		results = []
+		for (data, widths) in streams:
+			bits = cls(data)
+			results.append([bits.read(width) for width in widths])
+		return results
+
+	(legacyTime, results) = measure(lambda: readAll(LegacyBitArray), arguments.repeat)
+	(wrapperTime, results) = measure(lambda: readAll(BitArray.BitArray), arguments.repeat)
+	(readerTime, results) = measure(lambda: readAll(BitArray.BitReader), arguments.repeat)
+
+	length = sum(len(data) for (data, widths) in streams)
+	print "%u random bitstreams, %u reads" % (len(streams), sum(len(widths) for (data, widths) in streams))
+	report("byte wise BitArray", legacyTime, length)
+	report("BitArray wrapper", wrapperTime, length)
+	report("BitReader", readerTime, length)
+
+def benchLzma(arguments, f, data):
+	image = EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+	payloads = [str(s.ContentData) for s in IterSections(image) if isinstance(s, EFI.EfiGuidDefinedSection) and s.Guid == EFI.EFIGUIDS.FIRMWARE_FILE_SECTION_GUID_DEFINED_LZMA_COMPRESSED]
+	if not payloads:
+		print "No LZMA compressed sections found"
+		return
+
+	decoders = []
+	if LzmaDecompressor.DecompressNative(payloads[0]) is not None:
+		decoders.append(("native module", LzmaDecompressor.DecompressNative))
+	decoders.append(("pure python", LzmaDecompressor.DecompressPython))
+	if arguments.lzmaBinary:
+		decoders.append(("LzmaCompress binary", lambda payload: LzmaDecompressor.DecompressBinary(payload, arguments.lzmaBinary)))
+
+	compressedLength = sum(len(payload) for payload in payloads)
+	print "%u LZMA sections, %u bytes compressed" % (len(payloads), compressedLength)
+	expected = None
+	for (name, decoder) in decoders:
+		(seconds, results) = measure(lambda: [decoder(payload) for payload in payloads], arguments.repeat)
+		if expected is None:
+			expected = results
+			print "%u bytes decompressed" % sum(len(result) for result in results)
+		elif results != expected:
+			raise Exception("The %s decoder disagrees with the %s decoder" % (name, decoders[0][0]))
+		report(name, seconds, compressedLength)
+		print "%-24s %10.3fms per section" % ("", seconds * 1000 / len(payloads))
+
+def benchRepack(arguments, f, data):
+	def expanded():
+		image = EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+		list(IterSections(image))
+		return image
+
+	(copyTime, copied) = measure(lambda: Repacker.Repack(EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))), arguments.repeat)
+	images = [expanded() for i in xrange(arguments.repeat)]
+	(fullTime, rebuilt) = measure(lambda: Repacker.Repack(images.pop(), True), arguments.repeat)
+
+	report("repack (copy)", copyTime, len(data))
+	report("repack (rebuild all)", fullTime, len(data))
+	for (name, result) in (("copy", copied), ("rebuild all", rebuilt)):
+		if result != data[:]:
+			print "WARNING: the %s repack differs from the image" % name
+
+	#Patch the code of the last driver again and again, only its volume is rebuilt
+	image = EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+	code = (EFI.EfiSection.EFI_SECTIONTYPES.EFI_SECTION_PE32, EFI.EfiSection.EFI_SECTIONTYPES.EFI_SECTION_TE)
+	drivers = [s for s in IterSections(image) if s.SectionType in code]
+	if drivers:
+		section = drivers[-1]
+		node = section.Parent
+		while not isinstance(node, EFI.EfiFile):
+			node = node.Parent
+		content = str(section.RawContent)
+		def patch():
+			Repacker.ReplaceSection(image, node.Guid, section.SectionType, content)
+			return Repacker.Update(image)
+		(patchTime, patched) = measure(patch, arguments.repeat)
+		report("patch one file", patchTime, len(data))
+		if patched != data[:]:
+			print "WARNING: patching a file with its own content changed the image"
+
+def benchVerify(arguments, f, data):
+	(sumTime, total) = measure(lambda: EFI.Sum8(data), arguments.repeat)
+	(loopTime, expected) = measure(lambda: sum(bytearray(data)) & 0xFF, arguments.repeat)
+	report("8 bit sum (bulk)", sumTime, len(data))
+	report("8 bit sum (bytearray)", loopTime, len(data))
+	if total != expected:
+		print "WARNING: the bulk sum differs"
+
+	#The tree is parsed by the first run, the others only sum
+	image = EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+	Verifier.Verify(image)
+	(verifyTime, verifier) = measure(lambda: verifyImage(image), arguments.repeat)
+	report("verify checksums", verifyTime, verifier.BytesSummed)
+	if verifier.Problems:
+		print "WARNING: %u bad checksums" % len(verifier.Problems)
+
+def verifyImage(image):
+	verifier = Verifier.Verifier()
+	verifier.verify(image)
+	return verifier
+
+def TreeNodes(image):
+	"""Yields every node of the fully parsed and decompressed tree below image"""
+	pending = [image]
+	while pending:
+		node = pending.pop()
+		yield node
+		if isinstance(node, EFI.EfiFirmwareImage):
+			pending.extend(node.firmwareVolumes)
+		elif isinstance(node, EFI.EfiFirmwareVolume):
+			pending.extend(node.files)
+		elif isinstance(node, EFI.EfiFile):
+			pending.extend(node.subsections)
+		elif isinstance(node, EFI.EfiFirmwareVolumeSection):
+			pending.append(node.SubFirmware)
+		else:
+			pending.extend(node.Subsections)
+
+def NodeOverhead(node):
+	"""Bytes held by a node itself: the object, its __dict__ and the small objects
+	only it references (views, GUIDs, strings, lists of children). Payloads and the
+	buffers views point into are not counted."""
+	attributes = {}
+	size = sys.getsizeof(node)
+	if hasattr(node, "__dict__"):
+		size += sys.getsizeof(node.__dict__)
+		attributes.update(node.__dict__)
+	for cls in type(node).__mro__:
+		for name in getattr(cls, "__slots__", ()):
+			if hasattr(node, name):
+				attributes[name] = getattr(node, name)
+
+	for value in attributes.itervalues():
+		if isinstance(value, (buffer, unicode, list)) or (isinstance(value, (int, long)) and not -5 <= value <= 256):
+			size += sys.getsizeof(value)
+		elif isinstance(value, str) and len(value) <= 16:
+			size += sys.getsizeof(value)
+		elif isinstance(value, uuid.UUID):
+			size += sys.getsizeof(value) + sys.getsizeof(value.__dict__)
+	return size
+
+def phaseTree(path):
+	return (os.path.getsize(path), lambda: timed(lambda: list(TreeNodes(openImage(path)))))
+
+def benchMemory(arguments, f, data):
+	image = EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+	sizes = {}
+	for node in TreeNodes(image):
+		entry = sizes.setdefault(type(node).__name__, [0, 0])
+		entry[0] += 1
+		entry[1] += NodeOverhead(node)
+
+	print "%-32s %8s %12s %10s" % ("Node", "Count", "Bytes", "Per node")
+	for (name, (count, size)) in sorted(sizes.iteritems(), key=lambda entry: -entry[1][1]):
+		print "%-32s %8u %12u %10.1f" % (name, count, size, float(size) / count)
+	count = sum(count for (count, size) in sizes.itervalues())
+	size = sum(size for (count, size) in sizes.itervalues())
+	print "%-32s %8u %12u %10.1f" % ("Total", count, size, float(size) / count if count else 0.0)
+
+	#The whole tree in a process of its own, decompressed payloads included
+	r = measurePhase(phaseTree, f.name, 1)
+	print "Building the tree took %.4fs and %uKB" % (r["seconds"], r["phaseKB"])
+
+def timed(func):
+	start = time.time()
+	func()
+	return time.time() - start
+
+def mapImage(path):
+	f = open(path, "rb")
+	return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def openImage(path):
+	return EFI.OpenFirmwareImage(open(path, "rb"))
+
+def compressedPayloads(path, algorithm):
+	"""Returns the compressed payloads of all Tiano or LZMA sections of the image"""
+	image = openImage(path)
+	payloads = []
+	for section in IterSections(image):
+		if isinstance(section, EFI.EfiEncapsulationSection):
+			decompression = section.pendingDecompression()
+			if decompression is not None and decompression[0] == algorithm:
+				payloads.append(str(decompression[2]))
+	return payloads
+
+def phaseFvScan(path):
+	data = mapImage(path)
+	return (len(data), lambda: timed(lambda: EFI.FindFirmwareVolumes(data)))
+
+def phaseTiano(path):
+	payloads = compressedPayloads(path, "tiano")
+	return (sum(len(p) for p in payloads), lambda: timed(lambda: [EfiDecompressor.Decompress(p) for p in payloads]))
+
+def phaseLzma(path):
+	payloads = compressedPayloads(path, "lzma")
+	return (sum(len(p) for p in payloads), lambda: timed(lambda: [LzmaDecompressor.Decompress(p) for p in payloads]))
+
+def phaseParse(path):
+	return (os.path.getsize(path), lambda: timed(lambda: list(IterSections(openImage(path)))))
+
+def phaseDump(path):
+	def run():
+		destination = tempfile.mkdtemp(prefix="efipwn-bench-")
+		try:
+			return timed(lambda: EfiTreeFileDumpVisitor(os.path.join(destination, "dump")).visit(openImage(path)))
+		finally:
+			shutil.rmtree(destination, ignore_errors=True)
+	return (os.path.getsize(path), run)
+
+def phaseGenFdf(path):
+	output = open(os.devnull, "w")
+	return (os.path.getsize(path), lambda: timed(lambda: FDFGenerator("/dump").generate(openImage(path), output)))
+
+#Phases of the benchmark suite. dump and genfdf include parsing, parse includes decompression.
+SUITE_PHASES = [
+	("fvscan", phaseFvScan),
+	("tiano", phaseTiano),
+	("lzma", phaseLzma),
+	("parse", phaseParse),
+	("dump", phaseDump),
+	("genfdf", phaseGenFdf),
+]
+
+def maxRss():
+	"""Peak resident set size of this process in KB"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _runPhase(conn, phase, path, repeat):
+	try:
+		(length, run) = phase(path)
+		baseline = maxRss()
+		best = min(run() for i in xrange(repeat))
+		conn.send((True, (best, length, baseline, maxRss())))
+	except Exception:
+		conn.send((False, traceback.format_exc()))
+	conn.close()
+
+def measurePhase(phase, path, repeat):
+	"""Runs a phase in a child process so its peak memory can be told apart from the
+	other phases. Returns the best time, the bytes processed and the peak memory."""
+	(parentConn, childConn) = multiprocessing.Pipe(False)
+	process = multiprocessing.Process(target=_runPhase, args=(childConn, phase, path, repeat))
+	process.start()
+	(success, result) = parentConn.recv()
+	process.join()
+	if not success:
+		raise Exception("Benchmark phase failed:\n%s" % result)
+
+	(seconds, length, baseline, peak) = result
+	return {
+		"seconds": seconds,
+		"bytes": length,
+		"mbPerSecond": length / seconds / (1024 * 1024) if seconds else 0.0,
+		"peakKB": peak,
+		"phaseKB": peak - baseline,
+	}
+
+def benchSuite(arguments):
+	path = arguments.image
+	generated = None
+	if path is None:
+		(fd, path) = tempfile.mkstemp(prefix="efipwn-bench-", suffix=".bin")
+		start = time.time()
+		image = SyntheticImage(int(arguments.size * 1024 * 1024), arguments.seed).build()
+		os.write(fd, image)
+		os.close(fd)
+		generated = {"size": len(image), "seed": arguments.seed, "seconds": time.time() - start}
+		logging.info("Generated a %u byte synthetic image in %.1fs", len(image), generated["seconds"])
+
+	try:
+		results = {
+			"image": arguments.image,
+			"generated": generated,
+			"imageSize": os.path.getsize(path),
+			"python": sys.version.split()[0],
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"repeat": arguments.repeat,
+			"phases": {},
+		}
+		print "%-8s %10s %12s %10s %12s %12s" % ("Phase", "Time", "Bytes", "MB/s", "Peak", "Phase peak")
+		for (name, phase) in SUITE_PHASES:
+			if arguments.phases and name not in arguments.phases:
+				continue
+			r = measurePhase(phase, path, arguments.repeat)
+			results["phases"][name] = r
+			print "%-8s %9.4fs %12u %10.2f %10uKB %10uKB" % (name, r["seconds"], r["bytes"], r["mbPerSecond"], r["peakKB"], r["phaseKB"])
+	finally:
+		if generated is not None:
+			os.unlink(path)
+
+	if arguments.json:
+		f = open(arguments.json, "w")
+		json.dump(results, f, indent=2, sort_keys=True)
+		f.write("\n")
+		f.close()
+
+def benchCompare(arguments):
+	(old, new) = [json.load(open(path)) for path in (arguments.old, arguments.new)]
+	print "%-8s %10s %10s %8s %12s %12s" % ("Phase", "Old", "New", "Speedup", "Old peak", "New peak")
+	for (name, phase) in SUITE_PHASES:
+		if name not in old["phases"] or name not in new["phases"]:
+			continue
+		(o, n) = (old["phases"][name], new["phases"][name])
+		print "%-8s %9.4fs %9.4fs %7.2fx %10uKB %10uKB" % (name, o["seconds"], n["seconds"], o["seconds"] / n["seconds"] if n["seconds"] else 0.0, o["peakKB"], n["peakKB"])
+	if old["imageSize"] != new["imageSize"]:
+		print "WARNING: the runs used different images (%u vs. %u bytes)" % (old["imageSize"], new["imageSize"])
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='EFIPWN benchmarks')
+	parser.add_argument('-d', '--debug', action='store_true', dest='debug', help='Display debug information (DEBUG)')
+	parser.add_argument('-v', '--verbose', action='store_true', help='Report every single measurement')
+	parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs, the best one is reported')
+
+	subparsers = parser.add_subparsers(title='Benchmarks', dest='benchmark')
+
+	parser_bitreader = subparsers.add_parser('bitreader', help='Time BitArray and BitReader against the byte wise reader on random bitstreams')
+	parser_bitreader.add_argument('--streams', type=int, default=200, help='Number of random bitstreams')
+	parser_bitreader.add_argument('--size', type=int, default=4096, help='Maximum length of a bitstream in bytes')
+	parser_bitreader.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+
+	parser_fvscan = subparsers.add_parser('fvscan', help='Compare the firmware volume signature scanner against the old 16 byte UUID loop')
+
+	parser_huffman = subparsers.add_parser('huffman', help='Per block comparison of the huffman tree and table decoders on all Tiano compressed sections')
+
+	parser_lzma = subparsers.add_parser('lzma', help='Compare the LZMA decoders on all LZMA compressed sections')
+	parser_lzma.add_argument('--lzma-binary', dest='lzmaBinary', metavar='PATH', help='Also measure EDK2\'s LzmaCompress binary')
+
+	parser_memory = subparsers.add_parser('memory', help='Memory used per node of the fully parsed tree')
+
+	parser_verify = subparsers.add_parser('verify', help='Time the checksum verification and the bulk sums it uses')
+
+	parser_repack = subparsers.add_parser('repack', help='Check that repacking an unmodified image gives the same bytes and time it')
+
+	parser_suite = subparsers.add_parser('suite', help='Time FV scanning, decompression, parsing, dump and genfdf with throughput and peak memory')
+	parser_suite.add_argument('--image', type=str, default=None, help='Firmware image to use instead of a synthetic one')
+	parser_suite.add_argument('--size', type=float, default=1, help='Size of the synthetic image in MB (default: 1)')
+	parser_suite.add_argument('--seed', type=int, default=0, help='Seed of the synthetic image')
+	parser_suite.add_argument('--phase', action='append', dest='phases', default=[], choices=[name for (name, phase) in SUITE_PHASES], help='Only run this phase, may be given more than once')
+	parser_suite.add_argument('--json', type=str, metavar='FILE', help='Save the results as JSON')
+
+	parser_compare = subparsers.add_parser('compare', help='Compare two JSON results of the suite')
+	parser_compare.add_argument('old', type=str, help='Results of the baseline run')
+	parser_compare.add_argument('new', type=str, help='Results to compare against it')
+
+	for p in (parser_fvscan, parser_huffman, parser_lzma, parser_repack, parser_memory, parser_verify):
+		p.add_argument('file', nargs=1, type=argparse.FileType('rb'), help='The firmware file to benchmark with')
+
+	arguments = parser.parse_args(argv[1:])
+
+	if arguments.debug:
+		logging.basicConfig(level=logging.DEBUG)
+	else:
+		logging.basicConfig(level=logging.WARNING)
+
+	if arguments.benchmark == 'bitreader':
+		benchBitReader(arguments)
+		return
+	if arguments.benchmark == 'suite':
+		benchSuite(arguments)
+		return
+	if arguments.benchmark == 'compare':
+		benchCompare(arguments)
+		return
+
+	f = arguments.file[0]
+	data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	if arguments.benchmark == 'fvscan':
+		benchFvScan(arguments, f, data)
+	elif arguments.benchmark == 'huffman':
+		benchHuffman(arguments, f, data)
+	elif arguments.benchmark == 'lzma':
+		benchLzma(arguments, f, data)
+	elif arguments.benchmark == 'repack':
+		benchRepack(arguments, f, data)
+	elif arguments.benchmark == 'verify':
+		benchVerify(arguments, f, data)
+	elif arguments.benchmark == 'memory':
+		benchMemory(arguments, f, data)
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -1,29 +1,81 @@
 #!/usr/bin/env python
 
-import sys
 import os
+import sys
+import codecs
 import logging
 import argparse
+import uuid
 
-from EFI import EfiFirmwareImage
-from TreePrinter import EfiTreePrintVisitor
-from EfiTreeFileDumpVisitor import EfiTreeFileDumpVisitor
-from FDFGenerator import FDFGenerator
+import EFI
+import Stats
+import LzmaDecompressor
+from DecompressionCache import DecompressionCache
+from ParallelDecompressor import DecompressTree
+from GuidIndex import GuidIndex, FormatPath
+from ImageDiff import ImageDiff, FormatChanges
+from Verifier import Verifier, FormatProblems
+from BatchProcessor import ProcessBatch, OPERATIONS, DEFAULT_TIMEOUT
+from EFI import OpenFirmwareImage
+from TreePrinter import EfiTreePrintVisitor, EfiTreeStreamPrinter, EfiTreeJsonPrinter
+from EfiTreeFileDumpVisitor import EfiTreeFileDumpVisitor, EfiStreamFileDumper, DUMP_WRITER_THREADS
+import FDFGenerator
+import Repacker
+import SidecarIndex
 
 def main(argv):
 	parser = argparse.ArgumentParser(description='EFI Firmware exploration tool')
 	parser.add_argument('-d', '--debug', action='store_true', dest='debug', help='Display debug information (DEBUG)')
-	parser.add_argument('file', nargs=1, type=argparse.FileType('rb'), help='The firmware file')
+	parser.add_argument('--no-mmap', action='store_false', dest='mmap', help='Read the firmware file into memory instead of memory-mapping it')
+	parser.add_argument('--fv-guid', action='append', default=[], dest='fvGuids', metavar='GUID', help='Also accept firmware volumes with this file system GUID')
+	parser.add_argument('--lzma-binary', dest='lzmaBinary', metavar='PATH', help='EDK2 LzmaCompress binary, used when no lzma module is installed and for sections the in-process decoder rejects')
+	parser.add_argument('--cache', dest='cacheDir', metavar='DIR', help='Cache decompressed sections in this directory')
+	parser.add_argument('--cache-size', dest='cacheSize', type=int, default=1024, metavar='MB', help='Size limit of the decompression cache (default: 1024)')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Decompress sections on this many processes, in batch mode process this many images in parallel')
+	parser.add_argument('--stats', action='store_true', help='Print timings and counters to stderr when done')
+	parser.add_argument('--stats-format', choices=['text', 'json'], default='text', dest='statsFormat', help='Format of --stats (default: text)')
+	parser.add_argument('--index', action='store_true', dest='buildIndex', help='Write an index of the image next to it (IMAGE%s) if there is none or it is outdated' % SidecarIndex.INDEX_SUFFIX)
+	parser.add_argument('--no-index', action='store_false', dest='useIndex', help='Do not answer print from the index of the image')
+	parser.add_argument('file', nargs=1, type=str, help='The firmware file, for batch a directory or a manifest file listing one image per line')
 
 	subparsers = parser.add_subparsers(title='Operations', dest='action')
 
 	parser_print = subparsers.add_parser('print', help='Print a tree of the structure of the EFI firmware image')
+	parser_print.add_argument('--depth', type=int, default=None, help='Only print this many levels of the tree, volumes being the first')
+	parser_print.add_argument('--no-decompress', action='store_false', dest='decompress', help='Do not decompress compressed and GUID defined sections')
+	parser_print.add_argument('--stream', action='store_true', help='Print while parsing without building the tree')
+	parser_print.add_argument('--format', choices=['text', 'json', 'ndjson'], default='text', help='text (default), a JSON array of one record per node or one JSON record per line')
 
 	parser_dump = subparsers.add_parser('dump', help='Dump all files in an EFI firmware image into a directory structure')
 	parser_dump.add_argument('destination', nargs=1, type=str, help='The location of the dump')
+	parser_dump.add_argument('--stream', action='store_true', help='Write while parsing without building the tree')
+	parser_dump.add_argument('--dedup', action='store_true', help='Store identical payloads once and hardlink (or symlink) them into place')
+	parser_dump.add_argument('--writers', type=int, default=None, help='Number of threads writing files (default: %u)' % DUMP_WRITER_THREADS)
 
 	parser_genfdf = subparsers.add_parser('genfdf', help='Try to create a EDK2 FDF file for generating a firmware image out of a dump')
 	parser_genfdf.add_argument('dirPrefix', nargs=1, type=str, help='The location of the dump files')
+	parser_genfdf.add_argument('--template-cache', dest='templateCache', metavar='DIR', help='Keep the compiled templates in this directory')
+
+	parser_find = subparsers.add_parser('find', help='Find files and sections by GUID, decompressing only what is needed to reach them')
+	parser_find.add_argument('guid', nargs=1, type=str, help='GUID of a file, a freeform subtype GUID section or a GUID defined section')
+	parser_find.add_argument('--all', action='store_true', help='Report every node with this GUID instead of the first ones found')
+
+	parser_diff = subparsers.add_parser('diff', help='List the files added, removed or changed in another image, skipping identical volumes and files without decompressing them')
+	parser_diff.add_argument('other', nargs=1, type=str, help='The image to compare with')
+
+	parser_verify = subparsers.add_parser('verify', help='Check the FV header checksums and the FFS header and data checksums, nested volumes included')
+	parser_verify.add_argument('--no-decompress', action='store_false', dest='decompress', help='Do not check volumes inside compressed and GUID defined sections')
+
+	parser_repack = subparsers.add_parser('repack', help='Write the image back with files or sections replaced, without the EDK2 tools')
+	parser_repack.add_argument('output', nargs=1, type=str, help='The image file to write')
+	parser_repack.add_argument('--replace-file', nargs=2, action='append', default=[], dest='replaceFiles', metavar=('GUID', 'FFSFILE'), help='Replace the file GUID with the FFS file FFSFILE (header included)')
+	parser_repack.add_argument('--replace-section', nargs=3, action='append', default=[], dest='replaceSections', metavar=('GUID', 'TYPE', 'FILE'), help='Replace the content of the first section of TYPE (e.g. PE32) in the file GUID with FILE')
+	parser_repack.add_argument('--full', action='store_true', help='Rebuild every volume, file and section instead of only the modified ones')
+
+	parser_batch = subparsers.add_parser('batch', help='Run an operation on many images and stream one JSON line per image')
+	parser_batch.add_argument('--operation', choices=OPERATIONS, default='summary', help='What to do with every image (default: summary)')
+	parser_batch.add_argument('--output', type=str, default='.', help='Directory for the print/dump/genfdf results, one entry per image')
+	parser_batch.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT, help='Fail images which take longer than this many seconds, 0 to wait forever (default: %d)' % DEFAULT_TIMEOUT)
 
 	arguments = parser.parse_args(argv[1:])
 
@@ -32,23 +84,164 @@ def main(argv):
 	else:
 		logging.basicConfig(level=logging.INFO)
 
-	arguments.file[0].seek(0, os.SEEK_END)
-	flen = arguments.file[0].tell()
-	arguments.file[0].seek(0, os.SEEK_SET)
+	if arguments.stats:
+		Stats.Enable()
+
+	LzmaDecompressor.LZMA_BINARY = arguments.lzmaBinary
+
+	if arguments.cacheDir:
+		EFI.DECOMPRESSION_CACHE = DecompressionCache(arguments.cacheDir, arguments.cacheSize * 1024 * 1024)
+
+	for guid in arguments.fvGuids:
+		EFI.FIRMWARE_VOLUME_GUIDS.append(uuid.UUID(guid))
+
+	if arguments.action == 'batch':
+		with Stats.timer("batch"):
+			failed = ProcessBatch(arguments.file[0], arguments.operation, arguments.output, arguments.jobs, sys.stdout, arguments.mmap, arguments.timeout)
+		finish(arguments)
+		if failed:
+			logging.error("%u images failed", failed)
+			sys.exit(1)
+		return
+
+	path = arguments.file[0]
+	with Stats.timer("open"):
+		fw = OpenFirmwareImage(open(path, 'rb'), arguments.mmap)
+
+	#A shallow print only decompresses what it reaches, everything else needs the whole tree.
+	#Streaming never builds the tree, so it decompresses in-process.
+	streaming = arguments.action in ('print', 'dump') and arguments.stream
+	#Loading the index hashes the whole image, only do that if it can be used or
+	#--index has to know whether it is up to date
+	useIndex = arguments.action in ('print', 'find') and not streaming and arguments.useIndex and (arguments.action == 'find' or arguments.format == 'text')
+	index = None
+	if (useIndex or arguments.buildIndex) and os.path.exists(SidecarIndex.IndexPath(path)):
+		with Stats.timer("index.load"):
+			index = SidecarIndex.LoadIndex(path, fw.stream.Data)
+	indexed = useIndex and index is not None
+	if arguments.jobs > 1 and not streaming and not indexed and arguments.action not in ('find', 'diff') and not (arguments.action in ('print', 'verify') and not arguments.decompress) and not (arguments.action == 'print' and arguments.depth is not None):
+		with Stats.timer("decompress.tree"):
+			DecompressTree(fw, arguments.jobs)
+
+	with Stats.timer(arguments.action):
+		if arguments.action == 'print':
+			if arguments.format != 'text':
+				EfiTreeJsonPrinter(arguments.depth, arguments.decompress, format=arguments.format, stream=arguments.stream).process(fw)
+			elif indexed:
+				SidecarIndex.IndexPrinter(arguments.depth, arguments.decompress).process(index)
+			elif arguments.stream:
+				EfiTreeStreamPrinter(arguments.depth, arguments.decompress).process(fw)
+			else:
+				v = EfiTreePrintVisitor(arguments.depth, arguments.decompress)
+				v.visit(fw)
+
+		if arguments.action == 'dump':
+			if arguments.stream:
+				EfiStreamFileDumper(arguments.destination[0], arguments.writers, arguments.dedup).process(fw)
+			else:
+				d = EfiTreeFileDumpVisitor(arguments.destination[0], arguments.writers, arguments.dedup)
+				d.visit(fw)
+
+		if arguments.action == 'genfdf':
+			FDFGenerator.TEMPLATE_MODULE_DIR = arguments.templateCache
+			f = FDFGenerator.FDFGenerator(arguments.dirPrefix[0])
+			output = codecs.getwriter(sys.stdout.encoding or "ascii")(sys.stdout)
+			f.generate(fw, output)
+			output.write("\n")
+
+		if arguments.action == 'find':
+			if not find(fw, index if indexed else None, arguments):
+				logging.error("Found nothing with GUID %s", arguments.guid[0])
+				sys.exit(1)
+
+		if arguments.action == 'diff':
+			diff(fw, OpenFirmwareImage(open(arguments.other[0], 'rb'), arguments.mmap))
+
+		if arguments.action == 'verify':
+			if not verify(fw, arguments):
+				sys.exit(1)
+
+		if arguments.action == 'repack':
+			repack(fw, arguments)
+
+	if arguments.buildIndex and index is None:
+		if arguments.action == 'repack':
+			logging.warning("Not indexing the image after modifying its tree, index the repacked image instead")
+		else:
+			with Stats.timer("index.build"):
+				SidecarIndex.SaveIndex(path, SidecarIndex.BuildIndex(fw, SidecarIndex.ImageHash(fw.stream.Data)))
+
+	finish(arguments)
+
+def find(fw, index, arguments):
+	guid = uuid.UUID(arguments.guid[0])
+	if index is not None:
+		indexed = SidecarIndex.IndexedImage(index, fw.stream.Data)
+		numbers = indexed.lookup(guid)
+		if not arguments.all:
+			numbers = numbers[0:1]
+		matches = [(indexed.node(n), indexed.nodePath(n)) for n in numbers]
+	else:
+		guidIndex = GuidIndex(fw)
+		matches = guidIndex.lookupAll(guid) if arguments.all else guidIndex.lookup(guid)
+
+	for (node, path) in matches:
+		print FormatPath(path)
+		print str(node)
+	return len(matches)
+
+def diff(old, new):
+	d = ImageDiff()
+	changes = d.diff(old, new)
+	if changes:
+		print FormatChanges(changes)
+	counts = dict((status, 0) for status in ("added", "removed", "changed", "reencoded"))
+	for change in changes:
+		counts[change[0]] += 1
+	logging.info("%u added, %u removed, %u changed, %u only encoded differently. %u of %u volumes and files compared were identical",
+		counts["added"], counts["removed"], counts["changed"], counts["reencoded"], d.Pruned, d.VolumesCompared + d.FilesCompared)
+
+def verify(fw, arguments):
+	v = Verifier(arguments.decompress)
+	problems = v.verify(fw)
+	if problems:
+		print FormatProblems(problems)
+	logging.info("%u bad checksums in %u volumes and %u files", len(problems), v.VolumesChecked, v.FilesChecked)
+	return not problems
 
-	fw = EfiFirmwareImage(arguments.file[0], flen)
+def repack(fw, arguments):
+	for (guid, path) in arguments.replaceFiles:
+		Repacker.ReplaceFile(fw, uuid.UUID(guid), Repacker.ParseFile(open(path, 'rb').read()))
+	for (guid, typeName, path) in arguments.replaceSections:
+		sectionType = getattr(EFI.EfiSection.EFI_SECTIONTYPES, "EFI_SECTION_" + typeName.upper(), None)
+		if sectionType is None:
+			raise ValueError("Unknown section type %s" % typeName)
+		Repacker.ReplaceSection(fw, uuid.UUID(guid), sectionType, open(path, 'rb').read())
 
-	if arguments.action == 'print':
-		v = EfiTreePrintVisitor()
-		v.visit(fw)
+	r = Repacker.Repacker(arguments.full)
+	image = r.visit(fw)
+	f = open(arguments.output[0], 'wb')
+	f.write(image)
+	f.close()
+	logging.info("Wrote %u bytes, rebuilt %u volumes and %u files, compressed %u sections again", len(image), r.VolumesRebuilt, r.FilesRebuilt, r.Recompressed)
 
-	if arguments.action == 'dump':
-		d = EfiTreeFileDumpVisitor(arguments.destination[0])
-		d.visit(fw)
+def finish(arguments):
+	cache = EFI.DECOMPRESSION_CACHE
+	if cache is not None:
+		with Stats.timer("cache.trim"):
+			cache.trim()
+		logging.info("Decompression cache: %s", cache)
+		Stats.add("cache.hits", cache.Hits)
+		Stats.add("cache.misses", cache.Misses)
+		Stats.add("cache.stores", cache.Stores)
+		Stats.add("cache.evictions", cache.Evictions)
 
-	if arguments.action == 'genfdf':
-		f = FDFGenerator(arguments.dirPrefix[0])
-		print f.visit(fw)
+	if Stats.STATS is not None:
+		sys.stdout.flush()
+		if arguments.statsFormat == 'json':
+			sys.stderr.write(Stats.STATS.toJson() + "\n")
+		else:
+			sys.stderr.write(str(Stats.STATS))
 
 if __name__ == '__main__':
 	main(sys.argv)
@@ -0,0 +1,80 @@
+import os
+import sys
+import json
+import uuid
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import BatchProcessor
+from SyntheticImage import *
+
+class BatchProcessorTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix="efipwn-test-")
+		self.images = os.path.join(self.directory, "images")
+		os.makedirs(self.images)
+		files = [FfsFile(uuid.UUID(int=i), FILETYPES.EFI_FV_FILETYPE_FREEFORM, Sections([
+			CompressedSection([UserInterfaceSection(u"File%u" % i), FirmwareVolumeSection(FirmwareVolume([], 0x1000))]),
+		])) for i in xrange(3)]
+		self.write("firmware.bin", "\xff" * 0x100 + FirmwareVolume(files))
+		self.write("empty.bin", "\xff" * 0x1000)
+		#A section claiming to be 0 bytes long
+		self.write("corrupt.bin", FirmwareVolume([FfsFile(uuid.UUID(int=9), FILETYPES.EFI_FV_FILETYPE_FREEFORM, "\0" * 8)]))
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def write(self, name, data):
+		f = open(os.path.join(self.images, name), "wb")
+		f.write(data)
+		f.close()
+
+	def process(self, operation, jobs=1):
+		output = StringIO()
+		failed = BatchProcessor.ProcessBatch(self.images, operation, os.path.join(self.directory, "output"), jobs, output)
+		records = [json.loads(line) for line in output.getvalue().splitlines()]
+		return (failed, dict((os.path.basename(r["image"]), r) for r in records))
+
+	def test_summary(self):
+		(failed, records) = self.process("summary")
+		self.assertEqual(failed, 2)
+		summary = records["firmware.bin"]
+		self.assertEqual(summary["status"], "ok")
+		self.assertEqual((summary["volumes"], summary["files"], summary["sections"], summary["encapsulations"]), (4, 3, 9, 3))
+		self.assertEqual(summary["fileGuids"], [str(uuid.UUID(int=i)) for i in xrange(3)])
+
+	def test_no_firmware_volume(self):
+		for operation in BatchProcessor.OPERATIONS:
+			(failed, records) = self.process(operation)
+			self.assertEqual(records["empty.bin"]["status"], "error")
+			self.assertEqual(records["empty.bin"]["error"], "no firmware volume found")
+			self.assertNotIn("volumes", records["empty.bin"])
+			self.assertNotIn("output", records["empty.bin"])
+			self.assertEqual(records["firmware.bin"]["status"], "ok")
+
+	def test_corrupt_image(self):
+		for jobs in (1, 2):
+			(failed, records) = self.process("summary", jobs)
+			self.assertEqual(failed, 2)
+			self.assertEqual(records["corrupt.bin"]["status"], "error")
+			self.assertTrue(records["corrupt.bin"]["error"].startswith("ValueError: Section at offset 0x0"))
+
+	def test_timeout(self):
+		summarize = BatchProcessor.Summarize
+		def hang(image):
+			while True:
+				pass
+		BatchProcessor.Summarize = hang
+		try:
+			record = BatchProcessor.ProcessImage((os.path.join(self.images, "firmware.bin"), "firmware.bin", "summary", self.directory, True, 1))
+		finally:
+			BatchProcessor.Summarize = summarize
+		self.assertEqual(record["status"], "error")
+		self.assertTrue(record["error"].startswith("ImageTimeout"))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import BitArray
+from benchmark import LegacyBitArray, RandomBitstream
+
+class BitReaderTest(unittest.TestCase):
+	"""BitReader and BitArray against the byte wise reader BitArray replaced"""
+	def setUp(self):
+		rng = random.Random(0)
+		self.streams = [RandomBitstream(rng, rng.randrange(1, 512)) for i in xrange(100)]
+		self.streams.append(("\xA5", [1, 1, 1, 1, 1, 1, 1, 1]))
+		self.streams.append(("\x12\x34\x56\x78\x9A", [40]))
+
+	def readAll(self, bits, widths):
+		return [bits.read(width) for width in widths]
+
+	def test_read_matches_legacy(self):
+		for (data, widths) in self.streams:
+			expected = self.readAll(LegacyBitArray(data), widths)
+			self.assertEqual(self.readAll(BitArray.BitReader(data), widths), expected)
+			self.assertEqual(self.readAll(BitArray.BitArray(data), widths), expected)
+
+	def test_read_from_buffer(self):
+		for (data, widths) in self.streams:
+			expected = self.readAll(LegacyBitArray(data), widths)
+			self.assertEqual(self.readAll(BitArray.BitReader(buffer("\0" * 8 + data, 8)), widths), expected)
+
+	def test_peek_does_not_consume(self):
+		for (data, widths) in self.streams:
+			bits = BitArray.BitReader(data)
+			expected = self.readAll(LegacyBitArray(data), widths)
+			for (width, value) in zip(widths, expected):
+				self.assertEqual(bits.peek(width), value)
+				self.assertEqual(bits.read(width), value)
+
+	def test_skip_and_tell(self):
+		for (data, widths) in self.streams:
+			bits = BitArray.BitReader(data)
+			expected = self.readAll(LegacyBitArray(data), widths)
+			position = 0
+			for (i, width) in enumerate(widths):
+				self.assertEqual(bits.tell(), position)
+				if i % 2:
+					bits.skip(width)
+				else:
+					self.assertEqual(bits.read(width), expected[i])
+				position += width
+			self.assertEqual(bits.tell(), len(data) * 8)
+
+	def test_reader_pads_with_zeros(self):
+		bits = BitArray.BitReader("\xFF\x81")
+		self.assertEqual(bits.read(12), 0xFF8)
+		self.assertEqual(bits.peek(16), 0x1000)
+		self.assertEqual(bits.read(20), 0x10000)
+		self.assertEqual(bits.read(32), 0)
+		self.assertEqual(BitArray.BitReader("").read(7), 0)
+
+	def test_legacy_raises_past_end(self):
+		bits = LegacyBitArray("\xFF")
+		bits.read(8)
+		self.assertRaises(IndexError, bits.read, 1)
+
+	def test_bitarray_raises_past_end(self):
+		for (data, widths) in self.streams:
+			bits = BitArray.BitArray(data)
+			self.readAll(bits, widths)
+			self.assertRaises(IndexError, bits.read, 1)
+
+	def test_bitarray_raises_on_read_over_end(self):
+		bits = BitArray.BitArray("\xAB\xCD")
+		self.assertEqual(bits.read(4), 0xA)
+		self.assertRaises(IndexError, bits.read, 13)
+		self.assertEqual(bits.read(12), 0xBCD)
+		self.assertRaises(IndexError, BitArray.BitArray("").read, 1)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import DecompressionCache
+from DecompressionCache import DecompressionCache as Cache
+
+class FullFile(object):
+	"""A file on a full disk"""
+	def __init__(self, fd):
+		self.fd = fd
+
+	def write(self, data):
+		raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+	def close(self):
+		os.close(self.fd)
+
+class DecompressionCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix="efipwn-test-")
+		self.cache = Cache(os.path.join(self.directory, "cache"))
+		DecompressionCache.logger.setLevel(logging.CRITICAL)
+
+	def tearDown(self):
+		DecompressionCache.logger.setLevel(logging.NOTSET)
+		shutil.rmtree(self.directory)
+
+	def entries(self):
+		result = []
+		for (dirpath, dirnames, filenames) in os.walk(self.cache.Directory):
+			result.extend(filenames)
+		return result
+
+	def test_round_trip(self):
+		self.assertEqual(self.cache.get("tiano", "compressed"), None)
+		self.assertTrue(self.cache.put("tiano", "compressed", "decompressed"))
+		self.assertEqual(self.cache.get("tiano", "compressed"), "decompressed")
+		self.assertEqual(self.cache.get("lzma", "compressed"), None)
+		self.assertEqual(self.cache.get("tiano", buffer("xcompressed", 1)), "decompressed")
+		self.assertEqual((self.cache.Hits, self.cache.Misses, self.cache.Stores), (2, 2, 1))
+
+	def test_decompress(self):
+		calls = []
+		decompressor = lambda payload: calls.append(payload) or payload.upper()
+		for i in xrange(3):
+			self.assertEqual(self.cache.decompress("tiano", "abc", decompressor), "ABC")
+		self.assertEqual(calls, ["abc"])
+		#Another cache on the same directory, e.g. the next run
+		self.assertEqual(Cache(self.cache.Directory).decompress("tiano", "abc", decompressor), "ABC")
+		self.assertEqual(calls, ["abc"])
+
+	def test_trim_least_recently_used(self):
+		now = time.time()
+		for (i, name) in enumerate(["a", "b", "c"]):
+			self.cache.put("tiano", name, name * 100)
+			path = self.cache._path(self.cache.key("tiano", name))
+			os.utime(path, (now - 100 + i, now - 100 + i))
+		self.cache.MaxSize = 250
+		#Using "a" makes "b" the least recently used entry
+		self.cache.get("tiano", "a")
+		self.assertEqual(self.cache.trim(), 200)
+		self.assertEqual(self.cache.Evictions, 1)
+		self.assertEqual(self.cache.get("tiano", "b"), None)
+		self.assertEqual(self.cache.get("tiano", "a"), "a" * 100)
+		self.assertEqual(self.cache.get("tiano", "c"), "c" * 100)
+
+	def test_put_trims(self):
+		self.cache.MaxSize = 1000
+		for i in xrange(30):
+			self.cache.put("tiano", str(i), "x" * 100)
+		self.assertTrue(self.cache.Evictions > 0)
+		self.assertTrue(len(self.entries()) * 100 <= 1000)
+
+	def test_racing_writers(self):
+		data = "decompressed" * 1000
+		def writer():
+			for i in xrange(20):
+				self.cache.put("tiano", "same", data)
+		threads = [threading.Thread(target=writer) for i in xrange(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(self.cache.get("tiano", "same"), data)
+		self.assertEqual(len(self.entries()), 1)
+
+	def test_rename_does_not_replace(self):
+		#Like on Windows: the second writer of an entry loses the rename
+		rename = os.rename
+		def exclusiveRename(src, dst):
+			if os.path.exists(dst):
+				raise OSError(errno.EEXIST, os.strerror(errno.EEXIST))
+			rename(src, dst)
+		os.rename = exclusiveRename
+		try:
+			self.assertTrue(self.cache.put("tiano", "same", "first"))
+			self.assertTrue(self.cache.put("tiano", "same", "first"))
+		finally:
+			os.rename = rename
+		self.assertEqual(self.entries(), [self.cache.key("tiano", "same")])
+
+	def test_write_error(self):
+		fdopen = os.fdopen
+		os.fdopen = lambda fd, mode: FullFile(fd)
+		try:
+			self.assertFalse(self.cache.put("tiano", "compressed", "decompressed"))
+			self.assertEqual(self.cache.decompress("tiano", "abc", lambda payload: payload.upper()), "ABC")
+		finally:
+			os.fdopen = fdopen
+		self.assertEqual(self.entries(), [])
+		self.assertEqual(self.cache.Stores, 0)
+
+	def test_unwritable_directory(self):
+		path = os.path.join(self.directory, "file")
+		open(path, "w").close()
+		cache = Cache(self.directory)
+		#The subdirectory of the entry cannot be created where a file is
+		cache.Directory = path
+		self.assertFalse(cache.put("tiano", "compressed", "decompressed"))
+		self.assertEqual(cache.get("tiano", "compressed"), None)
+
+if __name__ == "__main__":
+	unittest.main()
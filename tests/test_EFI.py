@@ -0,0 +1,235 @@
+import os
+import sys
+import uuid
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+import Repacker
+import SyntheticImage
+from SyntheticImage import Section, Sections, CompressedSection, UserInterfaceSection, FirmwareVolume, FfsFile, FILETYPES, SECTIONTYPES
+from benchmark import LegacyFindFirmwareVolumes
+from TreePrinter import EfiTreePrintVisitor, EfiTreeStreamPrinter
+from EfiTreeFileDumpVisitor import EfiTreeFileDumpVisitor, EfiStreamFileDumper
+from FDFGenerator import FDFGenerator
+
+def Volume(files=(), size=0x1000):
+	return SyntheticImage.FirmwareVolume(list(files), size)
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+def RawFile(body):
+	return SyntheticImage.FfsFile(uuid.UUID(int=len(body)), EFI.EfiFile.EFI_FILETYPES.EFI_FV_FILETYPE_RAW, body)
+
+class FindFirmwareVolumesTest(unittest.TestCase):
+	"""FindFirmwareVolumes against the UUID loop EfiFirmwareImage used before"""
+	def assertScan(self, data, expected):
+		self.assertEqual(EFI.FindFirmwareVolumes(data), expected)
+		self.assertEqual(LegacyFindFirmwareVolumes(EFI.BufferStream(data), len(data)), expected)
+
+	def test_empty_buffer(self):
+		self.assertScan("", [])
+		self.assertEqual(EFI.FindFirmwareVolumes(buffer("")), [])
+
+	def test_no_volume(self):
+		self.assertScan("\xff" * 0x1000, [])
+
+	def test_volumes_between_padding(self):
+		data = "\xff" * 0x100 + Volume() + "\0" * 0x30 + Volume(size=0x2000) + "\xff" * 0x10
+		self.assertScan(data, [0x100, 0x1130])
+
+	def test_adjacent_volumes(self):
+		self.assertScan(Volume() + Volume() + Volume(), [0, 0x1000, 0x2000])
+
+	def test_volume_at_end_of_buffer(self):
+		self.assertScan("\xff" * 0x800 + Volume(), [0x800])
+
+	def test_signature_at_end_of_buffer(self):
+		#Too short for a header, the legacy loop fails on these
+		self.assertEqual(EFI.FindFirmwareVolumes("\xff" * 0x100 + EFI.FV_SIGNATURE), [])
+		self.assertEqual(EFI.FindFirmwareVolumes("\xff" * 0x100 + Volume()[:EFI.FV_SIGNATURE_OFFSET + 4]), [])
+		self.assertEqual(EFI.FindFirmwareVolumes(Volume()[:EFI.FV_HEADER_LENGTH - 1]), [])
+
+	def test_truncated_volume(self):
+		self.assertEqual(EFI.FindFirmwareVolumes(Volume(size=0x2000)[:0x1800]), [])
+
+	def test_signatures_inside_volume(self):
+		#A volume stored as a raw file contains a second valid header, it is not a top level volume
+		inner = Volume(size=0x400)
+		self.assertScan(Volume([RawFile(inner)]), [0])
+		self.assertScan(Volume([RawFile(EFI.FV_SIGNATURE * 64)]) + Volume(), [0, 0x1000])
+
+	def test_overlapping_false_signature(self):
+		#The header window of the false hit overlaps the real header which follows it
+		data = "\0" * 0x20 + EFI.FV_SIGNATURE + "\0" * 0x1C + Volume()
+		self.assertEqual(EFI.FindFirmwareVolumes(data), [0x40])
+		self.assertScan("\0" * 0x40 + EFI.FV_SIGNATURE * 4 + "\0" * 0x30 + Volume(), [0x80])
+
+	def test_start_and_end(self):
+		data = Volume() + Volume() + Volume()
+		self.assertEqual(EFI.FindFirmwareVolumes(data, 0x1000), [0x1000, 0x2000])
+		self.assertEqual(EFI.FindFirmwareVolumes(data, 0x10), [0x1000, 0x2000])
+		self.assertEqual(EFI.FindFirmwareVolumes(data, 0, 0x2FFF), [0, 0x1000])
+		self.assertEqual(EFI.FindFirmwareVolumes(data, 0x3000), [])
+
+	def test_unknown_file_system(self):
+		data = bytearray(Volume())
+		data[16:32] = uuid.UUID(int=1).bytes_le
+		self.assertScan(str(data), [])
+		self.assertEqual(EFI.FindFirmwareVolumes(str(data), guids=[uuid.UUID(int=1)]), [0])
+
+	def test_bad_header_length(self):
+		data = bytearray(Volume())
+		data[48:50] = "\x10\x00"
+		self.assertEqual(EFI.FindFirmwareVolumes(str(data)), [])
+
+class IterSectionsTest(unittest.TestCase):
+	def test_sections(self):
+		data = Sections([Section(SECTIONTYPES.EFI_SECTION_RAW, "x" * 5), UserInterfaceSection(u"Name")])
+		self.assertEqual([(offset, type(s)) for (offset, s) in EFI.IterSections(data)], [(0, EFI.EfiGenericSection), (12, EFI.EfiUserInterfaceSection)])
+
+	def test_short_section(self):
+		for length in xrange(4):
+			data = Section(SECTIONTYPES.EFI_SECTION_RAW, "x" * 4) + "\0" * 4
+			data = data[:8] + chr(length) + data[9:]
+			self.assertRaises(ValueError, list, EFI.IterSections(data))
+
+	def test_short_file(self):
+		volume = Volume([RawFile("x" * 8)])
+		#Zero the length of the file, with type 0xFF it used to be skipped forever
+		volume = volume[:0x48+18] + "\xff\xff\0\0\0" + volume[0x48+23:]
+		self.assertRaises(ValueError, list, Parse(volume).firmwareVolumes[0].iterChildren())
+
+class SumTest(unittest.TestCase):
+	def setUp(self):
+		self.data = "".join(chr((i * 7919) % 256) for i in xrange(100001))
+		self.audioop = EFI.audioop
+
+	def tearDown(self):
+		EFI.audioop = self.audioop
+
+	def assertSums(self):
+		for data in ("", self.data, buffer(self.data, 1), bytearray(self.data)):
+			self.assertEqual(EFI.Sum8(data), sum(bytearray(data)) & 0xFF)
+			words = bytearray(data)
+			self.assertEqual(EFI.Sum16(data), sum(words[i] | words[i+1] << 8 for i in xrange(0, len(words) - 1, 2)) & 0xFFFF)
+
+	def test_sums(self):
+		self.assertSums()
+
+	def test_sums_without_audioop(self):
+		EFI.audioop = None
+		self.assertSums()
+
+class SectionDataTest(unittest.TestCase):
+	"""Sections parse the same from a bytearray, e.g. after they were modified"""
+	def assertSameSection(self, data):
+		expected = EFI.InstantiateSectionFromType(ord(data[3]), data)
+		section = EFI.InstantiateSectionFromType(ord(data[3]), bytearray(data))
+		self.assertEqual(type(section), type(expected))
+		self.assertEqual(str(section), str(expected))
+		if isinstance(section, EFI.EfiEncapsulationSection):
+			self.assertEqual(section.Decoder, expected.Decoder)
+			self.assertEqual(str(section.UncompressedData), str(expected.UncompressedData))
+		return section
+
+	def test_compressed_section(self):
+		body = [SyntheticImage.UserInterfaceSection(u"Compressed")]
+		self.assertEqual(self.assertSameSection(SyntheticImage.CompressedSection(body)).CompressionType, 1)
+		self.assertEqual(self.assertSameSection(SyntheticImage.CompressedSection(body, False)).CompressionType, 0)
+
+	def test_name_sections(self):
+		self.assertEqual(self.assertSameSection(SyntheticImage.UserInterfaceSection(u"Name")).String, u"Name")
+		self.assertTrue(self.assertSameSection(SyntheticImage.VersionSection(u"1.0")).VersionString.endswith(u"1.0"))
+
+	def test_guid_defined_section(self):
+		section = self.assertSameSection(SyntheticImage.LzmaSection([SyntheticImage.UserInterfaceSection(u"Lzma")]))
+		self.assertEqual(section.Decoder.Name, "lzma")
+
+	def test_encapsulation_section_is_abstract(self):
+		class IncompleteSection(EFI.EfiEncapsulationSection):
+			__slots__ = ()
+			def _decode(self):
+				return ""
+		self.assertRaises(TypeError, EFI.EfiEncapsulationSection, 0x30, "\0" * 4)
+		self.assertRaises(TypeError, IncompleteSection, 0x30, "\0" * 4)
+
+class VendorSection(EFI.EfiGenericSection):
+	__slots__ = ()
+
+	def __str__(self):
+		return super(VendorSection, self).__str__() + "\tVendor: yes\n"
+
+def Listing(directory):
+	result = {}
+	for (dirpath, dirnames, filenames) in os.walk(directory):
+		for filename in filenames:
+			path = os.path.join(dirpath, filename)
+			result[os.path.relpath(path, directory)] = open(path, "rb").read()
+	return result
+
+class RegisteredSectionTest(unittest.TestCase):
+	"""Visitors handle registered subclasses like their base class"""
+	def setUp(self):
+		self.saved = EFI.SECTION_CLASSES.get(SECTIONTYPES.EFI_SECTION_RAW)
+		EFI.RegisterSectionClass(SECTIONTYPES.EFI_SECTION_RAW, VendorSection)
+		self.data = FirmwareVolume([
+			FfsFile(uuid.UUID(int=1), FILETYPES.EFI_FV_FILETYPE_FREEFORM, Sections([
+				Section(SECTIONTYPES.EFI_SECTION_RAW, "vendor data"),
+				CompressedSection([Section(SECTIONTYPES.EFI_SECTION_RAW, "compressed vendor data"), UserInterfaceSection(u"Vendor")]),
+			])),
+		])
+		self.directory = tempfile.mkdtemp(prefix="efipwn-test-")
+
+	def tearDown(self):
+		self.unregister()
+		shutil.rmtree(self.directory)
+
+	def unregister(self):
+		if self.saved is None:
+			EFI.SECTION_CLASSES.pop(SECTIONTYPES.EFI_SECTION_RAW, None)
+		else:
+			EFI.RegisterSectionClass(SECTIONTYPES.EFI_SECTION_RAW, self.saved)
+
+	def test_print(self):
+		printed = StringIO()
+		EfiTreePrintVisitor(output=printed).visit(Parse(self.data))
+		self.assertEqual(printed.getvalue().count("Vendor: yes"), 2)
+		streamed = StringIO()
+		EfiTreeStreamPrinter(output=streamed).process(Parse(self.data))
+		self.assertEqual(streamed.getvalue(), printed.getvalue())
+
+	def test_dump(self):
+		tree = os.path.join(self.directory, "tree")
+		EfiTreeFileDumpVisitor(tree).visit(Parse(self.data))
+		stream = os.path.join(self.directory, "stream")
+		EfiStreamFileDumper(stream).process(Parse(self.data))
+		dumped = Listing(tree)
+		self.assertEqual(dumped.values().count("vendor data"), 1)
+		self.assertEqual(dumped.values().count("compressed vendor data"), 1)
+		self.assertEqual(Listing(stream), dumped)
+		self.unregister()
+		generic = os.path.join(self.directory, "generic")
+		EfiTreeFileDumpVisitor(generic).visit(Parse(self.data))
+		self.assertEqual(Listing(generic), dumped)
+
+	def test_genfdf(self):
+		fdf = FDFGenerator(self.directory).render(Parse(self.data))
+		self.unregister()
+		self.assertEqual(fdf, FDFGenerator(self.directory).render(Parse(self.data)))
+
+	def test_repack(self):
+		image = Parse(self.data)
+		self.assertEqual(Repacker.Repack(image, True), self.data)
+		sections = image.firmwareVolumes[0].files[0].subsections
+		self.assertEqual(type(sections[0]), VendorSection)
+		sections[0].markDirty()
+		self.assertEqual(Repacker.Repack(image), self.data)
+
+if __name__ == "__main__":
+	unittest.main()
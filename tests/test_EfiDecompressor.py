@@ -0,0 +1,137 @@
+import os
+import sys
+import random
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import BitArray
+import EfiCompressor
+import EfiDecompressor
+from benchmark import LegacyBuildHuffmanTree, LegacyHuffmanDecode, BenchBlocks
+
+def HuffSyms(lengths):
+	"""The [symbol, bitlen, code] list LoadHuffmanSyms returns for these code lengths"""
+	codes = EfiCompressor.CanonicalCodes(lengths)
+	return sorted([[symbol, lengths[symbol], codes[symbol]] for symbol in xrange(len(lengths)) if lengths[symbol]], key=lambda huffsym: huffsym[1])
+
+def Encode(huffsyms, symbols):
+	codes = dict((huffsym[0], huffsym) for huffsym in huffsyms)
+	bits = EfiCompressor.BitWriter()
+	for symbol in symbols:
+		bits.write(codes[symbol][1], codes[symbol][2])
+	return bits.getvalue()
+
+class MakeTableTest(unittest.TestCase):
+	"""Table lookups against the nested list tree EfiDecompressor used before"""
+	def assertDecodes(self, huffsyms, symbols):
+		data = Encode(huffsyms, symbols)
+		tree = LegacyBuildHuffmanTree(huffsyms)
+		table = EfiDecompressor.MakeTable(huffsyms)
+		legacyBits = BitArray.BitReader(data)
+		bits = BitArray.BitReader(data)
+		for symbol in symbols:
+			self.assertEqual(LegacyHuffmanDecode(tree, legacyBits), symbol)
+			self.assertEqual(EfiDecompressor.HuffmanDecode(table, bits), symbol)
+			self.assertEqual(bits.tell(), legacyBits.tell())
+
+	def test_single_symbol(self):
+		#The zero symbol count case of LoadHuffmanSyms, both one bit codes mean the same symbol
+		huffsyms = [[7, 1, 0], [7, 1, 1]]
+		self.assertEqual(EfiDecompressor.MakeTable(huffsyms)[0], 1)
+		data = "\x5A"
+		tree = LegacyBuildHuffmanTree(huffsyms)
+		table = EfiDecompressor.MakeTable(huffsyms)
+		(legacyBits, bits) = (BitArray.BitReader(data), BitArray.BitReader(data))
+		for i in xrange(8):
+			self.assertEqual(LegacyHuffmanDecode(tree, legacyBits), 7)
+			self.assertEqual(EfiDecompressor.HuffmanDecode(table, bits), 7)
+		self.assertEqual(bits.tell(), 8)
+
+	def test_equal_lengths(self):
+		huffsyms = HuffSyms([8] * 256)
+		self.assertDecodes(huffsyms, range(256) + range(255, -1, -1))
+
+	def test_longest_codes(self):
+		#Lengths 1, 2, ..., 16, 16: the deepest tree EDK2 can produce
+		huffsyms = HuffSyms(range(1, 17) + [16])
+		self.assertEqual(EfiDecompressor.MakeTable(huffsyms)[0], 16)
+		self.assertDecodes(huffsyms, range(17) + [16, 15, 0, 16])
+
+	def test_zero_lengths_are_skipped(self):
+		self.assertDecodes(HuffSyms([0, 2, 0, 2, 2, 0, 3, 3]), [1, 3, 4, 6, 7, 7, 1])
+
+	def test_random_lengths(self):
+		rng = random.Random(0)
+		for i in xrange(50):
+			count = rng.randrange(2, 510)
+			freqs = [rng.choice([0, 1, 1, 2, 5, 100, 1000]) for s in xrange(count)]
+			EfiCompressor._ensureTwoSymbols(freqs)
+			huffsyms = HuffSyms(EfiCompressor.HuffmanLengths(freqs, 16))
+			used = [huffsym[0] for huffsym in huffsyms]
+			self.assertDecodes(huffsyms, [rng.choice(used) for s in xrange(200)])
+
+	def test_code_too_long(self):
+		self.assertRaises(ValueError, EfiDecompressor.MakeTable, [[0, 1, 0], [1, 17, 0x10000]])
+
+	def test_code_out_of_range(self):
+		self.assertRaises(ValueError, EfiDecompressor.MakeTable, [[0, 1, 0], [1, 2, 0x4]])
+
+	def test_unused_codes(self):
+		#Two 2 bit codes leave half of the table unused
+		table = EfiDecompressor.MakeTable([[5, 2, 0], [6, 2, 1]])
+		self.assertEqual(table[1], [(5 << 5) | 2, (6 << 5) | 2, EfiDecompressor.INVALID_CODE, EfiDecompressor.INVALID_CODE])
+		bits = BitArray.BitReader("\x1F")
+		self.assertEqual(EfiDecompressor.HuffmanDecode(table, bits), 5)
+		self.assertEqual(EfiDecompressor.HuffmanDecode(table, bits), 6)
+		self.assertRaises(ValueError, EfiDecompressor.HuffmanDecode, table, bits)
+
+	def test_compressed_blocks(self):
+		rng = random.Random(1)
+		data = "".join(rng.choice(["EFI", "PWN", "\0" * 40, chr(rng.randrange(256))]) for i in xrange(20000))
+		#BenchBlocks raises if tree and table decode a block differently
+		self.assertTrue(BenchBlocks(EfiCompressor.Compress(data)))
+		self.assertEqual(EfiDecompressor.Decompress(EfiCompressor.Compress(data)), data)
+
+class DecompressTest(unittest.TestCase):
+	def setUp(self):
+		rng = random.Random(2)
+		self.data = "".join(rng.choice(["EFI", "PWN", "\0" * 40, chr(rng.randrange(256))]) for i in xrange(3000))
+		self.compressed = EfiCompressor.Compress(self.data)
+
+	def withSizes(self, compressedSize, decompressedSize, payload=None):
+		return struct.pack("<II", compressedSize, decompressedSize) + (self.compressed[8:] if payload is None else payload)
+
+	def test_round_trip(self):
+		self.assertEqual(EfiDecompressor.Decompress(self.compressed), self.data)
+		#Data after the declared compressed size is not read
+		self.assertEqual(EfiDecompressor.Decompress(self.compressed + "\xff" * 16), self.data)
+
+	def test_short_header(self):
+		self.assertRaises(ValueError, EfiDecompressor.Decompress, self.compressed[:7])
+
+	def test_compressed_size_exceeds_data(self):
+		self.assertRaises(ValueError, EfiDecompressor.Decompress, self.compressed[:-1])
+		self.assertRaises(ValueError, EfiDecompressor.Decompress, self.withSizes(len(self.compressed) - 7, len(self.data)))
+
+	def test_impossible_declared_size(self):
+		self.assertRaises(ValueError, EfiDecompressor.Decompress, self.withSizes(1, EfiDecompressor.MAXMATCH * 8 + 1, "\0"))
+
+	def test_declared_size_beyond_data(self):
+		#The compressed data ends long before the declared size is reached
+		self.assertRaises(ValueError, EfiDecompressor.Decompress, self.withSizes(len(self.compressed) - 8, len(self.data) * 100))
+
+	def test_corrupt_data(self):
+		rng = random.Random(3)
+		for i in xrange(300):
+			data = bytearray(self.compressed)
+			for j in xrange(rng.randrange(1, 4)):
+				data[rng.randrange(8, 64)] = rng.randrange(256)
+			try:
+				EfiDecompressor.Decompress(str(data))
+			except ValueError:
+				pass
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from EfiTreeFileDumpVisitor import DumpWriter
+
+class DumpWriterTest(unittest.TestCase):
+	def setUp(self):
+		self.destination = tempfile.mkdtemp(prefix="efipwn-test-")
+		self.store = os.path.join(self.destination, ".objects")
+
+	def tearDown(self):
+		shutil.rmtree(self.destination)
+
+	def objectPath(self, data):
+		digest = hashlib.sha256(data).hexdigest()
+		return os.path.join(self.store, digest[:2], digest)
+
+	def test_same_payload_is_hardlinked(self):
+		#Objects take a while to be moved into place, other threads try to link them meanwhile
+		rename = os.rename
+		def slowRename(src, dst):
+			time.sleep(0.02)
+			rename(src, dst)
+		os.rename = slowRename
+		try:
+			writer = DumpWriter(8, store=self.store)
+			payloads = ["payload %u" % (i % 3) for i in xrange(48)]
+			for (i, data) in enumerate(payloads):
+				writer.write(os.path.join(self.destination, "file%u" % i), data)
+			writer.close()
+		finally:
+			os.rename = rename
+
+		self.assertEqual(writer.FilesWritten, 48)
+		self.assertEqual(writer.ObjectsStored, 3)
+		for (i, data) in enumerate(payloads):
+			path = os.path.join(self.destination, "file%u" % i)
+			self.assertFalse(os.path.islink(path))
+			self.assertTrue(os.path.samefile(path, self.objectPath(data)))
+			self.assertEqual(open(path, "rb").read(), data)
+
+	def test_rewritten_path_keeps_last_payload(self):
+		writer = DumpWriter(4, store=self.store)
+		path = os.path.join(self.destination, "file")
+		for i in xrange(20):
+			writer.write(path, "version %u" % i)
+		writer.close()
+		self.assertEqual(open(path, "rb").read(), "version 19")
+
+	def test_without_store(self):
+		writer = DumpWriter(4)
+		for i in xrange(10):
+			writer.write(os.path.join(self.destination, "file%u" % i), "x" * i)
+		writer.close()
+		self.assertEqual(writer.BytesWritten, 45)
+		self.assertEqual(open(os.path.join(self.destination, "file9"), "rb").read(), "x" * 9)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+import FDFGenerator
+from SyntheticImage import SyntheticImage
+from benchmark import LegacyFDFGenerator
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+class FDFGeneratorTest(unittest.TestCase):
+	"""The FDF against the generator compiling every template per node used before"""
+	@classmethod
+	def setUpClass(cls):
+		data = SyntheticImage(128 * 1024, seed=7).build()
+		cls.image = Parse(data)
+		cls.expected = LegacyFDFGenerator("/dump").visit(cls.image)
+
+	def setUp(self):
+		self.saved = FDFGenerator.TEMPLATE_MODULE_DIR
+		self.directory = tempfile.mkdtemp(prefix="efipwn-test-")
+
+	def tearDown(self):
+		FDFGenerator.TEMPLATE_MODULE_DIR = self.saved
+		shutil.rmtree(self.directory)
+
+	def test_baseline(self):
+		self.assertTrue("FV_1" in self.expected)
+		self.assertEqual(FDFGenerator.FDFGenerator("/dump").render(self.image), self.expected)
+
+	def test_template_cache(self):
+		FDFGenerator.TEMPLATE_MODULE_DIR = os.path.join(self.directory, "templates")
+		self.assertEqual(FDFGenerator.FDFGenerator("/dump").render(self.image), self.expected)
+		self.assertTrue(os.listdir(FDFGenerator.TEMPLATE_MODULE_DIR))
+		#A later run loads the compiled templates from the cache
+		del FDFGenerator._lookups[(FDFGenerator.TEMPLATEDIR, FDFGenerator.TEMPLATE_MODULE_DIR)]
+		self.assertEqual(FDFGenerator.FDFGenerator("/dump").render(self.image), self.expected)
+
+	def test_generate_streams_the_same(self):
+		path = os.path.join(self.directory, "image.fdf")
+		output = open(path, "w")
+		FDFGenerator.FDFGenerator("/dump").generate(self.image, output)
+		output.close()
+		self.assertEqual(open(path).read(), self.expected)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import uuid
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+from GuidIndex import GuidIndex, FormatPath
+from SyntheticImage import *
+
+DEEP = uuid.UUID(int=0xDEE9)
+
+def Driver(guid, compress=True):
+	sections = [Section(SECTIONTYPES.EFI_SECTION_PE32, guid.bytes * 8), UserInterfaceSection(unicode(guid))]
+	return FfsFile(guid, FILETYPES.EFI_FV_FILETYPE_DRIVER, Sections([CompressedSection(sections)] if compress else sections))
+
+def FvImageFile(guid, volume):
+	return FfsFile(guid, FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE, Sections([CompressedSection([FirmwareVolumeSection(volume)])]))
+
+def Encoded(node):
+	"""Returns the encapsulation sections below node which were decoded and which were not"""
+	result = ([], [])
+	for (offset, child) in EFI.CachedChildren(node) if node.IsExpanded else []:
+		if isinstance(child, EFI.EfiEncapsulationSection):
+			result[not child.IsDecoded].append(child)
+		(decoded, encoded) = Encoded(child)
+		result[0].extend(decoded)
+		result[1].extend(encoded)
+	return result
+
+class GuidIndexTest(unittest.TestCase):
+	def setUp(self):
+		#A chain of three compressed volumes with DEEP at the bottom, followed by
+		#compressed drivers at every level
+		volume = FirmwareVolume([Driver(DEEP, False)] + [Driver(uuid.UUID(int=0x300 + i)) for i in xrange(3)])
+		for level in xrange(3):
+			volume = FirmwareVolume([FvImageFile(uuid.UUID(int=0xF0 + level), volume)] + [Driver(uuid.UUID(int=0x100 * level + i)) for i in xrange(4)])
+		self.data = volume + FirmwareVolume([Driver(uuid.UUID(int=0x1000 + i)) for i in xrange(6)])
+
+	def image(self):
+		return EFI.EfiFirmwareImage(EFI.BufferStream(self.data), len(self.data))
+
+	def test_deep_lookup_decodes_the_way_down(self):
+		image = self.image()
+		matches = GuidIndex(image).lookup(DEEP)
+		self.assertEqual(len(matches), 1)
+		self.assertEqual(len(matches[0][1]), 14)
+		(decoded, encoded) = Encoded(image)
+		self.assertEqual(len(decoded), 3)
+		self.assertTrue(encoded)
+
+	def test_header_lookup_decodes_nothing(self):
+		image = self.image()
+		self.assertEqual(len(GuidIndex(image).lookup(uuid.UUID(int=0x1005))), 1)
+		self.assertEqual(Encoded(image)[0], [])
+
+	def test_lookup_finds_what_complete_finds(self):
+		complete = GuidIndex(self.image()).complete()
+		self.assertTrue(complete.IsComplete)
+		for guid in complete.guids():
+			expected = [FormatPath(path) for (node, path) in complete.lookupAll(guid)]
+			index = GuidIndex(self.image())
+			self.assertEqual(FormatPath(index.lookup(guid)[0][1]), expected[0])
+			self.assertEqual([FormatPath(path) for (node, path) in index.lookupAll(guid)], expected)
+
+	def test_missing(self):
+		index = GuidIndex(self.image())
+		self.assertEqual(index.lookup(uuid.UUID(int=0x9999)), [])
+		self.assertTrue(index.IsComplete)
+		self.assertFalse(uuid.UUID(int=0x9999) in index)
+
+if __name__ == "__main__":
+	unittest.main()
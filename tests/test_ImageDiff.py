@@ -0,0 +1,92 @@
+import os
+import sys
+import uuid
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+from ImageDiff import ImageDiff, ADDED, REMOVED, CHANGED, REENCODED
+from SyntheticImage import *
+
+#Without a registered decoder, like EFI_CRC32_GUIDED_SECTION_EXTRACTION
+CRC32_GUID = uuid.UUID('{fc1bcdb0-7d31-49aa-936a-a4600d9dd083}')
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+def Driver(number, body="A" * 100, compress=True):
+	return FfsFile(uuid.UUID(int=number), FILETYPES.EFI_FV_FILETYPE_DRIVER, Sections([
+		CompressedSection([Section(SECTIONTYPES.EFI_SECTION_PE32, body), UserInterfaceSection(u"Driver%u" % number)], compress),
+	]))
+
+def Crc32Driver(number, body):
+	return FfsFile(uuid.UUID(int=number), FILETYPES.EFI_FV_FILETYPE_DRIVER, Sections([
+		GuidDefinedSection(CRC32_GUID, "\0" * 4 + Sections([Section(SECTIONTYPES.EFI_SECTION_PE32, body)]), 2),
+	]))
+
+def VolumeFile(number, volume):
+	return FfsFile(uuid.UUID(int=number), FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE, Sections([
+		CompressedSection([FirmwareVolumeSection(volume)]),
+	]))
+
+def SetState(volume, state):
+	"""Changes the state byte of the first file of volume, which no checksum covers"""
+	volume = bytearray(volume)
+	volume[0x48+23] = state
+	return str(volume)
+
+class ImageDiffTest(unittest.TestCase):
+	def setUp(self):
+		self.other = FirmwareVolume([Driver(0x100 + i) for i in xrange(3)])
+
+	def diff(self, oldFiles, newFiles):
+		d = ImageDiff()
+		changes = d.diff(Parse(FirmwareVolume(oldFiles) + self.other), Parse(FirmwareVolume(newFiles) + self.other))
+		return (d, [(status, guid.int) for (status, guid, path, oldFile, newFile) in changes])
+
+	def test_identical(self):
+		(d, changes) = self.diff([Driver(1), Driver(2)], [Driver(1), Driver(2)])
+		self.assertEqual(changes, [])
+		self.assertEqual((d.VolumesCompared, d.Pruned, d.FilesCompared), (2, 2, 0))
+
+	def test_added_and_removed(self):
+		(d, changes) = self.diff([Driver(1), Driver(2)], [Driver(2), Driver(3)])
+		self.assertEqual(changes, [(ADDED, 3), (REMOVED, 1)])
+		#The second volume is identical and skipped without being parsed
+		self.assertEqual(d.Pruned, 2)
+
+	def test_changed(self):
+		(d, changes) = self.diff([Driver(1), Driver(2)], [Driver(1), Driver(2, "B" * 100)])
+		self.assertEqual(changes, [(CHANGED, 2)])
+
+	def test_reencoded(self):
+		(d, changes) = self.diff([Driver(1), Driver(2)], [Driver(1), Driver(2, compress=False)])
+		self.assertEqual(changes, [(REENCODED, 2)])
+
+	def test_pruned_volume_is_not_parsed(self):
+		old = Parse(FirmwareVolume([Driver(1)]) + self.other)
+		new = Parse(FirmwareVolume([Driver(2)]) + self.other)
+		ImageDiff().diff(old, new)
+		self.assertFalse(old.firmwareVolumes[1].IsExpanded)
+		self.assertFalse(new.firmwareVolumes[1].IsExpanded)
+
+	def test_nested_volume(self):
+		inner = [Driver(0x10), Driver(0x11)]
+		(d, changes) = self.diff([VolumeFile(1, FirmwareVolume(inner))], [VolumeFile(1, FirmwareVolume(inner[:1] + [Driver(0x11, "B" * 100), Driver(0x12)]))])
+		self.assertEqual(changes, [(CHANGED, 1), (CHANGED, 0x11), (ADDED, 0x12)])
+
+	def test_undecoded_section_payload(self):
+		(d, changes) = self.diff([Crc32Driver(1, "A" * 100)], [Crc32Driver(1, "B" * 100)])
+		self.assertEqual(changes, [(CHANGED, 1)])
+
+	def test_state_only(self):
+		data = FirmwareVolume([Driver(1)])
+		#EFI_FILE_DELETED, inverted with the erase polarity of 1
+		deleted = SetState(data, 0xE8)
+		self.assertEqual(Parse(deleted).firmwareVolumes[0].files[0].State, 0xE8)
+		changes = ImageDiff().diff(Parse(data), Parse(deleted))
+		self.assertEqual([(status, guid.int) for (status, guid, path, oldFile, newFile) in changes], [(CHANGED, 1)])
+
+if __name__ == "__main__":
+	unittest.main()
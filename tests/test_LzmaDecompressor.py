@@ -0,0 +1,70 @@
+import os
+import sys
+import random
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import LzmaCompressor
+import LzmaDecompressor
+
+class RecordingHandler(logging.Handler):
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.Records = []
+
+	def emit(self, record):
+		self.Records.append(record)
+
+class DecompressTest(unittest.TestCase):
+	def setUp(self):
+		rng = random.Random(0)
+		self.data = "".join(rng.choice(["EFI", "\0" * 32, chr(rng.randrange(256))]) for i in xrange(3000))
+		self.compressed = LzmaCompressor.Compress(self.data)
+		self.saved = (LzmaDecompressor.lzma, LzmaDecompressor.pylzma, LzmaDecompressor.LZMA_BINARY, LzmaDecompressor._warnedPython)
+		self.handler = RecordingHandler()
+		LzmaDecompressor.logger.addHandler(self.handler)
+
+	def tearDown(self):
+		(LzmaDecompressor.lzma, LzmaDecompressor.pylzma, LzmaDecompressor.LZMA_BINARY, LzmaDecompressor._warnedPython) = self.saved
+		LzmaDecompressor.logger.removeHandler(self.handler)
+
+	def warnings(self):
+		return [r for r in self.handler.Records if r.levelno == logging.WARNING]
+
+	def test_python_decoder(self):
+		self.assertEqual(LzmaDecompressor.DecompressPython(self.compressed), self.data)
+		self.assertEqual(LzmaDecompressor.DecompressPython(buffer("\0" + self.compressed, 1)), self.data)
+
+	def test_python_fallback_warns_once(self):
+		(LzmaDecompressor.lzma, LzmaDecompressor.pylzma, LzmaDecompressor.LZMA_BINARY, LzmaDecompressor._warnedPython) = (None, None, None, False)
+		for i in xrange(3):
+			self.assertEqual(LzmaDecompressor.Decompress(self.compressed), self.data)
+		self.assertEqual(len(self.warnings()), 1)
+
+	def test_binary_preferred_without_module(self):
+		(LzmaDecompressor.lzma, LzmaDecompressor.pylzma, LzmaDecompressor._warnedPython) = (None, None, False)
+		LzmaDecompressor.LZMA_BINARY = "/nonexistent/LzmaCompress"
+		calls = []
+		decompressBinary = LzmaDecompressor.DecompressBinary
+		try:
+			LzmaDecompressor.DecompressBinary = lambda buf, binary: calls.append(binary) or self.data
+			self.assertEqual(LzmaDecompressor.Decompress(self.compressed), self.data)
+		finally:
+			LzmaDecompressor.DecompressBinary = decompressBinary
+		self.assertEqual(calls, ["/nonexistent/LzmaCompress"])
+		self.assertEqual(self.warnings(), [])
+
+	def test_missing_binary_falls_back_to_python(self):
+		(LzmaDecompressor.lzma, LzmaDecompressor.pylzma, LzmaDecompressor._warnedPython) = (None, None, False)
+		LzmaDecompressor.LZMA_BINARY = "/nonexistent/LzmaCompress"
+		self.assertEqual(LzmaDecompressor.Decompress(self.compressed), self.data)
+		self.assertEqual(len(self.warnings()), 2)
+
+	def test_invalid_header(self):
+		self.assertRaises(ValueError, LzmaDecompressor.DecompressPython, "\xff" + self.compressed[1:])
+		self.assertRaises(ValueError, LzmaDecompressor.DecompressPython, self.compressed[:8])
+
+if __name__ == "__main__":
+	unittest.main()
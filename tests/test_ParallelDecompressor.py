@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+from SyntheticImage import SyntheticImage
+from ParallelDecompressor import DecompressTree
+from TreePrinter import EfiTreePrintVisitor
+from FDFGenerator import FDFGenerator
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+def EncapsulationSections(node):
+	"""The encapsulation sections below node in image order, without decoding any"""
+	result = []
+	if isinstance(node, EFI.EfiEncapsulationSection) and not node.IsDecoded:
+		return result
+	for (offset, child) in EFI.CachedChildren(node):
+		if isinstance(child, EFI.EfiEncapsulationSection):
+			result.append(child)
+		result.extend(EncapsulationSections(child))
+	return result
+
+def Output(image):
+	printed = StringIO()
+	EfiTreePrintVisitor(output=printed).visit(image)
+	return (printed.getvalue(), FDFGenerator("/dump").render(image))
+
+class DecompressTreeTest(unittest.TestCase):
+	def setUp(self):
+		#Nested Tiano and LZMA sections, LZMA decoding may be pure python here so the image is small
+		self.data = SyntheticImage(160 * 1024, seed=5, compressedShare=0.5).build()
+
+	def test_parallel_equals_serial(self):
+		serial = Parse(self.data)
+		expected = Output(serial)
+
+		image = Parse(self.data)
+		DecompressTree(image, 3)
+		sections = EncapsulationSections(image)
+		#Everything was decoded by the workers and stored back, nested levels included
+		self.assertEqual([s.IsDecoded for s in sections], [True] * len(sections))
+		self.assertTrue(any(s.Decoder is not None and s.Decoder.Name == "lzma" for s in sections))
+		self.assertTrue(any(s.Decoder is not None and s.Decoder.Name == "tiano" for s in sections))
+		self.assertTrue(any(isinstance(s, EFI.EfiFirmwareVolumeSection) for n in sections for s in n.Subsections))
+
+		#In the same order as the serial parse decodes them
+		serialSections = EncapsulationSections(serial)
+		self.assertEqual(len(sections), len(serialSections))
+		for (s, expectedSection) in zip(sections, serialSections):
+			self.assertEqual(str(s.UncompressedData), str(expectedSection.UncompressedData))
+		self.assertEqual(Output(image), expected)
+
+if __name__ == "__main__":
+	unittest.main()
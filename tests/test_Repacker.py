@@ -0,0 +1,164 @@
+import os
+import sys
+import uuid
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+import Repacker
+import Verifier
+from SyntheticImage import *
+
+DRIVER = uuid.UUID(int=0xD1)
+
+def Driver(guid, length):
+	return FfsFile(guid, FILETYPES.EFI_FV_FILETYPE_DRIVER, Sections([Section(SECTIONTYPES.EFI_SECTION_PE32, "\x4d" * length), UserInterfaceSection(u"Driver")]))
+
+def FvImageFile(guid, volume, compress=True):
+	return FfsFile(guid, FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE, CompressedSection([FirmwareVolumeSection(volume)], compress))
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+def BlockMap(volume):
+	return struct.unpack_from("<II", volume.stream.Data, volume.Base + EFI.FV_HEADER_LENGTH)
+
+class NestedVolumeTest(unittest.TestCase):
+	def build(self, compress=True, depth=1):
+		#The innermost volume is filled up to its last block
+		volume = FirmwareVolume([Driver(DRIVER, 0xF00), Driver(uuid.UUID(int=0xD2), 0xE00)], 0x2000)
+		for level in xrange(depth):
+			volume = FirmwareVolume([FvImageFile(uuid.UUID(int=0xF0 + level), volume, compress)], None if level < depth - 1 else 0x40000)
+		return volume
+
+	def innermost(self, image):
+		volume = image.firmwareVolumes[0]
+		while True:
+			section = volume.files[0].subsections[0]
+			if not isinstance(section, EFI.EfiCompressedSection):
+				return volume
+			volume = section.Subsections[0].SubFirmware.firmwareVolumes[0]
+
+	def replace(self, data, length):
+		image = Parse(data)
+		Repacker.ReplaceFile(image, DRIVER, Repacker.ParseFile(Driver(DRIVER, length)))
+		return Repacker.Repack(image)
+
+	def assertGrown(self, data, depth):
+		result = Parse(data)
+		self.assertEqual(len(data), 0x40000)
+		self.assertEqual(Verifier.Verify(result), [])
+		volume = self.innermost(result)
+		self.assertEqual(volume.HeaderLength + volume.DataLength, 0x3000)
+		self.assertEqual(BlockMap(volume), (3, 0x1000))
+		self.assertEqual([f.Guid for f in volume.files], [DRIVER, uuid.UUID(int=0xD2)])
+		self.assertEqual(len(volume.files[0].subsections[0].RawContent), 0xF00 + 3000)
+
+	def test_grow_compressed(self):
+		self.assertGrown(self.replace(self.build(), 0xF00 + 3000), 1)
+
+	def test_grow_uncompressed(self):
+		self.assertGrown(self.replace(self.build(False), 0xF00 + 3000), 1)
+
+	def test_grow_twice_nested(self):
+		self.assertGrown(self.replace(self.build(depth=2), 0xF00 + 3000), 2)
+
+	def test_size_kept_when_it_fits(self):
+		data = self.replace(self.build(), 0xF00 - 0x100)
+		volume = self.innermost(Parse(data))
+		self.assertEqual(volume.HeaderLength + volume.DataLength, 0x2000)
+		self.assertEqual(Verifier.Verify(Parse(data)), [])
+
+	def test_top_level_volume_is_fixed(self):
+		data = FirmwareVolume([Driver(DRIVER, 0xF00)], 0x1000)
+		self.assertRaises(ValueError, self.replace, data, 0x1000)
+
+	def test_unmodified(self):
+		data = self.build(depth=2)
+		self.assertEqual(Repacker.Repack(Parse(data)), data)
+		self.assertEqual(Repacker.Repack(Parse(data), True), data)
+
+class UpdateTest(unittest.TestCase):
+	def setUp(self):
+		#Three volumes with a compressed and an uncompressed driver each
+		volumes = []
+		for v in xrange(3):
+			volumes.append("\xff" * 0x100 + FirmwareVolume([
+				FfsFile(uuid.UUID(int=0x100 * v + 1), FILETYPES.EFI_FV_FILETYPE_DRIVER, Sections([CompressedSection([Section(SECTIONTYPES.EFI_SECTION_PE32, "P%u" % v * 100), UserInterfaceSection(u"Compressed%u" % v)])])),
+				Driver(uuid.UUID(int=0x100 * v + 2), 0x100),
+			], 0x4000))
+		self.data = "".join(volumes)
+
+	def edit(self, image, step):
+		#Every step modifies the second volume only
+		if step % 2:
+			Repacker.ReplaceSection(image, uuid.UUID(int=0x101), SECTIONTYPES.EFI_SECTION_PE32, "step %u" % step * (step + 1))
+		else:
+			Repacker.ReplaceFile(image, uuid.UUID(int=0x102), Repacker.ParseFile(Driver(uuid.UUID(int=0x102), 0x80 * step)))
+
+	def test_update_matches_full_repack(self):
+		image = Parse(self.data)
+		for step in xrange(4):
+			self.edit(image, step)
+			data = Repacker.Update(image)
+			#A freshly parsed image with the same modifications, rebuilt entirely
+			expected = Parse(self.data)
+			for s in xrange(step + 1):
+				self.edit(expected, s)
+			self.assertEqual(data, Repacker.Repack(expected, True))
+			self.assertEqual(Verifier.Verify(Parse(data)), [])
+			self.assertFalse(image.Dirty)
+			self.assertEqual(Repacker.Repack(image), data)
+
+	def test_untouched_volumes_are_reused(self):
+		image = Parse(self.data)
+		volumes = list(image.firmwareVolumes)
+		#Decompress everything, the untouched volumes keep it
+		for v in volumes:
+			for f in v.files:
+				[s.Subsections for s in f.subsections]
+		self.edit(image, 1)
+		data = Repacker.Update(image)
+		self.assertIs(image.firmwareVolumes[0], volumes[0])
+		self.assertIs(image.firmwareVolumes[2], volumes[2])
+		self.assertTrue(volumes[2].files[0].subsections[0].IsDecoded)
+
+		#Only the modified volume is parsed again, from the new bytes
+		volume = image.firmwareVolumes[1]
+		self.assertIsNot(volume, volumes[1])
+		self.assertFalse(volume.IsExpanded)
+		self.assertIs(volume.stream.Data, image.stream.Data)
+		self.assertEqual(volume.files[0].subsections[0].Subsections[0].RawContent[:], "step 1" * 2)
+
+		#Repeated updates keep reusing them
+		self.edit(image, 2)
+		data = Repacker.Update(image)
+		self.assertEqual(Repacker.Repack(Parse(data), True), data)
+		self.assertIs(image.firmwareVolumes[0], volumes[0])
+		self.assertIs(image.firmwareVolumes[2], volumes[2])
+
+	def test_update_unmodified(self):
+		image = Parse(self.data)
+		volumes = list(image.firmwareVolumes)
+		self.assertEqual(Repacker.Update(image), self.data)
+		self.assertEqual(image.firmwareVolumes, volumes)
+
+class GrowVolumeHeaderTest(unittest.TestCase):
+	def test_last_entry_grows(self):
+		header = bytearray(FirmwareVolume([], 0x2000)[0:EFI.FV_HEADER_LENGTH + 16])
+		header[EFI.FV_HEADER_LENGTH:EFI.FV_HEADER_LENGTH+8] = struct.pack("<II", 1, 0x1000)
+		header[EFI.FV_HEADER_LENGTH+8:] = struct.pack("<II", 2, 0x800)
+		header += struct.pack("<II", 0, 0)
+		self.assertEqual(Repacker.GrowVolumeHeader(header, 0x2801), 0x3000)
+		self.assertEqual(struct.unpack_from("<IIII", header, EFI.FV_HEADER_LENGTH), (1, 0x1000, 4, 0x800))
+		self.assertEqual(struct.unpack_from("<Q", header, 32), (0x3000,))
+
+	def test_no_block_map(self):
+		header = bytearray(FirmwareVolume([], 0x1000)[0:EFI.FV_HEADER_LENGTH + 16])
+		header[EFI.FV_HEADER_LENGTH:] = "\0" * 16
+		self.assertRaises(ValueError, Repacker.GrowVolumeHeader, header, 0x2000)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import uuid
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+import SidecarIndex
+from SyntheticImage import *
+from TreePrinter import EfiTreeStreamPrinter
+
+#Not used by the specification, the tests register an encapsulation section for it
+XOR_SECTION = 0x30
+
+def Xor(data):
+	return "".join(chr(ord(c) ^ 0x5A) for c in str(data))
+
+class EfiXorSection(EFI.EfiEncapsulationSection):
+	__slots__ = ()
+
+	@property
+	def Payload(self):
+		return EFI.BufferView(self.Data, 4)
+
+	def _decode(self):
+		return Xor(self.Payload)
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+class SidecarIndexTest(unittest.TestCase):
+	def setUp(self):
+		EFI.RegisterSectionClass(XOR_SECTION, EfiXorSection)
+		image = SyntheticImage(256 * 1024, seed=3)
+		files = image.everyFileType()
+		files.append(image.nestedVolume(2, 8 * 1024))
+		files.append(FfsFile(uuid.UUID(int=0x505), FILETYPES.EFI_FV_FILETYPE_FREEFORM, Sections([
+			Section(XOR_SECTION, Xor(Sections([UserInterfaceSection(u"Hidden"), Section(SECTIONTYPES.EFI_SECTION_RAW, "z" * 8)]))),
+		])))
+		self.data = "\xff" * 0x1000 + FirmwareVolume(files)
+		self.index = SidecarIndex.BuildIndex(Parse(self.data), SidecarIndex.ImageHash(self.data))
+
+	def tearDown(self):
+		del EFI.SECTION_CLASSES[XOR_SECTION]
+
+	def assertSamePrint(self, maxDepth=None, decompress=True):
+		expected = StringIO()
+		EfiTreeStreamPrinter(maxDepth, decompress, output=expected).process(Parse(self.data))
+		printed = StringIO()
+		SidecarIndex.IndexPrinter(maxDepth, decompress, output=printed).process(self.index)
+		self.assertEqual(printed.getvalue(), expected.getvalue())
+
+	def test_print(self):
+		self.assertSamePrint()
+
+	def test_print_depth(self):
+		for depth in xrange(6):
+			self.assertSamePrint(depth)
+
+	def test_print_without_decompressing(self):
+		self.assertSamePrint(decompress=False)
+
+	def test_registered_encapsulation(self):
+		records = [r for r in self.index["nodes"] if r["kind"] == "section" and r["type"] == XOR_SECTION]
+		self.assertEqual(len(records), 1)
+		self.assertTrue(records[0]["encapsulation"])
+		printed = StringIO()
+		SidecarIndex.IndexPrinter(decompress=False, output=printed).process(self.index)
+		self.assertNotIn("Hidden", printed.getvalue())
+
+	def test_records_hold_no_text(self):
+		for record in self.index["nodes"]:
+			self.assertNotIn("text", record)
+			self.assertIn(record["kind"], ("volume", "file", "section"))
+
+	def test_nodes(self):
+		indexed = SidecarIndex.IndexedImage(self.index, self.data)
+		for (number, record) in enumerate(self.index["nodes"]):
+			node = indexed.node(number)
+			self.assertEqual(str(node), SidecarIndex.RecordText(record))
+			self.assertEqual(len(node.Data) if record["kind"] == "section" else record["length"], record["length"])
+
+	def test_lookup(self):
+		indexed = SidecarIndex.IndexedImage(self.index, self.data)
+		numbers = indexed.lookup(uuid.UUID(int=0x505))
+		self.assertEqual(len(numbers), 1)
+		path = indexed.nodePath(numbers[0])
+		self.assertEqual([type(n) for n in path], [EFI.EfiFirmwareVolume, EFI.EfiFile])
+		self.assertEqual(path[0].Base, 0x1000)
+
+	def test_outdated(self):
+		self.assertEqual(self.index["version"], SidecarIndex.INDEX_VERSION)
+		self.assertNotEqual(self.index["sha256"], SidecarIndex.ImageHash(self.data[:-1] + "\0"))
+
+if __name__ == "__main__":
+	unittest.main()
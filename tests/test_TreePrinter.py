@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import uuid
+import struct
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+from SyntheticImage import *
+from TreePrinter import EfiTreePrintVisitor, EfiTreeStreamPrinter, EfiTreeJsonPrinter, _fileName
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+def Records(data, **options):
+	output = StringIO()
+	EfiTreeJsonPrinter(output=output, **options).process(Parse(data))
+	return [json.loads(line) for line in output.getvalue().splitlines()]
+
+class JsonPrinterTest(unittest.TestCase):
+	def setUp(self):
+		self.data = "\xff" * 0x100 + FirmwareVolume([
+			FfsFile(uuid.UUID(int=1), FILETYPES.EFI_FV_FILETYPE_FREEFORM, Sections([FreeformSubtypeGuidSection(uuid.UUID(int=2), "x" * 10), UserInterfaceSection(u"Freeform")])),
+			FfsFile(uuid.UUID(int=3), FILETYPES.EFI_FV_FILETYPE_DRIVER, Sections([CompressedSection([Section(SECTIONTYPES.EFI_SECTION_PE32, "y" * 100), VersionSection(u"1.0")])])),
+			FfsFile(uuid.UUID(int=4), FILETYPES.EFI_FV_FILETYPE_FIRMWARE_VOLUME_IMAGE, Sections([FirmwareVolumeSection(FirmwareVolume([], 0x1000))])),
+		])
+
+	def test_kinds(self):
+		records = Records(self.data)
+		self.assertEqual([r["kind"] for r in records], ["volume", "file", "section", "section", "file", "section", "section", "section", "file", "section", "volume"])
+
+	def test_header_lengths(self):
+		records = Records(self.data)
+		self.assertEqual([r["headerLength"] for r in records], [0x48, 24, 20, 4, 24, 9, 4, 4, 24, 4, 0x48])
+		for r in records:
+			if r["imageOffset"] is None:
+				continue
+			if r["kind"] == "section":
+				self.assertEqual(struct.unpack("<I", self.data[r["imageOffset"]:r["imageOffset"]+3] + "\0")[0], r["length"])
+				self.assertEqual(ord(self.data[r["imageOffset"]+3]), r["type"])
+			if r["headerLength"] == 20:
+				self.assertEqual(self.data[r["imageOffset"]+4:r["imageOffset"]+20], uuid.UUID(r["guid"]).bytes_le)
+
+	def test_names_and_paths(self):
+		records = Records(self.data)
+		self.assertEqual(records[1]["name"], "Freeform")
+		self.assertTrue(records[7]["version"].endswith("1.0"))
+		self.assertEqual(records[5]["algorithm"], "tiano")
+		self.assertEqual(records[6]["imageOffset"], None)
+		self.assertEqual(records[10]["path"], "FV@0x100/00000000-0000-0000-0000-000000000004/FIRMWARE_VOLUME_IMAGE/FV@0x0")
+
+	def test_stream_and_json_match(self):
+		records = Records(self.data)
+		self.assertEqual(Records(self.data, stream=True), records)
+		output = StringIO()
+		EfiTreeJsonPrinter(output=output, format="json").process(Parse(self.data))
+		self.assertEqual(json.loads(output.getvalue()), records)
+
+	def test_no_decompress(self):
+		records = Records(self.data, decompress=False)
+		self.assertEqual(len(records), 9)
+		self.assertEqual(records[5]["kind"], "section")
+
+	def test_depth(self):
+		for depth in xrange(5):
+			records = Records(self.data, maxDepth=depth)
+			self.assertEqual(set(r["depth"] for r in records), set(xrange(depth)))
+			self.assertEqual(Records(self.data, maxDepth=depth, stream=True), records)
+			printed = StringIO()
+			EfiTreePrintVisitor(depth, output=printed).visit(Parse(self.data))
+			streamed = StringIO()
+			EfiTreeStreamPrinter(depth, output=streamed).process(Parse(self.data))
+			self.assertEqual(streamed.getvalue(), printed.getvalue())
+			self.assertEqual(printed.getvalue() == "", depth == 0)
+		self.assertEqual(Records(self.data, maxDepth=1), [r for r in Records(self.data) if r["depth"] == 0])
+		self.assertEqual(Records(self.data, maxDepth=1)[0]["kind"], "volume")
+
+	def test_file_name_of_bytearray(self):
+		#E.g. a file that was modified before printing
+		files = Parse(self.data).firmwareVolumes[0].files
+		for f in files:
+			name = _fileName(f)
+			f.Data = bytearray(f.Data)
+			self.assertEqual(_fileName(f), name)
+		self.assertEqual(_fileName(files[0]), u"Freeform")
+
+	def test_empty(self):
+		output = StringIO()
+		EfiTreeJsonPrinter(output=output, format="json").process(Parse("\xff" * 0x100))
+		self.assertEqual(output.getvalue(), "[]\n")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import uuid
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import EFI
+import Verifier
+from SyntheticImage import *
+
+def Parse(data):
+	return EFI.EfiFirmwareImage(EFI.BufferStream(data), len(data))
+
+class VerifierTest(unittest.TestCase):
+	def setUp(self):
+		#Bit 0 is FFS_ATTRIB_TAIL_PRESENT in FFS1 and FFS_ATTRIB_LARGE_FILE in FFS2, the
+		#data checksum covers the whole body including what would be the tail
+		self.body = Sections([Section(SECTIONTYPES.EFI_SECTION_RAW, "x" * 30)]) + "\x12\x34"
+		self.file = FfsFile(uuid.UUID(int=1), FILETYPES.EFI_FV_FILETYPE_FREEFORM, self.body, 0x41)
+
+	def test_valid(self):
+		self.assertEqual(Verifier.Verify(Parse(FirmwareVolume([self.file]))), [])
+
+	def test_ffs2_has_no_tail(self):
+		image = Parse(FirmwareVolume([self.file], fileSystem=EFI.EFIGUIDS.FIRMWARE_VOLUME2))
+		self.assertEqual(image.firmwareVolumes[0].FileSystemGuid, EFI.EFIGUIDS.FIRMWARE_VOLUME2)
+		self.assertEqual(Verifier.Verify(image), [])
+
+	def test_ffs1_tail_is_not_summed(self):
+		image = Parse(FirmwareVolume([self.file], fileSystem=EFI.EFIGUIDS.FIRMWARE_VOLUME1))
+		self.assertEqual(image.firmwareVolumes[0].FileSystemGuid, EFI.EFIGUIDS.FIRMWARE_VOLUME1)
+		problems = Verifier.Verify(image)
+		self.assertEqual([(kind, stored, expected) for (kind, path, stored, expected) in problems],
+			[(Verifier.FILE_DATA, (-sum(bytearray(self.body))) & 0xFF, (-sum(bytearray(self.body[:-2]))) & 0xFF)])
+
+	def test_bad_header_checksum(self):
+		volume = bytearray(FirmwareVolume([self.file]))
+		volume[EFI.FV_CHECKSUM_OFFSET] ^= 1
+		problems = Verifier.Verify(Parse(str(volume)))
+		self.assertEqual([kind for (kind, path, stored, expected) in problems], [Verifier.FV_HEADER])
+
+if __name__ == "__main__":
+	unittest.main()